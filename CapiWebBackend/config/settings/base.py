@@ -16,6 +16,7 @@ import environ
 import os
 # Libreria para internacionalización
 from django.utils.translation import gettext_lazy as _
+from corsheaders.defaults import default_headers
 
 env = environ.Env(
     # set casting, default value
@@ -94,7 +95,59 @@ SESSION_COOKIE_SAMESITE = 'Lax'  # CSRF protection
 
 # File Upload Settings
 DATA_UPLOAD_MAX_MEMORY_SIZE = 30 * 1024 * 1024 * 1024  # 30 GB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 30 * 1024 * 1024 * 1024  # 30 GB
+# Los archivos mayores se vuelcan a disco en lugar de quedarse en memoria
+FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Subidas por fragmentos reanudables (transfers)
+TRANSFER_UPLOAD_CHUNK_SIZE = env.int('TRANSFER_UPLOAD_CHUNK_SIZE', default=8 * 1024 * 1024)  # 8 MB
+TRANSFER_UPLOAD_SESSION_TTL_HOURS = env.int('TRANSFER_UPLOAD_SESSION_TTL_HOURS', default=24)
+
+# Pre-admisión de subidas: POST /api/transfers/preflight/ devuelve un ticket que la
+# subida presenta en la cabecera X-Upload-Ticket (obligatorio con REQUIRED=True; por defecto
+# no, para no romper a los clientes existentes). Cuota por propietario en MB (0 = sin límite)
+TRANSFER_UPLOAD_TICKET_REQUIRED = env.bool('TRANSFER_UPLOAD_TICKET_REQUIRED', default=False)
+TRANSFER_UPLOAD_TICKET_TTL_SECONDS = env.int('TRANSFER_UPLOAD_TICKET_TTL_SECONDS', default=600)
+TRANSFER_USER_QUOTA_MB = env.int('TRANSFER_USER_QUOTA_MB', default=0)
+
+# Entrega de ficheros (transfers): 'direct' (Django, desarrollo), 'x-accel' (nginx)
+# o 'x-sendfile' (Apache/lighttpd). Con x-accel, TRANSFER_X_ACCEL_PREFIX debe
+# apuntar a una location `internal` de nginx con alias a MEDIA_ROOT.
+TRANSFER_FILE_DELIVERY = env('TRANSFER_FILE_DELIVERY', default='direct')
+TRANSFER_X_ACCEL_PREFIX = env('TRANSFER_X_ACCEL_PREFIX', default='/protected-media/')
+
+# Descargas ZIP (transfers): las categorías listadas se guardan sin comprimir (STORED);
+# el resto se comprime con deflate en paralelo con TRANSFER_ZIP_WORKERS hilos (0 = auto)
+TRANSFER_ZIP_STORED_CATEGORIES = env.list('TRANSFER_ZIP_STORED_CATEGORIES', default=['images', 'audio', 'video', 'archives'])
+TRANSFER_ZIP_COMPRESSLEVEL = env.int('TRANSFER_ZIP_COMPRESSLEVEL', default=6)
+TRANSFER_ZIP_WORKERS = env.int('TRANSFER_ZIP_WORKERS', default=0)
+
+# Caché en disco de archivos ZIP/tar de carpetas compartidas por enlace público
+# (LRU limitado a este tamaño; 0 la desactiva)
+TRANSFER_ARCHIVE_CACHE_MAX_MB = env.int('TRANSFER_ARCHIVE_CACHE_MAX_MB', default=2048)
+
+# Almacén de contenido deduplicado (SHA-256): los blobs sin referencias se borran
+# con purge_orphan_blobs pasado este margen
+TRANSFER_BLOB_GC_GRACE_MINUTES = env.int('TRANSFER_BLOB_GC_GRACE_MINUTES', default=60)
+
+# Post-procesado de subidas (análisis de malware y miniaturas) con el worker
+# process_upload_jobs. INLINE=True lo ejecuta en la propia petición (desarrollo).
+# Descarga de archivos aún sin analizar: 'allow', 'owner' (solo propietario) o 'block'
+TRANSFER_PROCESS_UPLOADS_INLINE = env.bool('TRANSFER_PROCESS_UPLOADS_INLINE', default=False)
+TRANSFER_PROCESSING_MAX_ATTEMPTS = env.int('TRANSFER_PROCESSING_MAX_ATTEMPTS', default=5)
+# El worker renueva cada trabajo en curso; sin renovar durante este tiempo se da por muerto y se reencola
+TRANSFER_PROCESSING_LEASE_SECONDS = env.int('TRANSFER_PROCESSING_LEASE_SECONDS', default=300)
+TRANSFER_UNSCANNED_DOWNLOAD_POLICY = env('TRANSFER_UNSCANNED_DOWNLOAD_POLICY', default='owner')
+
+# Miniaturas (transfers): tamaños (lado mayor en px) y formatos de las versiones
+# generadas por contenido; los formatos que Pillow no soporte se omiten (JPEG siempre).
+# Imágenes cuya decodificación necesitaría más de MAX_DECODE_MB de RAM no tienen miniatura
+TRANSFER_THUMBNAIL_SIZES = env.list('TRANSFER_THUMBNAIL_SIZES', cast=int, default=[160, 400, 1600])
+TRANSFER_THUMBNAIL_FORMATS = env.list('TRANSFER_THUMBNAIL_FORMATS', default=['avif', 'webp', 'jpeg'])
+TRANSFER_THUMBNAIL_MAX_DECODE_MB = env.int('TRANSFER_THUMBNAIL_MAX_DECODE_MB', default=1024)
+# Generación bajo demanda (la hace el worker): minutos sin reintentar un archivo que falló
+TRANSFER_THUMBNAIL_FAILURE_TTL_MINUTES = env.int('TRANSFER_THUMBNAIL_FAILURE_TTL_MINUTES', default=60)
+# Máximo de archivos por petición a /api/transfers/thumbnails/ (galerías)
+TRANSFER_THUMBNAIL_BATCH_MAX = env.int('TRANSFER_THUMBNAIL_BATCH_MAX', default=100)
 
 # VirusTotal Configuration (optional)
 VIRUSTOTAL_API_KEY = env('VIRUSTOTAL_API_KEY', default=None)
@@ -346,6 +399,8 @@ else:
     ]
 
 CORS_ALLOW_CREDENTIALS = True
+# Cabecera del ticket de pre-admisión de subidas (transfers)
+CORS_ALLOW_HEADERS = list(default_headers) + ['x-upload-ticket']
 
 # =============================================================================
 # GOOGLE OAUTH 2.0 CONFIGURATION
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class TransfersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'transfers'
+
+    def ready(self):
+        try:
+            import transfers.signals
+        except ImportError:
+            pass
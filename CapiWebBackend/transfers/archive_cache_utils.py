@@ -0,0 +1,286 @@
+"""
+On-disk cache of built folder archives for public share links.
+
+An archive is stored under MEDIA_ROOT/archive_cache/<folder_id>/ with a name
+derived from the subtree state (file paths, names, sizes, mtimes and format),
+so any upload, delete, rename or move produces a new key. Signals also drop
+the cached archives of the folder and its ancestors when their content changes.
+
+Concurrent requests for the same key are coalesced with a flock per key: one
+request builds the archive in a background thread (so it completes even if
+that client disconnects) and every request streams the partial file while it
+grows. Later requests are plain file serves (Range, ETag, X-Accel-Redirect).
+The cache is bounded by TRANSFER_ARCHIVE_CACHE_MAX_MB, evicting the least
+recently served archives first. Partial files count against the budget too;
+the ones left by a dead builder and unused lock files are reaped by age.
+Lock files are only deleted while locked, and a lock is only considered
+taken once the locked file is still the one at its path.
+"""
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Iterable, Iterator
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .archive_utils import (
+    ARCHIVE_TYPES, ARCHIVE_ZIP, ZIP_COMPRESSLEVEL, ArchiveEntry, archive_body,
+    archive_response, archive_size, stat_entries, streaming_archive_response,
+)
+from .download_utils import serve_file
+
+logger = logging.getLogger('transfers')
+
+# Cache settings
+ARCHIVE_CACHE_MAX_BYTES = getattr(settings, 'TRANSFER_ARCHIVE_CACHE_MAX_MB', 2048) * 1024 * 1024
+ARCHIVE_CACHE_DIR = 'archive_cache'
+ARCHIVE_CACHE_POLL_SECONDS = 0.05  # Wait between reads of a growing archive
+TAIL_CHUNK_SIZE = 64 * 1024
+ARCHIVE_CACHE_STALE_SECONDS = 3600  # Age of an unlocked .part/.lock before it is reaped
+
+
+def _cache_root() -> str:
+    return default_storage.path(ARCHIVE_CACHE_DIR)
+
+
+def _folder_cache_dir(folder_id: int) -> str:
+    return os.path.join(_cache_root(), str(folder_id))
+
+
+def archive_cache_key(entries: list[ArchiveEntry], archive_format: str) -> str:
+    """Content-versioned key of an archive over sized entries."""
+    digest = hashlib.sha256(archive_format.encode())
+    if archive_format == ARCHIVE_ZIP:
+        digest.update(f'level={ZIP_COMPRESSLEVEL}'.encode())
+    for entry in entries:
+        digest.update(
+            f'{entry.path}\0{entry.arcname}\0{entry.size}\0{entry.mtime!r}\0'.encode('utf-8', 'surrogateescape')
+        )
+    return digest.hexdigest()
+
+
+def _try_lock(lock_path: str, mode: int):
+    """Take a non-blocking flock on `lock_path`; return the fd or None if busy."""
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        # The file was reaped between open and flock: lock the one now at the path
+        os.close(fd)
+
+
+def _builder_running(lock_path: str) -> bool:
+    fd = _try_lock(lock_path, fcntl.LOCK_SH)
+    if fd is None:
+        return True
+    os.close(fd)
+    return False
+
+
+def _build(entries: list[ArchiveEntry], archive_format: str, final_path: str, part_path: str, lock_fd: int):
+    """Write the archive to `part_path` and publish it atomically; runs in a thread."""
+    started = time.monotonic()
+    try:
+        body, _size = archive_body(entries, archive_format)
+        with open(part_path, 'wb') as part:
+            for data in body:
+                part.write(data)
+                # Make the bytes visible to the requests tailing the file
+                part.flush()
+        os.replace(part_path, final_path)
+        logger.info(f"Cached archive {final_path} ({os.path.getsize(final_path)} bytes) "
+                    f"in {time.monotonic() - started:.1f}s")
+    except Exception as e:
+        logger.error(f"Error building cached archive {final_path}: {e}")
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+    evict_archives()
+
+
+def _tail(part_path: str, final_path: str, lock_path: str) -> Iterator[bytes]:
+    """
+    Stream an archive while another thread or process is still writing it.
+    Once the builder is done the rest is read from the published file.
+    """
+    sent = 0
+    part = None
+    try:
+        while True:
+            if part is None:
+                try:
+                    part = open(part_path, 'rb')
+                except FileNotFoundError:
+                    pass
+            data = part.read(TAIL_CHUNK_SIZE) if part else b''
+            if data:
+                sent += len(data)
+                yield data
+                continue
+            if not _builder_running(lock_path):
+                break
+            time.sleep(ARCHIVE_CACHE_POLL_SECONDS)
+    finally:
+        if part:
+            part.close()
+
+    # Archives are deterministic, so the published file continues where the partial one stopped
+    try:
+        with open(final_path, 'rb') as final:
+            final.seek(sent)
+            while True:
+                data = final.read(TAIL_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+    except FileNotFoundError:
+        logger.error(f"Archive build failed, {final_path} truncated after {sent} bytes")
+
+
+def _serve_cached(request, final_path: str, filename: str, content_type: str):
+    """Serve a cached archive, refreshing its access time for the LRU."""
+    try:
+        # Only atime: mtime is part of the ETag used by If-Range
+        os.utime(final_path, (time.time(), os.stat(final_path).st_mtime))
+    except OSError:
+        pass
+    return serve_file(request, final_path, filename=filename, content_type=content_type)
+
+
+def cached_archive_response(request, folder_id: int, entries: Iterable[ArchiveEntry], basename: str,
+                            archive_format: str):
+    """
+    Serve a folder archive from the cache, building it once if needed.
+    Falls back to a direct stream when the cache is disabled or the folder
+    alone would not fit in it.
+    """
+    entries = stat_entries(entries)
+    if ARCHIVE_CACHE_MAX_BYTES <= 0 or sum(entry.size for entry in entries) > ARCHIVE_CACHE_MAX_BYTES:
+        return archive_response(request, entries, basename, archive_format)
+
+    extension, content_type = ARCHIVE_TYPES[archive_format]
+    filename = f'{basename}{extension}'
+    directory = _folder_cache_dir(folder_id)
+    key = archive_cache_key(entries, archive_format)
+    final_path = os.path.join(directory, key + extension)
+    part_path = os.path.join(directory, key + '.part')
+    lock_path = os.path.join(directory, key + '.lock')
+
+    if os.path.exists(final_path):
+        return _serve_cached(request, final_path, filename, content_type)
+
+    os.makedirs(directory, exist_ok=True)
+    lock_fd = _try_lock(lock_path, fcntl.LOCK_EX)
+    if lock_fd is not None:
+        if os.path.exists(final_path):
+            # Finished between the check and the lock
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+            return _serve_cached(request, final_path, filename, content_type)
+        threading.Thread(
+            target=_build,
+            args=(entries, archive_format, final_path, part_path, lock_fd),
+            name=f'archive-cache-{key[:8]}',
+            daemon=True,
+        ).start()
+
+    response = streaming_archive_response(_tail(part_path, final_path, lock_path), content_type, filename)
+    size = archive_size(entries, archive_format)
+    if size is not None:
+        response['Content-Length'] = str(size)
+    return response
+
+
+def _reap_if_unlocked(path: str, lock_path: str) -> bool:
+    """Delete `path` (a .part or .lock) unless a builder holds the lock of its key."""
+    lock_fd = _try_lock(lock_path, fcntl.LOCK_EX)
+    if lock_fd is None:
+        return False
+    try:
+        os.remove(path)
+        if path != lock_path:
+            os.remove(lock_path)
+    except OSError:
+        pass
+    finally:
+        os.close(lock_fd)
+    return True
+
+
+def evict_archives() -> int:
+    """
+    Delete least recently served archives until the cache fits its budget.
+    Partial files of running builds count against it; stale partial and lock
+    files (a builder that died, keys nobody requests) are removed first.
+    """
+    archives = []
+    total = 0
+    now = time.time()
+    for dirpath, _dirnames, filenames in os.walk(_cache_root()):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(('.part', '.lock')):
+                key_path = os.path.join(dirpath, name[:-len('.part')])
+                # A .lock next to a .part is reaped with it
+                reapable = name.endswith('.part') or not os.path.exists(key_path + '.part')
+                if reapable and now - stat.st_mtime > ARCHIVE_CACHE_STALE_SECONDS \
+                        and _reap_if_unlocked(path, key_path + '.lock'):
+                    continue
+                total += stat.st_size
+                continue
+            archives.append((stat.st_atime, stat.st_size, path))
+
+    total += sum(size for _atime, size, _path in archives)
+    removed = 0
+    for _atime, size, path in sorted(archives):
+        if total <= ARCHIVE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f"Evicted {removed} cached archives")
+    return removed
+
+
+def invalidate_folder_archives(folder_id: int) -> None:
+    """Drop the cached archives of a folder and of all its ancestors."""
+    from .tree_utils import with_ancestors
+
+    for folder_id in with_ancestors([folder_id]):
+        directory = _folder_cache_dir(folder_id)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                # Partial and lock files of the old keys are reaped by evict_archives once stale
+                if not name.endswith(('.part', '.lock')):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+
+
+def remove_folder_cache(folder_id: int) -> None:
+    """Remove the whole cache directory of a deleted folder."""
+    shutil.rmtree(_folder_cache_dir(folder_id), ignore_errors=True)
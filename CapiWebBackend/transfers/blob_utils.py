@@ -0,0 +1,150 @@
+"""
+Content-addressed blob store for file transfers.
+Every distinct content is stored once under MEDIA_ROOT/blobs/ keyed by its
+SHA-256; FileTransfer rows reference a Blob and their `file` points at the
+shared path. Reference counts are updated under a row lock, and blobs whose
+count dropped to zero are only removed after a grace period, so an upload
+claiming the same hash cannot race the deletion of its file.
+"""
+import os
+import shutil
+import hashlib
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Blob
+from .thumbnail_utils import rendition_dir
+
+logger = logging.getLogger('transfers')
+
+# Blob settings
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB reads while hashing
+BLOB_GC_GRACE_MINUTES = getattr(settings, 'TRANSFER_BLOB_GC_GRACE_MINUTES', 60)
+
+
+def hash_file(file_path: str) -> str:
+    """Return the hex SHA-256 of a file, read in HASH_CHUNK_SIZE blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(HASH_CHUNK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def store_blob(source_path: str, filename: str, sha256: str = None) -> Blob:
+    """
+    Take ownership of `source_path` and return the Blob holding its content,
+    with one more reference.
+
+    If the content is already stored the source file is deleted (no second
+    copy); otherwise it is renamed into the blob tree. `source_path` must be
+    on the same filesystem as MEDIA_ROOT.
+    """
+    sha256 = sha256 or hash_file(source_path)
+    size = os.path.getsize(source_path)
+    try:
+        return _claim_blob(source_path, filename, sha256, size)
+    except IntegrityError:
+        # A concurrent first upload of the same content won the insert. Ours
+        # failed before moving the source, which is now deduplicated into theirs
+        return _claim_blob(source_path, filename, sha256, size)
+
+
+def _claim_blob(source_path: str, filename: str, sha256: str, size: int) -> Blob:
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is not None and blob.file and os.path.exists(blob.file.path):
+            os.remove(source_path)
+            logger.info(f"Deduplicated {filename} into blob {sha256[:12]} ({size} bytes saved)")
+            blob.ref_count += 1
+            blob.orphaned_at = None
+            blob.save(update_fields=['ref_count', 'orphaned_at'])
+            return blob
+
+        if blob is None:
+            blob = Blob(sha256=sha256, size=size)
+        # The name carries this upload's extension: concurrent first uploads
+        # of the same content may differ, so only the one whose row is
+        # written moves its file, after the insert
+        blob.file.name = blob._meta.get_field('file').generate_filename(blob, filename)
+        blob.ref_count += 1
+        blob.orphaned_at = None
+        blob.save()
+        dest_path = default_storage.path(blob.file.name)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(source_path, dest_path)
+        return blob
+
+
+def attach_blob(instance, source_path: str, sha256: str = None) -> Blob:
+    """
+    Store `source_path` as a blob and point the FileTransfer at it.
+    The caller saves `instance` (fields 'blob' and 'file').
+    """
+    blob = store_blob(source_path, instance.filename, sha256)
+    instance.blob = blob
+    instance.file.name = blob.file.name
+    return blob
+
+
+def add_blob_reference(blob_id: int):
+    """Take one more reference on a stored blob; None if its content is gone."""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(id=blob_id).first()
+        if blob is None or not blob.file or not os.path.exists(blob.file.path):
+            return None
+        blob.ref_count += 1
+        blob.orphaned_at = None
+        blob.save(update_fields=['ref_count', 'orphaned_at'])
+        return blob
+
+
+def release_blob(blob_id: int) -> None:
+    """Drop one reference; a blob left without references becomes an orphan."""
+    with transaction.atomic():
+        Blob.objects.filter(id=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        Blob.objects.filter(id=blob_id, ref_count=0, orphaned_at__isnull=True).update(orphaned_at=timezone.now())
+
+
+def purge_orphan_blobs(grace_minutes: int = None, dry_run: bool = False) -> tuple[int, int]:
+    """
+    Delete blobs without references that have been orphaned for longer than
+    the grace period, together with their thumbnail renditions. Each blob is
+    re-checked under its row lock, and its file is removed before the row so
+    a concurrent claim never points at a deleted file.
+
+    Returns:
+        (number of blobs deleted, bytes freed)
+    """
+    grace_minutes = BLOB_GC_GRACE_MINUTES if grace_minutes is None else grace_minutes
+    cutoff = timezone.now() - timedelta(minutes=grace_minutes)
+    candidates = Blob.objects.filter(ref_count=0, orphaned_at__lt=cutoff).values_list('id', flat=True)
+
+    deleted = 0
+    freed = 0
+    for blob_id in list(candidates):
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(
+                id=blob_id, ref_count=0, orphaned_at__lt=cutoff
+            ).first()
+            if blob is None or blob.file_transfers.exists():
+                continue
+            deleted += 1
+            freed += blob.size
+            if dry_run:
+                continue
+            if blob.file:
+                try:
+                    os.remove(blob.file.path)
+                except FileNotFoundError:
+                    pass
+            shutil.rmtree(default_storage.path(rendition_dir(blob.sha256)), ignore_errors=True)
+            blob.delete()
+    return deleted, freed
@@ -0,0 +1,337 @@
+"""
+Download utilities for file transfers.
+Serves files with HTTP Range support (RFC 7233): single and multi-range
+requests, If-Range validation and 206/416 responses, plus conditional
+requests (RFC 7232: If-None-Match / If-Modified-Since -> 304).
+
+Delivery backends (settings.TRANSFER_FILE_DELIVERY):
+    - 'direct': Django streams the file (default, development)
+    - 'x-accel': nginx serves it via X-Accel-Redirect to an internal location
+    - 'x-sendfile': Apache/lighttpd serve it via X-Sendfile
+With an offload backend Django checks permissions and answers conditional
+requests (304) with the same validators; the front server streams the body
+with sendfile and handles Range itself.
+"""
+import os
+import json
+import hashlib
+import logging
+import mimetypes
+import secrets
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+logger = logging.getLogger('transfers')
+
+# Streaming settings
+RANGE_CHUNK_SIZE = 64 * 1024  # 64KB reads
+MAX_RANGES = 16  # More ranges than this are ignored and the full file is sent
+
+# Packed multi-file responses
+PACK_CONTENT_TYPE = 'application/x-capiweb-pack'
+
+# Delivery backend settings
+DELIVERY_DIRECT = 'direct'
+DELIVERY_X_ACCEL = 'x-accel'
+DELIVERY_X_SENDFILE = 'x-sendfile'
+FILE_DELIVERY_BACKEND = getattr(settings, 'TRANSFER_FILE_DELIVERY', DELIVERY_DIRECT)
+X_ACCEL_PREFIX = getattr(settings, 'TRANSFER_X_ACCEL_PREFIX', '/protected-media/')
+
+
+def content_disposition(filename: str, as_attachment: bool = True) -> str:
+    """Build a Content-Disposition header value (RFC 6266 / 5987)."""
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        file_expr = 'filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        file_expr = "filename*=utf-8''{}".format(quote(filename))
+    return f'{disposition}; {file_expr}'
+
+
+def file_validators(file_path: str) -> tuple[str, float]:
+    """
+    Return (etag, mtime) for a file on disk.
+    The ETag is derived from modification time and size, like nginx does.
+    """
+    stat = os.stat(file_path)
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', stat.st_mtime
+
+
+def parse_range_header(header: str, size: int):
+    """
+    Parse a `Range: bytes=...` header.
+
+    Returns:
+        None if the header is absent, malformed or not in bytes (serve full file),
+        [] if no range is satisfiable (416),
+        or a list of (start, end) inclusive tuples
+    """
+    if not header:
+        return None
+    unit, _, ranges_spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        start_str, _, end_str = spec.partition('-')
+        start_str, end_str = start_str.strip(), end_str.strip()
+        try:
+            if not start_str:
+                # Suffix range: last N bytes
+                if not end_str:
+                    return None
+                length = int(end_str)
+                if length < 0:
+                    return None
+                if length == 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start_str)
+                end = int(end_str) if end_str else size - 1
+                if start < 0 or (end_str and end < start):
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _if_range_matches(request, etag: str, mtime: float) -> bool:
+    """Evaluate If-Range: a strong ETag match or an exact Last-Modified date."""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    parsed = parse_http_date_safe(if_range)
+    return parsed is not None and parsed == int(mtime)
+
+
+def _iter_file_range(file_path: str, start: int, end: int):
+    """Yield bytes [start, end] of a file in RANGE_CHUNK_SIZE blocks."""
+    remaining = end - start + 1
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while remaining > 0:
+            data = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _iter_multipart_ranges(read_range, parts):
+    """Yield a multipart/byteranges body from precomputed (header, start, end) parts."""
+    for part_header, start, end in parts[:-1]:
+        yield part_header
+        yield from read_range(start, end)
+    yield parts[-1][0]
+
+
+def _offload_response(file_path: str, content_type: str, backend: str):
+    """
+    Build an empty response that tells the front web server to send the file.
+    Returns None for files outside MEDIA_ROOT, which are streamed directly.
+    """
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    real_path = os.path.realpath(file_path)
+    if not real_path.startswith(media_root + os.sep):
+        logger.warning(f"Cannot offload {file_path}: outside MEDIA_ROOT, streaming directly")
+        return None
+
+    response = HttpResponse(content_type=content_type)
+    if backend == DELIVERY_X_ACCEL:
+        relative_path = os.path.relpath(real_path, media_root).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    else:
+        response['X-Sendfile'] = real_path
+    return response
+
+
+def serve_file(request, file_path: str, *, filename: str = None, content_type: str = None,
+               as_attachment: bool = True, etag: str = None):
+    """
+    Serve a file from disk honouring Range / If-Range and conditional requests.
+    Permission checks must be done by the caller before calling this.
+
+    Args:
+        request: Current request (Range, If-Range headers)
+        file_path: Absolute path of the file
+        filename: Name for Content-Disposition (defaults to the basename)
+        content_type: MIME type (guessed from filename if omitted)
+        as_attachment: attachment vs inline disposition
+        etag: Strong ETag of the content (e.g. its hash); defaults to mtime-size
+
+    Returns:
+        200 FileResponse, 206 Partial Content, 304 Not Modified, 416 Range Not Satisfiable,
+        or an internal-redirect response when an offload backend is configured
+    """
+    filename = filename or os.path.basename(file_path)
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    default_etag, mtime = file_validators(file_path)
+    etag = etag or default_etag
+
+    if FILE_DELIVERY_BACKEND in (DELIVERY_X_ACCEL, DELIVERY_X_SENDFILE):
+        # Revalidations are answered here: the front server only knows its own validators
+        response = get_conditional_response(request, etag=etag, last_modified=int(mtime))
+        if response is None:
+            response = _offload_response(file_path, content_type, FILE_DELIVERY_BACKEND)
+            if response is not None:
+                response['Content-Disposition'] = content_disposition(filename, as_attachment)
+        if response is not None:
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(mtime)
+            return response
+
+    return ranged_response(
+        request,
+        size=os.path.getsize(file_path),
+        etag=etag,
+        mtime=mtime,
+        read_range=lambda start, end: _iter_file_range(file_path, start, end),
+        full_body=lambda: FileResponse(open(file_path, 'rb'), content_type=content_type),
+        content_type=content_type,
+        filename=filename,
+        as_attachment=as_attachment,
+    )
+
+
+def ranged_response(request, *, size: int, etag: str, mtime: float, read_range, content_type: str,
+                    filename: str, as_attachment: bool = True, full_body=None):
+    """
+    Build a 200/206/304/412/416 response for any byte source of known size.
+
+    Args:
+        request: Current request (Range, If-Range headers)
+        size: Total length of the representation
+        etag: Strong ETag of the representation
+        mtime: Last modification timestamp
+        read_range: Callable (start, end) yielding bytes [start, end]
+        content_type: MIME type of the representation
+        filename: Name for Content-Disposition
+        as_attachment: attachment vs inline disposition
+        full_body: Optional callable building the 200 response (streams read_range otherwise)
+    """
+    # Revalidation of a cached copy (304) or failed precondition (412)
+    response = get_conditional_response(request, etag=etag, last_modified=int(mtime))
+    if response is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        return response
+
+    ranges = None
+    if request.method in ('GET', 'HEAD') and _if_range_matches(request, etag, mtime):
+        ranges = parse_range_header(request.META.get('HTTP_RANGE', ''), size)
+
+    if ranges is None:
+        if full_body is not None:
+            response = full_body()
+        else:
+            response = StreamingHttpResponse(read_range(0, size - 1), content_type=content_type)
+            response['Content-Length'] = str(size)
+    elif not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(read_range(start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        boundary = secrets.token_hex(16)
+        parts = []
+        total = 0
+        for index, (start, end) in enumerate(ranges):
+            separator = '' if index == 0 else '\r\n'
+            part_header = (
+                f'{separator}--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+            ).encode('latin-1')
+            parts.append((part_header, start, end))
+            total += len(part_header) + (end - start + 1)
+        closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+        parts.append((closing, None, None))
+        total += len(closing)
+        response = StreamingHttpResponse(_iter_multipart_ranges(read_range, parts), status=206,
+                                         content_type=f'multipart/byteranges; boundary={boundary}')
+        response['Content-Length'] = str(total)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    if response.status_code != 416:
+        response['Content-Disposition'] = content_disposition(filename, as_attachment)
+    return response
+
+
+def pack_response(request, parts, extra: dict = None):
+    """
+    Serve several small files in one response, packed as a JSON index line
+    followed by the concatenated bytes:
+
+        {"files": [{"id", "offset", "length", "content_type", "etag"}, ...], ...extra}\n<bytes>
+
+    Offsets are relative to the first byte after the newline.
+
+    Args:
+        request: Current request (If-None-Match)
+        parts: (id, path, content_type, etag) of each file, in order
+        extra: Additional index entries (e.g. the ids that were left out)
+
+    Returns:
+        200 with the pack, or 304 when the pack (derived from the part
+        ETags, so nothing is read) is unchanged
+    """
+    extra = dict(extra or {})
+    digest = hashlib.sha256(json.dumps([(part[0], part[3]) for part in parts]).encode())
+    digest.update(json.dumps(extra, sort_keys=True).encode())
+    etag = f'"{digest.hexdigest()[:32]}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+        return response
+
+    files = []
+    chunks = []
+    offset = 0
+    complete = True
+    for part_id, path, content_type, part_etag in parts:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            # Removed since it was listed (regenerated or purged): the client asks again
+            extra.setdefault('missing', {})[str(part_id)] = 'missing'
+            complete = False
+            continue
+        files.append({
+            'id': part_id, 'offset': offset, 'length': len(data),
+            'content_type': content_type, 'etag': part_etag
+        })
+        chunks.append(data)
+        offset += len(data)
+
+    index = json.dumps({'files': files, **extra}, separators=(',', ':')).encode() + b'\n'
+    response = HttpResponse(b''.join([index, *chunks]), content_type=PACK_CONTENT_TYPE)
+    if complete:
+        response['ETag'] = etag
+    return response
@@ -0,0 +1,120 @@
+"""
+Validators for conditional GET (RFC 7232) on transfers endpoints.
+
+- File bytes (downloads, renditions) get strong ETags derived from the
+  content SHA-256 of their blob, so identical content revalidates with 304
+  wherever it is stored.
+- Listings get weak ETags from a per-user change counter (ChangeCounter).
+  Every write that can change what a user lists bumps the counter of that
+  user (owner, uploader and everyone granted access to the file, its folder
+  or an ancestor folder), so a revalidation is answered with a few indexed
+  reads, before the listing is queried or serialized.
+- Grants that lapse change listings without any write, so the ETag also
+  carries the next expiry among the user's grants: once it has passed, the
+  ETag no longer matches.
+
+Counters are stored in the database, not in the cache: the default cache is
+per-process and would give every worker its own versions.
+"""
+import hashlib
+from django.db.models import F, Min
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from .models import ChangeCounter, FileAccess, FileTransfer, Folder, FolderAccess
+from .tree_utils import with_ancestors
+
+# Listings may be stored by the browser but must be revalidated on every use
+LISTING_CACHE_CONTROL = 'private, no-cache'
+
+
+def content_etag(instance):
+    """Strong ETag of a blob-backed file's bytes, or None for files without blob."""
+    return f'"{instance.blob.sha256}"' if instance.blob_id else None
+
+
+def rendition_etag(sha256: str, name: str, mtime_ns: int) -> str:
+    """Strong ETag of a stored rendition: source content, rendition and its version on disk."""
+    return f'"{sha256}-{name}-{mtime_ns:x}"'
+
+
+def bump_change_counters(user_ids) -> None:
+    """
+    Invalidate the listings of `user_ids`.
+    Users without a counter have never received a listing ETag, so there is
+    nothing to invalidate: their counter is created on their next listing.
+    """
+    user_ids = {user_id for user_id in user_ids if user_id}
+    if user_ids:
+        ChangeCounter.objects.filter(user_id__in=user_ids).update(version=F('version') + 1)
+
+
+def folder_audience(folder_ids) -> set:
+    """Users who can list the given folders: owners, uploaders and grantees of them or any ancestor."""
+    folder_ids = with_ancestors(folder_ids)
+    if not folder_ids:
+        return set()
+    users = set()
+    for owner_id, uploader_id in Folder.objects.filter(id__in=folder_ids).values_list('owner_id', 'uploader_id'):
+        users.update((owner_id, uploader_id))
+    users.update(FolderAccess.objects.filter(folder_id__in=folder_ids).values_list('granted_to_id', flat=True))
+    users.discard(None)
+    return users
+
+
+def file_audience(file_ids) -> set:
+    """Users who can list the given files, directly or through their folder."""
+    users = set()
+    folder_ids = set()
+    rows = FileTransfer.objects.filter(id__in=file_ids).values_list('owner_id', 'uploader_id', 'folder_id')
+    for owner_id, uploader_id, folder_id in rows:
+        users.update((owner_id, uploader_id))
+        folder_ids.add(folder_id)
+    users.update(FileAccess.objects.filter(file_id__in=file_ids).values_list('granted_to_id', flat=True))
+    return users | folder_audience(folder_ids)
+
+
+def touch_files(file_ids) -> None:
+    """Bump the listings of a set of files; for bulk .update() calls, which skip signals."""
+    file_ids = list(file_ids)
+    if file_ids:
+        bump_change_counters(file_audience(file_ids))
+
+
+def next_grant_expiry(user):
+    """Earliest expiry still ahead among the grants given to `user`, or None."""
+    now = timezone.now()
+    expiries = [
+        model.objects.filter(granted_to=user, expires_at__gt=now).aggregate(next=Min('expires_at'))['next']
+        for model in (FileAccess, FolderAccess)
+    ]
+    expiries = [expiry for expiry in expiries if expiry]
+    return min(expiries) if expiries else None
+
+
+def listing_etag(request) -> str:
+    """
+    Weak ETag of a listing: the user's change counter, the next expiry of
+    their grants and the representation asked for.
+    """
+    counter, _ = ChangeCounter.objects.get_or_create(user=request.user)
+    expiry = next_grant_expiry(request.user)
+    variant = '\0'.join((request.build_absolute_uri(), request.META.get('HTTP_ACCEPT', '')))
+    digest = hashlib.sha256(variant.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    expires = f'{int(expiry.timestamp() * 1000):x}' if expiry else '0'
+    return f'W/"{counter.user_id}-{counter.version}-{expires}-{digest}"'
+
+
+def conditional_listing(request, build_response):
+    """
+    Answer a listing with 304 when If-None-Match still matches, without
+    calling `build_response` (no query, no serialization); otherwise build it
+    and tag it with its ETag.
+    """
+    etag = listing_etag(request)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = build_response()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        response['Cache-Control'] = LISTING_CACHE_CONTROL
+    return response
@@ -0,0 +1,45 @@
+"""
+Set-based writes of folder grants.
+
+Folder grants are inherited at read time (access_utils): sharing or revoking
+a folder writes one row whatever the size of its tree, so nothing has to
+propagate grants to the contents any more. What is still copied is what a
+new subfolder takes from its parent: the grants without propagate, which
+cover the subfolders created after them but not the ones that existed.
+They are written with one bulk upsert on (folder, granted_to), keeping the
+grantor's permission, expiry and propagate, instead of one
+update_or_create per grant.
+
+bulk_create sends no post_save, so listings are invalidated here once.
+"""
+from .etag_utils import bump_change_counters
+from .models import FolderAccess
+
+GRANT_FIELDS = ['granted_by', 'permission', 'propagate', 'expires_at']
+
+
+def inherit_grants(parent_folder, folder) -> int:
+    """Copy the grants without propagate of `parent_folder` onto its new subfolder `folder`. Returns the rows written."""
+    copies = [
+        FolderAccess(
+            folder=folder,
+            granted_to_id=granted_to_id,
+            granted_by_id=granted_by_id,
+            permission=permission,
+            propagate=propagate,
+            expires_at=expires_at,
+        )
+        for granted_to_id, granted_by_id, permission, propagate, expires_at in FolderAccess.objects.filter(
+            folder=parent_folder, propagate=False
+        ).values_list('granted_to_id', 'granted_by_id', 'permission', 'propagate', 'expires_at')
+    ]
+    if not copies:
+        return 0
+    FolderAccess.objects.bulk_create(
+        copies,
+        update_conflicts=True,
+        unique_fields=['folder', 'granted_to'],
+        update_fields=GRANT_FIELDS,
+    )
+    bump_change_counters({copy.granted_to_id for copy in copies})
+    return len(copies)
@@ -0,0 +1,180 @@
+"""
+Management command to benchmark the query that lists the files a user can see.
+Fills the database with users, folders, files and grants (1M files and 100k
+grants by default), then for a sample of users compares the previous OR over
+the grant joins + DISTINCT with the UNION of indexed branches
+(access_utils.accessible_files): first page and count, as the listing runs
+them. Prints the EXPLAIN of both queries; with --check it fails when the
+results differ or the UNION plan scans a whole table instead of using the
+indexes (owner, uploader, folder, path and the grantee indexes on
+granted_to). Folders are built flat, where a folder grant covers the same
+files with or without propagate, so both queries must agree.
+Everything is rolled back at the end.
+Run with: python manage.py benchmark_access_queries [--files 1000000] [--grants 100000] [--check]
+"""
+import random
+import statistics
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from transfers.access_utils import accessible_files
+from transfers.models import FileAccess, FileTransfer, Folder, FolderAccess
+
+BATCH_SIZE = 10000
+# Plan lines of a full table scan: PostgreSQL / SQLite
+FULL_SCAN_MARKERS = ('Seq Scan', ' SCAN ')
+# SQLite scans an index instead of the table for the path prefix: its LIKE is
+# case-insensitive and cannot seek (PostgreSQL seeks on the varchar_pattern_ops index)
+INDEX_SCAN_MARKERS = ('USING INDEX', 'USING COVERING INDEX')
+
+
+def _scans_table(line: str) -> bool:
+    return any(marker in line for marker in FULL_SCAN_MARKERS) and not any(
+        marker in line for marker in INDEX_SCAN_MARKERS
+    )
+
+
+def _legacy_files(user):
+    """FileTransferViewSet.get_queryset before the UNION: one row per grant, de-duplicated."""
+    return FileTransfer.objects.filter(
+        Q(owner=user)
+        | Q(uploader=user)
+        | Q(access_list__granted_to=user)
+        | Q(folder__access_list__granted_to=user)
+    ).distinct()
+
+
+STRATEGIES = [
+    ('OR + DISTINCT', _legacy_files),
+    ('UNION', accessible_files),
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the accessible-files query (OR + DISTINCT vs UNION) with EXPLAIN'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--folders', type=int, default=10000)
+        parser.add_argument('--files', type=int, default=1000000)
+        parser.add_argument('--grants', type=int, default=100000, help='File grants')
+        parser.add_argument('--folder-grants', type=int, default=10000)
+        parser.add_argument('--samples', type=int, default=20, help='Users measured')
+        parser.add_argument('--page', type=int, default=50, help='Page size of the listing')
+        parser.add_argument('--analyze', action='store_true', help='EXPLAIN ANALYZE (PostgreSQL)')
+        parser.add_argument('--check', action='store_true', help='Fail if results differ or indexes are unused')
+
+    def _random_pairs(self, rng, count, left, right):
+        """`count` distinct (left, right) pairs; grants are unique per object and user."""
+        pairs = set()
+        count = min(count, len(left) * len(right))
+        while len(pairs) < count:
+            pairs.add((rng.choice(left), rng.choice(right)))
+        return pairs
+
+    def _build(self, options, rng):
+        stamp = int(time.time())
+        User.objects.bulk_create([
+            User(username=f'access_bench_{stamp}_{index}') for index in range(options['users'])
+        ], batch_size=BATCH_SIZE)
+        users = list(User.objects.filter(username__startswith=f'access_bench_{stamp}_').order_by('id'))
+        user_ids = [user.id for user in users]
+
+        Folder.objects.bulk_create([
+            Folder(name=f'f{index}', owner_id=user_ids[index % len(user_ids)], uploader_id=user_ids[index % len(user_ids)])
+            for index in range(options['folders'])
+        ], batch_size=BATCH_SIZE)
+        folders = list(Folder.objects.filter(owner_id__in=user_ids).only('id'))
+        for folder in folders:
+            folder.path = f'/{folder.id}/'
+        Folder.objects.bulk_update(folders, ['path'], batch_size=BATCH_SIZE)
+        folder_ids = [folder.id for folder in folders]
+
+        for start in range(0, options['files'], BATCH_SIZE):
+            batch = []
+            for index in range(start, min(start + BATCH_SIZE, options['files'])):
+                owner_id = rng.choice(user_ids)
+                # Some files are sent by someone else, half live in a folder
+                uploader_id = rng.choice(user_ids) if index % 10 == 0 else owner_id
+                folder_id = rng.choice(folder_ids) if folder_ids and index % 2 else None
+                batch.append(FileTransfer(owner_id=owner_id, uploader_id=uploader_id, folder_id=folder_id,
+                                          file=f'bench/{index}.bin', filename=f'{index}.bin', size=1))
+            FileTransfer.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+        file_ids = list(FileTransfer.objects.filter(owner_id__in=user_ids).values_list('id', flat=True))
+
+        grants = self._random_pairs(rng, options['grants'], file_ids, user_ids)
+        FileAccess.objects.bulk_create([
+            FileAccess(file_id=file_id, granted_to_id=user_id) for file_id, user_id in grants
+        ], batch_size=BATCH_SIZE)
+        folder_grants = self._random_pairs(rng, options['folder_grants'], folder_ids, user_ids) if folder_ids else set()
+        FolderAccess.objects.bulk_create([
+            FolderAccess(folder_id=folder_id, granted_to_id=user_id) for folder_id, user_id in folder_grants
+        ], batch_size=BATCH_SIZE)
+
+        # Fresh tables: give the planner statistics before asking for plans
+        with connection.cursor() as cursor:
+            for model in (User, Folder, FileTransfer, FileAccess, FolderAccess):
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+        return users
+
+    def _listing(self, queryset, page):
+        """What a listing page costs: the count of the paginator and the first page."""
+        queryset = queryset.order_by('-created_at')
+        count = queryset.count()
+        ids = list(queryset.values_list('id', flat=True)[:page])
+        return count, ids
+
+    def _explain(self, queryset, analyze):
+        queryset = queryset.order_by('-created_at')
+        if analyze and connection.vendor == 'postgresql':
+            return queryset.explain(analyze=True, buffers=True)
+        return queryset.explain()
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        errors = []
+        with transaction.atomic():
+            started = time.perf_counter()
+            users = self._build(options, rng)
+            self.stdout.write(f"Built {options['files']} files, {options['grants']} file grants and "
+                              f"{options['folder_grants']} folder grants in {time.perf_counter() - started:.1f}s "
+                              f"({connection.vendor})")
+
+            sample = rng.sample(users, min(options['samples'], len(users)))
+            timings = {name: [] for name, _ in STRATEGIES}
+            for user in sample:
+                results = {}
+                for name, strategy in STRATEGIES:
+                    started = time.perf_counter()
+                    results[name] = self._listing(strategy(user), options['page'])
+                    timings[name].append(time.perf_counter() - started)
+                legacy_ids = set(_legacy_files(user).values_list('id', flat=True))
+                union_ids = set(accessible_files(user).values_list('id', flat=True))
+                if legacy_ids != union_ids or results['OR + DISTINCT'][0] != results['UNION'][0]:
+                    errors.append(f'results differ for user {user.id}')
+
+            self.stdout.write('')
+            self.stdout.write(f"Listing (count + first {options['page']}) for {len(sample)} users")
+            for name, values in timings.items():
+                self.stdout.write(f'  {name:<14} median {statistics.median(values) * 1000:8.1f} ms'
+                                  f'   max {max(values) * 1000:8.1f} ms')
+
+            plans = {}
+            for name, strategy in STRATEGIES:
+                plans[name] = self._explain(strategy(sample[0]), options['analyze'])
+                self.stdout.write('')
+                self.stdout.write(f'EXPLAIN {name}')
+                self.stdout.write(plans[name])
+            errors.extend(
+                f'UNION plan scans a whole table: {line.strip()}'
+                for line in plans['UNION'].splitlines() if _scans_table(line)
+            )
+
+            transaction.set_rollback(True)
+
+        if errors and options['check']:
+            raise CommandError('; '.join(errors))
+        for error in errors:
+            self.stderr.write(error)
@@ -0,0 +1,123 @@
+"""
+Management command to benchmark subtree operations on the Folder tree.
+Builds a wide tree (one folder with many subfolders) and a deep one (a long
+chain of nested folders), each with files, and compares the previous
+recursive walks (one query per folder) with the materialized-path queries,
+reporting time and number of queries. Everything is rolled back at the end.
+Run with: python manage.py benchmark_folder_tree [--wide 2000] [--deep 200] [--files 1]
+"""
+import os
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from transfers.archive_utils import ArchiveEntry
+from transfers.models import FileTransfer, Folder
+from transfers.tree_utils import collect_archive_entries, subtree_files
+
+
+def _legacy_descendants(folder):
+    """mark_contents_viewed before the path index: one query per folder."""
+    result = []
+    for child in folder.subfolders.all():
+        result.append(child)
+        result.extend(_legacy_descendants(child))
+    return result
+
+
+def _legacy_files(folder):
+    return list(FileTransfer.objects.filter(folder__in=[folder] + _legacy_descendants(folder)).values_list('id'))
+
+
+def _legacy_entries(folder, base_path='', entries=None):
+    """Archive collection before the path index: two queries per folder."""
+    entries = [] if entries is None else entries
+    folder_path = os.path.join(base_path, folder.name) if base_path else folder.name
+    for file_transfer in FileTransfer.objects.filter(folder=folder):
+        if file_transfer.file:
+            entries.append(ArchiveEntry(file_transfer.file.path, os.path.join(folder_path, file_transfer.filename)))
+    for subfolder in Folder.objects.filter(parent=folder):
+        _legacy_entries(subfolder, folder_path, entries)
+    return entries
+
+
+def _indexed_files(folder):
+    return list(subtree_files(folder).values_list('id'))
+
+
+class _QueryCounter:
+    """execute_wrapper counting the queries of a block (connection.queries is capped)."""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+STRATEGIES = [
+    ('files under (recursive)', _legacy_files),
+    ('files under (path)', _indexed_files),
+    ('archive entries (recursive)', _legacy_entries),
+    ('archive entries (path)', collect_archive_entries),
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark subtree queries (recursive walk vs materialized path) on wide and deep folder trees'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wide', type=int, default=2000, help='Subfolders of the wide tree')
+        parser.add_argument('--deep', type=int, default=200, help='Levels of the deep tree')
+        parser.add_argument('--files', type=int, default=1, help='Files per folder')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per strategy (best is reported)')
+
+    def _add_level(self, owner, parents, per_parent, files):
+        """Create `per_parent` subfolders under every parent (bulk) and give them paths and files."""
+        created = Folder.objects.bulk_create([
+            Folder(name=f'f{index}', owner=owner, uploader=owner, parent=parent)
+            for parent in parents for index in range(per_parent)
+        ])
+        parent_paths = {parent.id: parent.path for parent in parents}
+        for folder in created:
+            folder.path = f'{parent_paths[folder.parent_id]}{folder.id}/'
+        Folder.objects.bulk_update(created, ['path'], batch_size=1000)
+        FileTransfer.objects.bulk_create([
+            FileTransfer(owner=owner, uploader=owner, folder=folder, file=f'bench/{folder.id}-{index}.bin',
+                         filename=f'{index}.bin', size=1)
+            for folder in created for index in range(files)
+        ], batch_size=1000)
+        return created
+
+    def _run(self, label, root, repeat):
+        self.stdout.write('')
+        self.stdout.write(label)
+        for name, strategy in STRATEGIES:
+            best = None
+            for _ in range(max(repeat, 1)):
+                queries = _QueryCounter()
+                with connection.execute_wrapper(queries):
+                    started = time.perf_counter()
+                    strategy(root)
+                    elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            self.stdout.write(f'  {name:<28} {best * 1000:8.1f} ms  {queries.count:6d} queries')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            owner = User.objects.create(username=f'tree_bench_{int(time.time())}')
+
+            started = time.perf_counter()
+            wide_root = Folder.objects.create(name='wide', owner=owner, uploader=owner)
+            self._add_level(owner, [wide_root], options['wide'], options['files'])
+            deep_root = Folder.objects.create(name='deep', owner=owner, uploader=owner)
+            level = [deep_root]
+            for _ in range(options['deep']):
+                level = self._add_level(owner, level, 1, options['files'])
+            self.stdout.write(f'Trees built in {time.perf_counter() - started:.1f}s '
+                              f'(deepest path: {len(level[0].path)} chars)')
+
+            self._run(f"Wide tree: {options['wide']} subfolders", wide_root, options['repeat'])
+            self._run(f"Deep tree: {options['deep']} levels", deep_root, options['repeat'])
+
+            transaction.set_rollback(True)
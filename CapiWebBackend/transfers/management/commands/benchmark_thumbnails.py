@@ -0,0 +1,151 @@
+"""
+Management command to benchmark thumbnail decoding.
+Compares the previous strategy (full-resolution decode, then resize) with the
+reduced decoder (JPEG draft + reduce) over large JPEG/PNG/WebP/GIF inputs,
+reporting latency and peak RSS growth per format. Every sample runs in a
+fresh process so it does not reuse memory freed by earlier samples.
+Run with: python manage.py benchmark_thumbnails [--megapixels 50] [--dir /path/to/images]
+"""
+import os
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from io import BytesIO
+from PIL import Image, ImageOps
+from django.core.management.base import BaseCommand
+from transfers.thumbnail_utils import (
+    IMAGE_EXTENSIONS,
+    RENDITION_SIZES,
+    THUMBNAIL_MAX_SIZE,
+    THUMBNAIL_QUALITY,
+    generate_thumbnail,
+    load_preview_image,
+)
+
+# Synthetic corpus: extension -> Pillow save options
+CORPUS_FORMATS = {
+    '.jpg': {'format': 'JPEG', 'quality': 90},
+    '.png': {'format': 'PNG', 'compress_level': 1},
+    '.webp': {'format': 'WEBP', 'quality': 80, 'method': 0},
+    '.gif': {'format': 'GIF'},
+}
+
+
+def _legacy_thumbnail(path):
+    """The thumbnailer before reduced decoding: full decode, convert, then resize."""
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail(THUMBNAIL_MAX_SIZE, Image.Resampling.LANCZOS)
+        img.save(BytesIO(), format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+
+
+def _lightbox_source(path):
+    load_preview_image(path, path, max(RENDITION_SIZES))
+
+
+STRATEGIES = [
+    ('legacy thumbnail', _legacy_thumbnail),
+    ('reduced thumbnail', generate_thumbnail),
+    ('reduced 1600px source', _lightbox_source),
+]
+
+
+def _memory_kb(field):
+    """Read a Vm* field (KB) of /proc/self/status."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def _sample(task):
+    """Run one strategy on one file; runs in a fresh process. Returns (seconds, peak RSS MB)."""
+    index, path = task
+    try:
+        # Reset the high-water mark to the current RSS (Linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        baseline = _memory_kb('VmRSS')
+    except OSError:
+        baseline = None
+    started = time.perf_counter()
+    STRATEGIES[index][1](path)
+    elapsed = time.perf_counter() - started
+    if baseline is None:
+        # ru_maxrss (KB on Linux) is only a bound here: it includes the start-up peak
+        return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return elapsed, (_memory_kb('VmHWM') - baseline) / 1024
+
+
+class Command(BaseCommand):
+    help = 'Benchmark thumbnail decoding latency and peak memory per image format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', type=int, default=50, help='Size of the synthetic images')
+        parser.add_argument('--dir', help='Use the images of an existing directory instead')
+        parser.add_argument('--repeat', type=int, default=1, help='Runs per file and strategy (best is reported)')
+
+    def _build_corpus(self, root, megapixels):
+        width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+        height = megapixels * 1_000_000 // width
+        # Photo-like content: gradients plus sensor noise
+        noise = Image.effect_noise((width, height), 24)
+        red = Image.linear_gradient('L').resize((width, height))
+        blue = Image.radial_gradient('L').resize((width, height))
+        img = Image.merge('RGB', (red, Image.blend(noise, red, 0.5), blue))
+        for ext, options in CORPUS_FORMATS.items():
+            started = time.perf_counter()
+            img.save(os.path.join(root, f'photo_{megapixels}mp{ext}'), **options)
+            self.stdout.write(f'  {ext:<6} written in {time.perf_counter() - started:.1f}s')
+
+    def _files(self, root):
+        files = []
+        for name in sorted(os.listdir(root)):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                files.append(os.path.join(root, name))
+        return files
+
+    def handle(self, *args, **options):
+        temp_root = None
+        root = options.get('dir')
+        if not root:
+            temp_root = tempfile.mkdtemp(prefix='thumb_bench_')
+            root = temp_root
+            self.stdout.write(f"Building {options['megapixels']} MP corpus in {root}...")
+            self._build_corpus(root, options['megapixels'])
+
+        # spawn: each sample starts from a clean interpreter, not a copy of this one
+        context = multiprocessing.get_context('spawn')
+        try:
+            files = self._files(root)
+            self.stdout.write(f'{len(files)} files')
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                for path in files:
+                    with Image.open(path) as img:
+                        dimensions = f'{img.width}x{img.height} {img.mode}'
+                    self.stdout.write('')
+                    self.stdout.write(
+                        f'{os.path.basename(path)} ({dimensions}, {os.path.getsize(path) / (1024 * 1024):.1f} MB)'
+                    )
+                    for index, (label, _run) in enumerate(STRATEGIES):
+                        best = None
+                        peak = 0
+                        for _ in range(max(options['repeat'], 1)):
+                            elapsed, rss = pool.apply(_sample, ((index, path),))
+                            best = elapsed if best is None else min(best, elapsed)
+                            peak = max(peak, rss)
+                        self.stdout.write(f'  {label:<24} {best * 1000:8.0f} ms  peak RSS +{peak:7.1f} MB')
+        finally:
+            if temp_root:
+                shutil.rmtree(temp_root, ignore_errors=True)
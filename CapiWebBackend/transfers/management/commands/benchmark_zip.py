@@ -0,0 +1,127 @@
+"""
+Management command to benchmark ZIP download throughput.
+Compares the previous strategy (zipfile, ZIP_DEFLATED for every entry) with
+the streaming engine (per-extension STORED/DEFLATED policy, parallel deflate).
+Run with: python manage.py benchmark_zip [--size-mb 200] [--dir /path/to/folder]
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+from django.core.management.base import BaseCommand
+from transfers.archive_utils import ArchiveEntry, ZIP_WORKERS, stream_zip
+
+
+class _NullSink:
+    """Discard output while counting bytes (zipfile writes to it unseekable)."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+# Share of the synthetic corpus per extension (photo/video heavy folder)
+MIXED_CORPUS = [
+    ('.jpg', 0.40, 4),
+    ('.mp4', 0.30, 40),
+    ('.txt', 0.15, 2),
+    ('.pdf', 0.10, 3),
+    ('.zip', 0.05, 10),
+]
+WORDS = [b'lorem', b'ipsum', b'dolor', b'sit', b'amet', b'capiweb', b'transfer', b'folder', b'\n']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ZIP streaming throughput (MB/s) before and after the compression policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=200, help='Size of the synthetic mixed folder')
+        parser.add_argument('--dir', help='Use the files of an existing directory instead')
+        parser.add_argument('--repeat', type=int, default=1, help='Runs per strategy (best is reported)')
+
+    def _build_corpus(self, root, size_mb):
+        rng = random.Random(42)
+        for ext, share, file_mb in MIXED_CORPUS:
+            budget = int(size_mb * share * 1024 * 1024)
+            index = 0
+            while budget > 0:
+                length = min(budget, file_mb * 1024 * 1024)
+                path = os.path.join(root, f'file_{index}{ext}')
+                with open(path, 'wb') as f:
+                    if ext in ('.txt', '.pdf'):
+                        # Compressible text-like content
+                        chunk = b' '.join(rng.choice(WORDS) for _ in range(200000))
+                        while f.tell() < length:
+                            f.write(chunk[:length - f.tell()])
+                    else:
+                        # Already compressed media: random bytes
+                        f.write(os.urandom(length))
+                budget -= length
+                index += 1
+
+    def _entries(self, root):
+        entries = []
+        for dirpath, _dirnames, filenames in os.walk(root):
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                entries.append(ArchiveEntry(path, os.path.relpath(path, root)))
+        return entries
+
+    def _run_legacy(self, entries):
+        sink = _NullSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for entry in entries:
+                zf.write(entry.path, entry.arcname)
+        return sink.size
+
+    def _run_stream(self, entries, parallel):
+        return sum(len(chunk) for chunk in stream_zip(entries, parallel=parallel))
+
+    def handle(self, *args, **options):
+        temp_root = None
+        root = options.get('dir')
+        if not root:
+            temp_root = tempfile.mkdtemp(prefix='zip_bench_')
+            root = temp_root
+            self.stdout.write(f"Building {options['size_mb']} MB mixed corpus in {root}...")
+            self._build_corpus(root, options['size_mb'])
+
+        try:
+            entries = self._entries(root)
+            input_bytes = sum(os.path.getsize(entry.path) for entry in entries)
+            input_mb = input_bytes / (1024 * 1024)
+            self.stdout.write(f'{len(entries)} files, {input_mb:.1f} MB, {ZIP_WORKERS} deflate workers')
+            self.stdout.write('')
+
+            strategies = [
+                ('legacy (zipfile, deflate all)', self._run_legacy),
+                ('stream (policy, 1 thread)', lambda e: self._run_stream(e, parallel=False)),
+                ('stream (policy, parallel)', lambda e: self._run_stream(e, parallel=True)),
+            ]
+            baseline = None
+            for label, run in strategies:
+                best = None
+                output_bytes = 0
+                for _ in range(max(options['repeat'], 1)):
+                    started = time.perf_counter()
+                    output_bytes = run(entries)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                throughput = input_mb / best if best else 0
+                baseline = baseline or throughput
+                self.stdout.write(
+                    f'  {label:<32} {throughput:8.1f} MB/s  '
+                    f'({best:.2f}s, output {output_bytes / (1024 * 1024):.1f} MB, '
+                    f'x{throughput / baseline:.2f})'
+                )
+        finally:
+            if temp_root:
+                shutil.rmtree(temp_root, ignore_errors=True)
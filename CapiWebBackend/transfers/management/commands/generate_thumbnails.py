@@ -1,14 +1,72 @@
 """
-Management command to generate thumbnails for existing images.
-Run with: python manage.py generate_thumbnails
+Management command to generate thumbnails for existing images and videos.
+Files are rendered by a process pool and written back in batched updates.
+Blob-backed files get the full rendition set (sizes x formats), rendered once
+per content; older files without a blob get the single JPEG thumbnail.
+Progress is checkpointed after every batch, so a killed run resumes where it
+stopped (use --restart to start over).
+Run with: python manage.py generate_thumbnails [--workers 8] [--force]
 """
+import os
+import json
+import time
+import multiprocessing
+from collections import Counter
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
-from transfers.models import FileTransfer
-from transfers.thumbnail_utils import is_image_file, generate_thumbnail, get_thumbnail_filename
+from django.db import connections
+from django.db.models import Q
+from transfers.etag_utils import touch_files
+from transfers.models import Blob, FileTransfer
+from transfers.processing_utils import READY_STATUSES
+from transfers.thumbnail_utils import (
+    IMAGE_EXTENSIONS,
+    ImageTooLarge,
+    RENDITIONS_DIR,
+    VIDEO_EXTENSIONS,
+    generate_thumbnail,
+    generate_video_thumbnail,
+    get_thumbnail_filename,
+    is_image_file,
+    pick_rendition,
+    render_rendition_files,
+    rendition_name,
+)
+
+CHECKPOINT_NAME = 'thumbnail_backfill.json'
+
+
+def _render(task):
+    """
+    Generate and store one thumbnail; runs in a pool process.
+    Returns (id, renditions dict or stored thumbnail name or None, error or None);
+    images over the decode memory budget are reported as 'too_large'.
+    """
+    file_id, path, filename, sha256 = task
+    if not path or not os.path.exists(path):
+        return file_id, None, 'missing'
+    try:
+        if sha256:
+            renditions = render_rendition_files(path, filename, sha256)
+            return file_id, renditions, None if renditions else 'failed'
+        if is_image_file(filename):
+            content = generate_thumbnail(path)
+        else:
+            content = generate_video_thumbnail(path)
+        if not content:
+            return file_id, None, 'failed'
+        field = FileTransfer._meta.get_field('thumbnail')
+        name = default_storage.save(field.generate_filename(None, get_thumbnail_filename(filename)), content)
+        return file_id, name, None
+    except ImageTooLarge:
+        return file_id, None, 'too_large'
+    except Exception as e:
+        return file_id, None, type(e).__name__
 
 
 class Command(BaseCommand):
-    help = 'Generate thumbnails for existing image files that do not have one'
+    help = 'Generate thumbnails for existing image and video files in parallel (resumable)'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -21,77 +79,158 @@ class Command(BaseCommand):
             type=int,
             help='Limit the number of files to process',
         )
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Pool processes (default: CPU cores)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files per DB update and checkpoint')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of a previous run')
 
-    def handle(self, *args, **options):
-        force = options.get('force', False)
-        limit = options.get('limit')
-        
-        # Get all files that are images
-        queryset = FileTransfer.objects.all()
-        
+    def _checkpoint_path(self):
+        return os.path.join(settings.MEDIA_ROOT, CHECKPOINT_NAME)
+
+    def _load_checkpoint(self, force):
+        try:
+            with open(self._checkpoint_path()) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        # A checkpoint of a run with different options does not apply
+        return checkpoint['last_id'] if checkpoint.get('force') == force else 0
+
+    def _save_checkpoint(self, last_id, force):
+        path = self._checkpoint_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'last_id': last_id, 'force': force}, f)
+        os.replace(path + '.tmp', path)
+
+    def _queryset(self, force):
+        extensions = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+        name_filter = Q()
+        for ext in extensions:
+            name_filter |= Q(filename__iendswith=ext)
+        queryset = FileTransfer.objects.filter(name_filter, processing_status__in=READY_STATUSES)
         if not force:
             # Only process files without thumbnails
-            from django.db.models import Q
             queryset = queryset.filter(Q(thumbnail='') | Q(thumbnail__isnull=True))
-        
-        if limit:
-            queryset = queryset[:limit]
-        
-        total = queryset.count()
+        return queryset.order_by('id')
+
+    def _delete_replaced(self, previous, thumbnails):
+        """
+        Delete the thumbnail files that --force replaced and nothing references any more.
+        Renditions are rewritten in place and belong to their blob.
+        """
+        replaced = {
+            name for file_id, name in previous.items()
+            if name and name != thumbnails.get(file_id, name) and not name.startswith(RENDITIONS_DIR + os.sep)
+        }
+        # Instant-upload copies share the thumbnail of the file they come from
+        replaced -= set(FileTransfer.objects.filter(thumbnail__in=replaced).values_list('thumbnail', flat=True))
+        for name in replaced:
+            default_storage.delete(name)
+
+    def _write_batch(self, thumbnails, blobs, previous):
+        """Store the rendered thumbnails of a batch with one bulk update per table."""
+        Blob.objects.bulk_update(blobs, ['renditions'])
+        updated = [FileTransfer(id=file_id, thumbnail=name) for file_id, name in thumbnails.items()]
+        FileTransfer.objects.bulk_update(updated, ['thumbnail'])
+        self._delete_replaced(previous, thumbnails)
+        # Clean files whose preview is now generated
+        FileTransfer.objects.filter(
+            id__in=[instance.id for instance in updated],
+            processing_status=FileTransfer.ProcessingStatus.CLEAN
+        ).update(processing_status=FileTransfer.ProcessingStatus.THUMBNAIL_READY)
+        # Bulk updates skip the signals that invalidate listing ETags
+        touch_files(thumbnails)
+        return len(updated)
+
+    def handle(self, *args, **options):
+        force = options.get('force', False)
+        limit = options.get('limit')
+        batch_size = max(options['batch_size'], 1)
+        workers = max(options['workers'], 1)
+
+        last_id = 0 if options['restart'] else self._load_checkpoint(force)
+        queryset = self._queryset(force)
+        pending = queryset.filter(id__gt=last_id)
+        remaining = pending.count()
+        total = min(remaining, limit) if limit else remaining
+        if last_id:
+            self.stdout.write(f'Resuming after file {last_id}')
+        self.stdout.write(f'Processing {total} files with {workers} workers...')
+
         processed = 0
         success = 0
-        skipped = 0
-        errors = 0
-        
-        self.stdout.write(f'Processing {total} files...')
-        
-        for file_transfer in queryset.iterator():
-            processed += 1
-            
-            # Check if it's an image
-            if not is_image_file(file_transfer.filename):
-                skipped += 1
-                continue
-            
-            # Check if file exists
-            if not file_transfer.file or not hasattr(file_transfer.file, 'path'):
-                skipped += 1
-                continue
-            
-            try:
-                import os
-                if not os.path.exists(file_transfer.file.path):
-                    self.stdout.write(
-                        self.style.WARNING(f'  [{processed}/{total}] File not found: {file_transfer.filename}')
-                    )
-                    skipped += 1
-                    continue
-                
-                # Generate thumbnail
-                thumbnail_content = generate_thumbnail(file_transfer.file.path)
-                
-                if thumbnail_content:
-                    thumb_filename = get_thumbnail_filename(file_transfer.filename)
-                    file_transfer.thumbnail.save(thumb_filename, thumbnail_content, save=True)
-                    success += 1
-                    self.stdout.write(
-                        self.style.SUCCESS(f'  [{processed}/{total}] Generated: {file_transfer.filename}')
-                    )
-                else:
-                    errors += 1
-                    self.stdout.write(
-                        self.style.WARNING(f'  [{processed}/{total}] Failed to generate: {file_transfer.filename}')
-                    )
-                    
-            except Exception as e:
-                errors += 1
+        errors_by_type = {}
+        started = time.monotonic()
+
+        # Forked workers must not share the parent's DB connection
+        connections.close_all()
+        with multiprocessing.Pool(workers, maxtasksperchild=1000) as pool:
+            while processed < total:
+                rows = list(
+                    pending.filter(id__gt=last_id)
+                    .values_list('id', 'file', 'filename', 'blob_id', 'blob__sha256', 'blob__renditions', 'thumbnail')
+                    [:min(batch_size, total - processed)]
+                )
+                if not rows:
+                    break
+                previous = {row[0]: row[-1] for row in rows}
+                rows = [row[:-1] for row in rows]
+
+                # One render per content: files sharing a blob reuse its renditions
+                blob_renditions = {}
+                tasks = {}
+                for file_id, name, filename, blob_id, sha256, renditions in rows:
+                    if blob_id and renditions and not force:
+                        blob_renditions[blob_id] = renditions
+                    elif not blob_id or blob_id not in tasks:
+                        tasks[blob_id or -file_id] = (
+                            file_id, default_storage.path(name) if name else None, filename, sha256
+                        )
+                tasks = list(tasks.values())
+                results = list(pool.imap(_render, tasks, chunksize=max(len(tasks) // (workers * 4), 1)))
+
+                files = {row[0]: row for row in rows}
+                thumbnails = {}
+                rendered_blobs = []
+                for file_id, value, error in results:
+                    _id, _name, filename, blob_id, _sha256, _renditions = files[file_id]
+                    if error:
+                        ext = os.path.splitext(filename)[1].lower()
+                        errors_by_type.setdefault(ext, Counter())[error] += 1
+                    elif blob_id:
+                        blob_renditions[blob_id] = value
+                        rendered_blobs.append(Blob(id=blob_id, renditions=value))
+                    else:
+                        thumbnails[file_id] = value
+                for file_id, _name, _filename, blob_id, sha256, _renditions in rows:
+                    if blob_id in blob_renditions:
+                        thumbnails[file_id] = rendition_name(sha256, *pick_rendition(blob_renditions[blob_id]))
+                success += self._write_batch(thumbnails, rendered_blobs, previous)
+
+                processed += len(rows)
+                last_id = rows[-1][0]
+                self._save_checkpoint(last_id, force)
+
+                elapsed = time.monotonic() - started
                 self.stdout.write(
-                    self.style.ERROR(f'  [{processed}/{total}] Error processing {file_transfer.filename}: {e}')
+                    f'  [{processed}/{total}] {processed / elapsed if elapsed else 0:.1f} files/s, '
+                    f'{success} generated'
                 )
-        
+
+        if processed >= remaining:
+            # Backfill finished: the next run starts from scratch
+            try:
+                os.remove(self._checkpoint_path())
+            except FileNotFoundError:
+                pass
+
+        elapsed = time.monotonic() - started
+        errors = sum(sum(counter.values()) for counter in errors_by_type.values())
         self.stdout.write('')
-        self.stdout.write(self.style.SUCCESS(f'Completed!'))
-        self.stdout.write(f'  Total processed: {processed}')
+        self.stdout.write(self.style.SUCCESS('Completed!'))
+        self.stdout.write(f'  Total processed: {processed} in {elapsed:.1f}s '
+                          f'({processed / elapsed if elapsed else 0:.1f} files/s)')
         self.stdout.write(f'  Thumbnails generated: {success}')
-        self.stdout.write(f'  Skipped (not images or missing): {skipped}')
         self.stdout.write(f'  Errors: {errors}')
+        for ext, counter in sorted(errors_by_type.items()):
+            detail = ', '.join(f'{reason}: {count}' for reason, count in counter.most_common())
+            self.stdout.write(f'    {ext or "(no extension)"}: {detail}')
@@ -0,0 +1,63 @@
+"""
+Management command to move existing transfers into the content-addressed blob store.
+Identical files end up sharing a single blob on disk.
+Run with: python manage.py migrate_to_blobs [--dry-run]
+"""
+import os
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from transfers.blob_utils import attach_blob, hash_file
+from transfers.models import Blob, FileTransfer
+
+
+class Command(BaseCommand):
+    help = 'Hash files stored before the blob store and deduplicate them into blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only hash the files and report the space that would be saved',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+
+        file_transfers = FileTransfer.objects.filter(blob__isnull=True).exclude(file='')
+        total = file_transfers.count()
+        self.stdout.write(f'Found {total} files outside the blob store')
+
+        migrated = 0
+        missing = 0
+        saved_bytes = 0
+        # sha256 -> bytes already stored (dry run bookkeeping)
+        seen = defaultdict(int)
+
+        for file_transfer in file_transfers.iterator():
+            file_path = file_transfer.file.path
+            if not os.path.exists(file_path):
+                missing += 1
+                self.stdout.write(self.style.WARNING(f'  Missing: {file_transfer.file.name}'))
+                continue
+
+            sha256 = hash_file(file_path)
+            size = os.path.getsize(file_path)
+            if dry_run:
+                if sha256 in seen or Blob.objects.filter(sha256=sha256).exists():
+                    saved_bytes += size
+                seen[sha256] = size
+                migrated += 1
+                continue
+
+            existing = Blob.objects.filter(sha256=sha256).exists()
+            attach_blob(file_transfer, file_path, sha256)
+            file_transfer.save(update_fields=['blob', 'file'])
+            if existing:
+                saved_bytes += size
+            migrated += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Migrated {migrated} files, {missing} missing, '
+            f'{saved_bytes / (1024 * 1024):.1f} MB deduplicated'
+            + (' (dry run)' if dry_run else '')
+        ))
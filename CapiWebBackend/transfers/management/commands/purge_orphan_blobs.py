@@ -0,0 +1,31 @@
+"""
+Management command to delete content blobs that no FileTransfer references.
+Run with: python manage.py purge_orphan_blobs
+"""
+from django.core.management.base import BaseCommand
+from transfers.blob_utils import BLOB_GC_GRACE_MINUTES, purge_orphan_blobs
+
+
+class Command(BaseCommand):
+    help = 'Delete unreferenced blobs orphaned for longer than the grace period'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-minutes',
+            type=int,
+            default=BLOB_GC_GRACE_MINUTES,
+            help='Minimum time a blob must have been unreferenced',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be deleted',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+        deleted, freed = purge_orphan_blobs(options['grace_minutes'], dry_run=dry_run)
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {deleted} orphan blobs ({freed / (1024 * 1024):.1f} MB)'
+            + (' (dry run)' if dry_run else '')
+        ))
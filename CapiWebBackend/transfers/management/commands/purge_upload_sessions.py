@@ -0,0 +1,55 @@
+"""
+Management command to purge expired or aborted chunked upload sessions
+and stale staged files of regular uploads.
+Run with: python manage.py purge_upload_sessions
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from transfers.models import UploadSession
+from transfers.upload_utils import discard_part_file, purge_staged_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete expired/aborted upload sessions and their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be deleted',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+
+        queryset = UploadSession.objects.filter(
+            Q(status=UploadSession.Status.ABORTED)
+            | Q(status=UploadSession.Status.ACTIVE, expires_at__lt=timezone.now())
+        )
+
+        purged = 0
+        for session in queryset.iterator():
+            purged += 1
+            if dry_run:
+                self.stdout.write(f'  Would purge: {session}')
+                continue
+            discard_part_file(session)
+            session.delete()
+
+        # Completed sessions no longer hold a partial file, only the row
+        completed = UploadSession.objects.filter(
+            status=UploadSession.Status.COMPLETED,
+            expires_at__lt=timezone.now()
+        )
+        completed_count = completed.count()
+        if not dry_run:
+            completed.delete()
+
+        # Staged files of regular uploads whose worker was killed mid-request
+        staged = 0 if dry_run else purge_staged_uploads()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged} incomplete and {completed_count} completed upload sessions, '
+            f'{staged} staged files' + (' (dry run)' if dry_run else '')
+        ))
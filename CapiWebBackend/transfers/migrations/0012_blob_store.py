@@ -0,0 +1,32 @@
+# Generated by Django 4.1.13 on 2026-10-16 23:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+import transfers.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0011_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(max_length=255, upload_to=transfers.models.blob_upload_path)),
+                ('size', models.BigIntegerField(help_text='Size in bytes')),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('orphaned_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='filetransfer',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='file_transfers', to='transfers.blob'),
+        ),
+    ]
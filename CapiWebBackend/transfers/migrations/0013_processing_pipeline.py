@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-17 00:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0012_blob_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetransfer',
+            name='processing_status',
+            field=models.CharField(choices=[('pending_scan', 'Pendiente de análisis'), ('clean', 'Limpio'), ('quarantined', 'En cuarentena'), ('thumbnail_ready', 'Miniatura lista')], db_index=True, default='clean', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('scan', 'Análisis de malware'), ('thumbnail', 'Miniatura')], max_length=10)),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('running', 'En ejecución'), ('done', 'Terminado'), ('failed', 'Fallido')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField()),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('file_transfer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='processing_jobs', to='transfers.filetransfer')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='processingjob',
+            index=models.Index(fields=['status', 'run_after'], name='transfers_p_status_f63010_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-17 00:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0013_processing_pipeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
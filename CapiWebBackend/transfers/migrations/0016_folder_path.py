@@ -0,0 +1,48 @@
+# Generated by Django 4.1.13 on 2026-10-17 00:32
+
+from django.db import migrations, models
+
+
+def fill_folder_paths(apps, schema_editor):
+    """
+    Calcula la ruta materializada (/1/5/12/) de las carpetas existentes,
+    nivel a nivel desde las raíces, con actualizaciones por lotes
+    """
+    Folder = apps.get_model('transfers', 'Folder')
+
+    children = {}
+    for folder_id, parent_id in Folder.objects.values_list('id', 'parent_id').iterator():
+        children.setdefault(parent_id, []).append(folder_id)
+
+    paths = {}
+    level = [(folder_id, f'/{folder_id}/') for folder_id in children.get(None, [])]
+    while level:
+        paths.update(level)
+        level = [
+            (child_id, f'{path}{child_id}/')
+            for folder_id, path in level
+            for child_id in children.get(folder_id, [])
+            if child_id not in paths
+        ]
+
+    Folder.objects.bulk_update(
+        [Folder(id=folder_id, path=path) for folder_id, path in paths.items()],
+        ['path'],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0015_change_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=2048),
+        ),
+        migrations.RunPython(fill_folder_paths, migrations.RunPython.noop),
+    ]
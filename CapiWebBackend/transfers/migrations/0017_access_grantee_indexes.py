@@ -0,0 +1,21 @@
+# Generated by Django 4.1.13 on 2026-10-17 00:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0016_folder_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fileaccess',
+            index=models.Index(fields=['granted_to', 'file', 'expires_at'], name='fileaccess_grantee_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folderaccess',
+            index=models.Index(fields=['granted_to', 'folder', 'expires_at'], name='folderaccess_grantee_idx'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 4.1.13 on 2026-10-17 00:51
+
+from django.db import migrations
+
+PERMISSION_RANK = {'read': 1, 'edit': 2}
+BATCH_SIZE = 1000
+
+
+def _path_ids(path):
+    return [int(part) for part in path.strip('/').split('/') if part]
+
+
+def _covers(grant, permission, expires_at):
+    """Un acceso cubre a otro si concede al menos el mismo permiso durante al menos el mismo tiempo"""
+    grant_permission, grant_expires_at, _propagate = grant
+    return (
+        PERMISSION_RANK.get(grant_permission, 0) >= PERMISSION_RANK.get(permission, 0)
+        and (grant_expires_at is None or (expires_at is not None and grant_expires_at >= expires_at))
+    )
+
+
+def collapse_inherited_access(apps, schema_editor):
+    """
+    Borra los accesos que copiaba la herencia anterior y que ahora se
+    resuelven al leer: los de una carpeta cubiertos por un acceso con
+    propagate de una antecesora, y los de un archivo cubiertos por el acceso
+    a su carpeta o por uno con propagate de una antecesora (mismo usuario,
+    permiso igual o mayor, caducidad igual o posterior). El permiso efectivo
+    de cada usuario no cambia; los accesos más amplios que el heredado se
+    conservan.
+    """
+    Folder = apps.get_model('transfers', 'Folder')
+    FileAccess = apps.get_model('transfers', 'FileAccess')
+    FolderAccess = apps.get_model('transfers', 'FolderAccess')
+
+    paths = dict(Folder.objects.values_list('id', 'path').iterator())
+    # {(carpeta, usuario): (permiso, caducidad, propagate)}
+    grants = {}
+    rows = FolderAccess.objects.values_list(
+        'id', 'folder_id', 'granted_to_id', 'permission', 'expires_at', 'propagate'
+    )
+    for _id, folder_id, user_id, permission, expires_at, propagate in rows.iterator():
+        grants[(folder_id, user_id)] = (permission, expires_at, propagate)
+
+    def covered(folder_id, user_id, permission, expires_at, include_folder):
+        ancestors = _path_ids(paths.get(folder_id, ''))[:-1]
+        for ancestor_id in ancestors:
+            grant = grants.get((ancestor_id, user_id))
+            if grant and grant[2] and _covers(grant, permission, expires_at):
+                return True
+        grant = grants.get((folder_id, user_id)) if include_folder else None
+        return bool(grant) and _covers(grant, permission, expires_at)
+
+    redundant_folder_accesses = [
+        access_id
+        for access_id, folder_id, user_id, permission, expires_at, _propagate in rows.iterator()
+        if covered(folder_id, user_id, permission, expires_at, include_folder=False)
+    ]
+    redundant_file_accesses = [
+        access_id
+        for access_id, folder_id, user_id, permission, expires_at in FileAccess.objects.filter(
+            file__folder__isnull=False
+        ).values_list('id', 'file__folder_id', 'granted_to_id', 'permission', 'expires_at').iterator()
+        if covered(folder_id, user_id, permission, expires_at, include_folder=True)
+    ]
+
+    for model, ids in ((FolderAccess, redundant_folder_accesses), (FileAccess, redundant_file_accesses)):
+        for start in range(0, len(ids), BATCH_SIZE):
+            model.objects.filter(id__in=ids[start:start + BATCH_SIZE]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transfers', '0018_access_propagation_job'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='AccessPropagationJob',
+        ),
+        migrations.RunPython(collapse_inherited_access, migrations.RunPython.noop),
+    ]
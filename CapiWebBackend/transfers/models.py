@@ -1,4 +1,10 @@
-from django.db import models
+import math
+import os
+import uuid
+
+from django.db import models, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 from django.contrib.auth.models import User
 
 
@@ -7,11 +13,45 @@ def file_upload_path(instance, filename):
     owner_username = owner.username if owner else 'unknown'
     return f'media_transfer/{owner_username}/{filename}'
 
+def blob_upload_path(instance, filename):
+    # Sharded by hash prefix; the extension is kept for tools that dispatch on it
+    ext = os.path.splitext(filename)[1].lower()
+    return f'blobs/{instance.sha256[:2]}/{instance.sha256[2:4]}/{instance.sha256}{ext}'
+
+
+class Blob(models.Model):
+    """
+    Contenido de un fichero guardado una sola vez, direccionado por su SHA-256.
+    Varios FileTransfer con los mismos bytes comparten el mismo Blob; cuando
+    ref_count llega a 0 queda huérfano y lo elimina purge_orphan_blobs.
+    `renditions` registra las miniaturas generadas ({tamaño: [formatos]}).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_upload_path, max_length=255)
+    size = models.BigIntegerField(help_text="Size in bytes")
+    ref_count = models.PositiveIntegerField(default=0)
+    orphaned_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    renditions = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256[:12]} ({self.ref_count} refs)"
+
+
 class Folder(models.Model):
+    """
+    Carpeta del árbol de archivos.
+    `path` es la ruta materializada de ids desde la raíz (/1/5/12/, la propia
+    carpeta incluida): los descendientes de una carpeta son las filas cuyo
+    path empieza por el suyo, una sola consulta indexada (ver tree_utils).
+    Se mantiene al crear y al mover la carpeta (save); al borrar, el
+    subárbol se elimina en cascada.
+    """
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_folders')
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_folders', null=True, blank=True)
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='subfolders', db_index=True)
+    path = models.CharField(max_length=2048, blank=True, default='', db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -20,14 +60,47 @@ class Folder(models.Model):
             models.Index(fields=['owner', 'parent']),
         ]
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'parent' not in update_fields:
+            # Renames and other edits keep their place in the tree
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            parent_path = '/'
+            if self.parent_id:
+                parent_path = Folder.objects.filter(pk=self.parent_id).values_list('path', flat=True).get()
+            old_path = Folder.objects.filter(pk=self.pk).values_list('path', flat=True).first() if self.pk else None
+            if old_path and parent_path.startswith(old_path):
+                raise ValueError(f"Folder {self.pk} cannot be moved into its own subtree")
+
+            super().save(*args, **kwargs)
+
+            new_path = f'{parent_path}{self.pk}/'
+            if old_path and old_path != new_path:
+                # Moved: rewrite the prefix of the whole subtree in one statement
+                Folder.objects.filter(path__startswith=old_path).update(
+                    path=Concat(Value(new_path), Substr('path', len(old_path) + 1))
+                )
+            elif old_path != new_path:
+                Folder.objects.filter(pk=self.pk).update(path=new_path)
+            self.path = new_path
+
     def __str__(self):
         return f"{self.name} ({self.owner})"
 
 class FileTransfer(models.Model):
+    class ProcessingStatus(models.TextChoices):
+        PENDING_SCAN = 'pending_scan', 'Pendiente de análisis'
+        CLEAN = 'clean', 'Limpio'
+        QUARANTINED = 'quarantined', 'En cuarentena'
+        THUMBNAIL_READY = 'thumbnail_ready', 'Miniatura lista'
+
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_files')
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_files')
     folder = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.SET_NULL, related_name='files')
     file = models.FileField(upload_to=file_upload_path)
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='file_transfers')
     filename = models.CharField(max_length=255)
     size = models.BigIntegerField(help_text="Size in bytes")
     description = models.TextField(blank=True, null=True)
@@ -36,6 +109,9 @@ class FileTransfer(models.Model):
     is_downloaded = models.BooleanField(default=False)
     is_viewed = models.BooleanField(default=False, db_index=True)
     thumbnail = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
+    processing_status = models.CharField(
+        max_length=20, choices=ProcessingStatus.choices, default=ProcessingStatus.CLEAN, db_index=True
+    )
 
     class Meta:
         indexes = [
@@ -66,6 +142,10 @@ class FileAccess(models.Model):
 
     class Meta:
         unique_together = ('file', 'granted_to')
+        indexes = [
+            # Accesos vigentes de un usuario (listados) solo desde el índice
+            models.Index(fields=['granted_to', 'file', 'expires_at'], name='fileaccess_grantee_idx'),
+        ]
 
     def __str__(self):
         return f"Access to {self.file_id} for {self.granted_to} ({self.permission})"
@@ -86,6 +166,10 @@ class FolderAccess(models.Model):
 
     class Meta:
         unique_together = ('folder', 'granted_to')
+        indexes = [
+            # Accesos vigentes de un usuario (listados) solo desde el índice
+            models.Index(fields=['granted_to', 'folder', 'expires_at'], name='folderaccess_grantee_idx'),
+        ]
 
     def __str__(self):
         return f"Access to folder {self.folder_id} for {self.granted_to} ({self.permission})"
@@ -138,3 +222,98 @@ class ShareLink(models.Model):
     def __str__(self):
         target = self.file.filename if self.file else self.folder.name
         return f"ShareLink({self.token[:8]}...) -> {target}"
+
+
+class UploadSession(models.Model):
+    """
+    Sesión de subida por fragmentos (chunked upload) reanudable.
+    El cliente crea la sesión, envía los fragmentos numerados en orden y
+    finalmente la completa, momento en el que se crea el FileTransfer.
+    """
+    class Status(models.TextChoices):
+        ACTIVE = 'active', 'Activa'
+        COMPLETED = 'completed', 'Completada'
+        ABORTED = 'aborted', 'Cancelada'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    owner = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='incoming_upload_sessions')
+    folder = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.SET_NULL, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField(help_text="Total size in bytes")
+    description = models.TextField(blank=True, null=True)
+    chunk_size = models.PositiveIntegerField()
+    received_chunks = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.ACTIVE)
+    file_transfer = models.ForeignKey(FileTransfer, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['uploader', 'status']),
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    @property
+    def total_chunks(self):
+        return math.ceil(self.size / self.chunk_size) if self.size else 0
+
+    @property
+    def received_bytes(self):
+        return min(self.received_chunks * self.chunk_size, self.size)
+
+    def expected_chunk_length(self, index):
+        """Longitud que debe tener el fragmento `index` (el último puede ser menor)."""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def __str__(self):
+        return f"UploadSession({self.id}) {self.filename} [{self.received_chunks}/{self.total_chunks}]"
+
+
+class ProcessingJob(models.Model):
+    """
+    Trabajo de post-procesado de un archivo subido (análisis y miniatura).
+    Lo ejecuta fuera de la petición el comando process_upload_jobs.
+    """
+    class Stage(models.TextChoices):
+        SCAN = 'scan', 'Análisis de malware'
+        THUMBNAIL = 'thumbnail', 'Miniatura'
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pendiente'
+        RUNNING = 'running', 'En ejecución'
+        DONE = 'done', 'Terminado'
+        FAILED = 'failed', 'Fallido'
+
+    file_transfer = models.ForeignKey(FileTransfer, on_delete=models.CASCADE, related_name='processing_jobs')
+    stage = models.CharField(max_length=10, choices=Stage.choices)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField()
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f"ProcessingJob({self.id}) {self.stage} for file {self.file_transfer_id} [{self.status}]"
+
+
+class ChangeCounter(models.Model):
+    """
+    Versión de lo que un usuario ve en sus listados de archivos y carpetas.
+    Se incrementa con cada cambio que le afecta y forma los ETag débiles de
+    los listados, que se revalidan con 304 sin volver a serializarse.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='change_counter')
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"ChangeCounter {self.user_id} v{self.version}"
@@ -0,0 +1,71 @@
+"""
+On-demand thumbnails for request handlers.
+
+Previews are never rendered in the web process: a missing one is queued as
+a thumbnail ProcessingJob for the worker (process_upload_jobs) and the
+request answers 202 with Retry-After right away. So a gallery opening many
+tiles at once costs one job per content, and render concurrency is bounded
+by the number of workers:
+
+- One job per key (content, or file without blob): the key's row is locked
+  while checking for a pending job, so concurrent requests, in any process,
+  queue it once.
+- Keys whose last thumbnail job failed within
+  TRANSFER_THUMBNAIL_FAILURE_TTL_MINUTES are not queued again on every view.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Blob, FileTransfer, ProcessingJob
+from .processing_utils import enqueue_processing
+
+# On-demand settings
+THUMBNAIL_FAILURE_TTL = getattr(settings, 'TRANSFER_THUMBNAIL_FAILURE_TTL_MINUTES', 60) * 60
+THUMBNAIL_RETRY_AFTER_SECONDS = 2
+
+# Files per request of the gallery batch endpoint
+THUMBNAIL_BATCH_MAX = getattr(settings, 'TRANSFER_THUMBNAIL_BATCH_MAX', 100)
+
+# Outcomes of request_preview()
+PREVIEW_READY = 'ready'
+PREVIEW_PENDING = 'pending'
+PREVIEW_FAILED = 'failed'
+
+
+def _thumbnail_jobs(instance):
+    """Thumbnail jobs of the key of a file: its content when blob-backed (shared renditions)."""
+    jobs = ProcessingJob.objects.filter(stage=ProcessingJob.Stage.THUMBNAIL)
+    if instance.blob_id:
+        return jobs.filter(file_transfer__blob_id=instance.blob_id)
+    return jobs.filter(file_transfer_id=instance.id)
+
+
+def request_preview(instance) -> str:
+    """
+    Queue the preview of a file that has none, unless it is already queued.
+
+    Returns:
+        PREVIEW_PENDING when a thumbnail job is queued or running (the
+        caller answers 202), PREVIEW_FAILED for keys whose job recently
+        failed, PREVIEW_READY when the job ran inline (development) and
+        built it (the caller reloads the file).
+    """
+    jobs = _thumbnail_jobs(instance)
+    with transaction.atomic():
+        # Serializes the check-then-enqueue of concurrent requests for the key
+        if instance.blob_id:
+            Blob.objects.select_for_update().filter(id=instance.blob_id).exists()
+        else:
+            FileTransfer.objects.select_for_update().filter(id=instance.id).exists()
+
+        if jobs.filter(status__in=[ProcessingJob.Status.PENDING, ProcessingJob.Status.RUNNING]).exists():
+            return PREVIEW_PENDING
+        failed_since = timezone.now() - timedelta(seconds=THUMBNAIL_FAILURE_TTL)
+        if jobs.filter(status=ProcessingJob.Status.FAILED, updated_at__gte=failed_since).exists():
+            return PREVIEW_FAILED
+        job = enqueue_processing(instance, ProcessingJob.Stage.THUMBNAIL)
+
+    if job.status == ProcessingJob.Status.DONE:
+        return PREVIEW_READY
+    return PREVIEW_FAILED if job.status == ProcessingJob.Status.FAILED else PREVIEW_PENDING
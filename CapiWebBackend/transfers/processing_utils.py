@@ -0,0 +1,245 @@
+"""
+Post-upload processing pipeline for file transfers.
+Uploads only write the file and enqueue a ProcessingJob; the worker
+(python manage.py process_upload_jobs) runs the stages out of the request:
+
+    scan       malware scan + archive scan  -> clean | quarantined
+    thumbnail  image/video renditions       -> thumbnail_ready
+
+Jobs live in the database, so they survive restarts. Workers claim them with
+a conditional UPDATE (safe with several workers on any backend) and failed
+attempts are retried with exponential backoff. A claim is a lease of
+TRANSFER_PROCESSING_LEASE_SECONDS that the worker renews while the job runs,
+so only the jobs of a dead worker are requeued, however long a scan or
+render takes.
+
+Files that are not scanned yet are served according to
+TRANSFER_UNSCANNED_DOWNLOAD_POLICY: 'allow' (anyone with access), 'owner'
+(only their owner/uploader, default) or 'block'. Quarantined files are never served.
+"""
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+from .etag_utils import touch_files
+from .models import FileTransfer, ProcessingJob
+from .security_utils import scan_archive_contents, scan_file_for_malware
+from .thumbnail_utils import (
+    ImageTooLarge,
+    generate_thumbnail,
+    generate_video_thumbnail,
+    get_thumbnail_filename,
+    is_image_file,
+    is_video_file,
+    store_renditions,
+)
+
+logger = logging.getLogger('transfers')
+
+# Pipeline settings
+PROCESS_UPLOADS_INLINE = getattr(settings, 'TRANSFER_PROCESS_UPLOADS_INLINE', False)
+PROCESSING_MAX_ATTEMPTS = getattr(settings, 'TRANSFER_PROCESSING_MAX_ATTEMPTS', 5)
+PROCESSING_RETRY_SECONDS = 30  # Base backoff, doubled on every attempt
+# Running jobs whose lease was not renewed for this long belong to a dead worker
+PROCESSING_LEASE_SECONDS = getattr(settings, 'TRANSFER_PROCESSING_LEASE_SECONDS', 300)
+PROCESSING_HEARTBEAT_SECONDS = PROCESSING_LEASE_SECONDS / 3
+NO_PREVIEW_ERROR = 'No preview could be generated'
+
+# Download policy for files still waiting for the malware scan
+POLICY_ALLOW = 'allow'
+POLICY_OWNER = 'owner'
+POLICY_BLOCK = 'block'
+UNSCANNED_DOWNLOAD_POLICY = getattr(settings, 'TRANSFER_UNSCANNED_DOWNLOAD_POLICY', POLICY_OWNER)
+
+READY_STATUSES = (FileTransfer.ProcessingStatus.CLEAN, FileTransfer.ProcessingStatus.THUMBNAIL_READY)
+ARCHIVE_EXTENSIONS = ['.zip', '.rar', '.7z', '.tar', '.gz', '.bz2']
+
+
+def enqueue_processing(instance, stage: str = ProcessingJob.Stage.SCAN) -> ProcessingJob:
+    """
+    Queue a processing stage for a file.
+    With TRANSFER_PROCESS_UPLOADS_INLINE (development) it runs immediately.
+    """
+    job = ProcessingJob.objects.create(file_transfer=instance, stage=stage, run_after=timezone.now())
+    if PROCESS_UPLOADS_INLINE and claim_job(job):
+        run_job(job)
+    return job
+
+
+def claim_job(job: ProcessingJob) -> bool:
+    """Atomically move a pending job to running; False if another worker got it."""
+    now = timezone.now()
+    claimed = ProcessingJob.objects.filter(
+        id=job.id, status=ProcessingJob.Status.PENDING
+    ).update(status=ProcessingJob.Status.RUNNING, locked_at=now, attempts=F('attempts') + 1, updated_at=now)
+    if claimed:
+        job.status = ProcessingJob.Status.RUNNING
+        job.locked_at = now
+        job.attempts += 1
+    return bool(claimed)
+
+
+def claim_jobs(limit: int) -> list[ProcessingJob]:
+    """Claim up to `limit` due jobs, oldest first."""
+    due = ProcessingJob.objects.filter(
+        status=ProcessingJob.Status.PENDING,
+        run_after__lte=timezone.now()
+    ).order_by('id').select_related('file_transfer')[:limit]
+    return [job for job in due if claim_job(job)]
+
+
+def renew_lease(job: ProcessingJob) -> bool:
+    """Extend the lease of a running job; False if it was requeued or claimed again."""
+    return bool(ProcessingJob.objects.filter(
+        id=job.id, status=ProcessingJob.Status.RUNNING, attempts=job.attempts
+    ).update(locked_at=timezone.now()))
+
+
+@contextmanager
+def _heartbeat(job: ProcessingJob):
+    """Renew the lease of `job` from a background thread while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(PROCESSING_HEARTBEAT_SECONDS):
+                if not renew_lease(job):
+                    logger.warning(f"Processing job {job.id} lost its lease")
+                    break
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'processing-lease-{job.id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_stale_jobs() -> int:
+    """Give back the jobs of workers that died while running them."""
+    cutoff = timezone.now() - timedelta(seconds=PROCESSING_LEASE_SECONDS)
+    return ProcessingJob.objects.filter(
+        status=ProcessingJob.Status.RUNNING,
+        locked_at__lt=cutoff
+    ).update(status=ProcessingJob.Status.PENDING, run_after=timezone.now(), locked_at=None)
+
+
+def run_job(job: ProcessingJob) -> bool:
+    """Run a claimed job and record its outcome. Returns True on success."""
+    instance = job.file_transfer
+    preview_built = True
+    try:
+        with _heartbeat(job):
+            if job.stage == ProcessingJob.Stage.SCAN:
+                _scan_stage(instance)
+            else:
+                preview_built = build_preview(instance)
+    except Exception as e:
+        logger.error(f"Processing job {job.id} ({job.stage}) failed for file {instance.id}: {e}")
+        job.last_error = str(e)[:1000]
+        if job.attempts >= PROCESSING_MAX_ATTEMPTS:
+            job.status = ProcessingJob.Status.FAILED
+        else:
+            job.status = ProcessingJob.Status.PENDING
+            job.run_after = timezone.now() + timedelta(seconds=PROCESSING_RETRY_SECONDS * 2 ** (job.attempts - 1))
+        job.locked_at = None
+        job.save(update_fields=['status', 'run_after', 'locked_at', 'last_error', 'updated_at'])
+        return False
+
+    if preview_built:
+        job.status = ProcessingJob.Status.DONE
+        job.last_error = ''
+    else:
+        # The content cannot have a preview: retrying would not change that
+        job.status = ProcessingJob.Status.FAILED
+        job.last_error = NO_PREVIEW_ERROR
+    job.locked_at = None
+    job.save(update_fields=['status', 'locked_at', 'last_error', 'updated_at'])
+    return preview_built
+
+
+def _set_status(instance, processing_status: str) -> None:
+    instance.processing_status = processing_status
+    FileTransfer.objects.filter(id=instance.id).update(processing_status=processing_status)
+    touch_files([instance.id])
+
+
+def _scan_stage(instance) -> None:
+    """Malware scan, then archive scan; queue the thumbnail of clean media."""
+    file_path = instance.file.path
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(file_path)
+
+    is_safe, message = scan_file_for_malware(file_path, instance.blob.sha256 if instance.blob_id else None)
+    if not is_safe:
+        logger.warning(f"File {instance.id} ({instance.filename}) quarantined: {message}")
+        _set_status(instance, FileTransfer.ProcessingStatus.QUARANTINED)
+        return
+
+    ext = os.path.splitext(instance.filename)[1].lower()
+    if ext in ARCHIVE_EXTENSIONS:
+        has_executables, executable_list = scan_archive_contents(file_path)
+        if has_executables:
+            logger.warning(f"Archive {instance.id} ({instance.filename}) contains executables: {executable_list}")
+
+    _set_status(instance, FileTransfer.ProcessingStatus.CLEAN)
+    if is_image_file(instance.filename) or is_video_file(instance.filename):
+        enqueue_processing(instance, ProcessingJob.Stage.THUMBNAIL)
+
+
+def build_preview(instance) -> bool:
+    """
+    Generate the image/video preview (renditions) of a clean file; run by
+    the thumbnail stage. False if no preview could be made.
+    """
+    if instance.blob_id:
+        if not store_renditions(instance):
+            return False
+    else:
+        if is_image_file(instance.filename):
+            try:
+                thumbnail_content = generate_thumbnail(instance.file.path)
+            except ImageTooLarge as e:
+                logger.warning(f"[THUMBNAIL] Skipping preview of file {instance.id}: {e}")
+                return False
+        else:
+            thumbnail_content = generate_video_thumbnail(instance.file.path)
+        if not thumbnail_content:
+            return False
+        instance.thumbnail.save(get_thumbnail_filename(instance.filename), thumbnail_content, save=False)
+
+    instance.processing_status = FileTransfer.ProcessingStatus.THUMBNAIL_READY
+    instance.save(update_fields=['thumbnail', 'processing_status'])
+    return True
+
+
+def can_download(instance, user=None) -> bool:
+    """Whether the bytes of `instance` may be served to `user` (None = anonymous link)."""
+    if instance.processing_status in READY_STATUSES:
+        return True
+    if instance.processing_status != FileTransfer.ProcessingStatus.PENDING_SCAN:
+        return False
+    if UNSCANNED_DOWNLOAD_POLICY == POLICY_ALLOW:
+        return True
+    if UNSCANNED_DOWNLOAD_POLICY == POLICY_OWNER and user is not None and user.is_authenticated:
+        return user.id in (instance.owner_id, instance.uploader_id)
+    return False
+
+
+def downloadable_filter(user=None) -> Q:
+    """Queryset filter equivalent to can_download(), for archives of many files."""
+    allowed = Q(processing_status__in=READY_STATUSES)
+    pending = Q(processing_status=FileTransfer.ProcessingStatus.PENDING_SCAN)
+    if UNSCANNED_DOWNLOAD_POLICY == POLICY_ALLOW:
+        return allowed | pending
+    if UNSCANNED_DOWNLOAD_POLICY == POLICY_OWNER and user is not None and user.is_authenticated:
+        return allowed | (pending & (Q(owner=user) | Q(uploader=user)))
+    return allowed
@@ -3,14 +3,23 @@ Security utilities for file validation and malware scanning
 """
 import os
 import json
+import time
+import queue
+import socket
+import struct
 import zipfile
+import logging
 import rarfile
 import tarfile
+import threading
 from pathlib import Path
 from django.conf import settings
+from django.core.cache import cache
 import hashlib
 import vt
 
+logger = logging.getLogger('transfers')
+
 # Load security configuration
 CONFIG_PATH = Path(__file__).resolve().parent.parent.parent / 'security_config.json'
 
@@ -36,6 +45,124 @@ def get_dangerous_extensions():
     """Get list of dangerous extensions in archives"""
     return set(SECURITY_CONFIG['file_validation']['dangerous_in_archives'])
 
+# Leading bytes of the formats we can recognise. Extensions not listed here
+# (text, svg, MPEG-TS...) have no reliable signature and are not sniffed.
+# A candidate is a list of (offset, magic) that must all match, or a function
+# of the leading bytes for formats without a fixed magic.
+_FTYP = [(4, b'ftyp')]
+_OLE = [(0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1')]
+_OOXML = [(0, b'PK\x03\x04')]
+TAR_BLOCK_SIZE = 512
+
+
+def _riff(fourcc):
+    return [(0, b'RIFF'), (8, fourcc)]
+
+
+def _mpeg_audio_frame(head):
+    """11-bit MPEG audio frame sync (MPEG-1, 2 and 2.5, any layer)."""
+    return len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+
+
+def _tar_header(head):
+    """First tar header block with a valid checksum (v7 tars have no 'ustar' magic)."""
+    if len(head) < TAR_BLOCK_SIZE:
+        return False
+    try:
+        stored = int(head[148:156].strip(b'\x00 ') or b'-1', 8)
+    except ValueError:
+        return False
+    # The checksum is computed with its own field filled with spaces
+    return stored == sum(head[:148]) + 8 * ord(' ') + sum(head[156:TAR_BLOCK_SIZE])
+
+
+def _office_markup(head):
+    """RTF, HTML or XML documents that Word and Excel save with .doc/.xls extensions."""
+    text = head.removeprefix(b'\xef\xbb\xbf').lstrip().lower()
+    return text.startswith((b'{\\rtf', b'<?xml', b'<html', b'<!doctype html'))
+
+
+MAGIC_SIGNATURES = {
+    '.jpg': [[(0, b'\xff\xd8\xff')]],
+    '.jpeg': [[(0, b'\xff\xd8\xff')]],
+    '.png': [[(0, b'\x89PNG\r\n\x1a\n')]],
+    '.gif': [[(0, b'GIF87a')], [(0, b'GIF89a')]],
+    '.bmp': [[(0, b'BM')]],
+    '.webp': [_riff(b'WEBP')],
+    '.ico': [[(0, b'\x00\x00\x01\x00')]],
+    '.wav': [_riff(b'WAVE')],
+    '.avi': [_riff(b'AVI ')],
+    '.ogg': [[(0, b'OggS')]],
+    '.ogv': [[(0, b'OggS')]],
+    '.flac': [[(0, b'fLaC')]],
+    '.mp3': [[(0, b'ID3')], _mpeg_audio_frame],
+    '.mp4': [_FTYP],
+    '.m4v': [_FTYP],
+    '.m4a': [_FTYP],
+    '.mov': [_FTYP, [(4, b'moov')], [(4, b'mdat')], [(4, b'wide')], [(4, b'free')]],
+    '.3gp': [_FTYP],
+    '.3g2': [_FTYP],
+    '.mkv': [[(0, b'\x1a\x45\xdf\xa3')]],
+    '.webm': [[(0, b'\x1a\x45\xdf\xa3')]],
+    '.flv': [[(0, b'FLV')]],
+    '.wmv': [[(0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11')]],
+    '.wma': [[(0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11')]],
+    '.pdf': [[(0, b'%PDF-')]],
+    '.zip': [[(0, b'PK\x03\x04')], [(0, b'PK\x05\x06')], [(0, b'PK\x07\x08')]],
+    '.rar': [[(0, b'Rar!\x1a\x07')]],
+    '.7z': [[(0, b"7z\xbc\xaf\x27\x1c")]],
+    '.tar': [[(257, b'ustar')], _tar_header],
+    '.gz': [[(0, b'\x1f\x8b')]],
+    '.bz2': [[(0, b'BZh')]],
+    '.doc': [_OLE, _office_markup],
+    '.xls': [_OLE, _office_markup],
+    '.ppt': [_OLE],
+    '.docx': [_OOXML],
+    '.xlsx': [_OOXML],
+    '.pptx': [_OOXML],
+}
+# Enough for a tar header block and for the PE signature of any executable we refuse
+SNIFF_BYTES = 4096
+
+# Native executables are refused whatever their extension
+EXECUTABLE_SIGNATURES = [b'\x7fELF', b'\xfe\xed\xfa', b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe']
+
+
+def _is_executable(head):
+    if any(head.startswith(signature) for signature in EXECUTABLE_SIGNATURES):
+        return True
+    # Windows PE: 'MZ' DOS header whose e_lfanew points at the 'PE' signature.
+    # Only the sniffed bytes are looked at: a pointer past them is not a PE we refuse
+    if head.startswith(b'MZ') and len(head) >= 64:
+        pe_offset = int.from_bytes(head[60:64], 'little')
+        return head[pe_offset:pe_offset + 4] == b'PE\x00\x00'
+    return False
+
+
+def sniff_content_mismatch(filename, head):
+    """
+    Check the first bytes of a file against its extension.
+    Returns: error message if the content does not match, None otherwise
+    """
+    if not SECURITY_CONFIG['file_validation'].get('sniff_content', True):
+        return None
+
+    if _is_executable(head):
+        return 'El contenido del archivo es un ejecutable'
+
+    ext = os.path.splitext(filename)[1].lower()
+    candidates = MAGIC_SIGNATURES.get(ext)
+    if not candidates or not head:
+        return None
+    for candidate in candidates:
+        if callable(candidate):
+            if candidate(head):
+                return None
+        elif all(head[offset:offset + len(magic)] == magic for offset, magic in candidate):
+            return None
+    return f'El contenido del archivo no corresponde a su extensión ({ext})'
+
+
 def scan_archive_contents(file_path):
     """
     Scan archive (ZIP, RAR, TAR) for dangerous file types
@@ -85,111 +212,365 @@ def scan_archive_contents(file_path):
         print(f"Error scanning archive: {e}")
         return False, []
 
-def scan_with_virustotal(file_path):
+# =============================================================================
+# Malware scanners
+# =============================================================================
+# Verdicts are cached by SHA-256 (ClamAV keys also carry the signature database
+# version, so a freshclam update invalidates them), scanner connections are
+# pooled and reused, and clamd receives the bytes through INSTREAM, so it does
+# not need read access to MEDIA_ROOT. Files over clamd's StreamMaxLength
+# (clamav.stream_max_mb, 25 MB like clamd) are scanned by path instead; if
+# clamd cannot scan them either they stay unscanned, never "safe".
+
+VERDICT_CACHE_PREFIX = 'malware_verdict'
+VERDICT_CACHE_TTL = SECURITY_CONFIG['malware_scanning'].get('verdict_cache_ttl_hours', 24) * 3600
+CLAMD_CHUNK_SIZE = 64 * 1024
+CLAMD_VERSION_TTL = 60  # Seconds between signature version checks
+CLAMD_STREAM_LIMIT_REPLY = 'INSTREAM size limit exceeded'
+
+
+class ScannerMetrics:
+    """Thread-safe counters and latency totals of the scanner layer."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, peak = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + seconds, max(peak, seconds))
+
+    def snapshot(self):
+        """Counters plus count/avg/max latency (ms) of every timed operation."""
+        with self._lock:
+            data = dict(self._counters)
+            for name, (count, total, peak) in self._timings.items():
+                data[f'{name}_count'] = count
+                data[f'{name}_avg_ms'] = round(total * 1000 / count, 2)
+                data[f'{name}_max_ms'] = round(peak * 1000, 2)
+            return data
+
+
+SCANNER_METRICS = ScannerMetrics()
+
+
+class ClamdError(Exception):
+    """Raised when clamd cannot be reached or answers with an error."""
+
+
+class FileNotScanned(Exception):
+    """Raised when a file could not be scanned at all, so no verdict must be assumed."""
+
+
+class ClamdConnection:
+    """
+    A clamd IDSESSION: several commands share one socket, answered in order
+    as "<id>: <reply>". clamd drops idle sessions, so callers retry once on
+    a fresh connection.
+    """
+
+    def __init__(self, address, timeout):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.sendall(b'zIDSESSION\0')
+        self.buffer = b''
+        self.next_id = 1
+
+    def _reply(self):
+        while b'\0' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ClamdError('clamd closed the session')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\0', 1)
+        request_id, _, reply = line.decode('utf-8', 'replace').partition(': ')
+        if request_id != str(self.next_id):
+            raise ClamdError(f'Unexpected clamd reply: {line!r}')
+        self.next_id += 1
+        return reply
+
+    def command(self, name):
+        self.sock.sendall(b'z' + name.encode() + b'\0')
+        return self._reply()
+
+    def instream(self, file_obj):
+        """Send the content of `file_obj` with INSTREAM and return the reply."""
+        self.sock.sendall(b'zINSTREAM\0')
+        while True:
+            block = file_obj.read(CLAMD_CHUNK_SIZE)
+            if not block:
+                break
+            self.sock.sendall(struct.pack('!L', len(block)) + block)
+        self.sock.sendall(struct.pack('!L', 0))
+        return self._reply()
+
+    def close(self):
+        try:
+            self.sock.sendall(b'zEND\0')
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ClamdPool:
+    """Pool of clamd sessions reused across scans."""
+
+    def __init__(self, address, size=4, timeout=60, stream_max_bytes=25 * 1024 * 1024):
+        self.address = address
+        self.timeout = timeout
+        self.stream_max_bytes = stream_max_bytes
+        self.idle = queue.LifoQueue(maxsize=size)
+        self._version = (None, 0.0)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            started = time.monotonic()
+            connection = ClamdConnection(self.address, self.timeout)
+            SCANNER_METRICS.observe('clamd_connect', time.monotonic() - started)
+            return connection
+
+    def _release(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _run(self, operation):
+        """Run `operation(connection)`, retrying once if a pooled session went stale."""
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                result = operation(connection)
+            except (OSError, ClamdError) as e:
+                connection.close()
+                if attempt:
+                    raise ClamdError(str(e))
+                continue
+            self._release(connection)
+            return result
+
+    def version(self):
+        """Signature database version (e.g. '27106'), refreshed every CLAMD_VERSION_TTL seconds."""
+        version, checked_at = self._version
+        if version is None or time.monotonic() - checked_at > CLAMD_VERSION_TTL:
+            # "ClamAV 1.0.3/27106/Mon Nov 20 09:33:39 2023"
+            reply = self._run(lambda connection: connection.command('VERSION'))
+            parts = reply.split('/')
+            version = parts[1] if len(parts) > 1 else parts[0]
+            self._version = (version, time.monotonic())
+        return version
+
+    def scan(self, file_path):
+        """
+        Stream a file to clamd, or have clamd read it by path when it is over
+        the INSTREAM size limit.
+        Returns: (is_safe: bool, message: str or None)
+
+        Raises:
+            FileNotScanned: if the file is too large to stream and clamd
+                cannot read it by path
+        """
+        def operation(connection):
+            with open(file_path, 'rb') as f:
+                return connection.instream(f)
+
+        reply = None
+        if os.path.getsize(file_path) <= self.stream_max_bytes:
+            reply = self._run(operation)
+            if CLAMD_STREAM_LIMIT_REPLY in reply:
+                reply = None
+        if reply is None:
+            SCANNER_METRICS.incr('clamav_path_scans')
+            reply = self._run(lambda connection: connection.command(f'SCAN {os.path.abspath(file_path)}'))
+            if reply.endswith('ERROR'):
+                raise FileNotScanned(f'ClamAV could not read {file_path}: {reply}')
+        # "<name>: OK", "<name>: Eicar-Signature FOUND" or "... ERROR" (name is 'stream' or the path)
+        if reply.endswith('FOUND'):
+            return False, f"Malware detected: {reply.rsplit(': ', 1)[-1][:-len(' FOUND')]}"
+        if reply.endswith('OK'):
+            return True, None
+        raise ClamdError(reply)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_clamd_pool = None
+_clamd_pool_lock = threading.Lock()
+
+
+def get_clamd_pool():
+    """Process-wide clamd pool built from security_config.json."""
+    global _clamd_pool
+    with _clamd_pool_lock:
+        if _clamd_pool is None:
+            config = SECURITY_CONFIG['malware_scanning']['clamav']
+            if config.get('host'):
+                address = (config['host'], config.get('port', 3310))
+            else:
+                address = config['socket_path']
+            _clamd_pool = ClamdPool(address, config.get('pool_size', 4), config.get('timeout_seconds', 60),
+                                    config.get('stream_max_mb', 25) * 1024 * 1024)
+        return _clamd_pool
+
+
+_vt_clients = threading.local()
+
+
+def _get_vt_client(api_key):
+    """VirusTotal client reused by every scan of the current thread."""
+    client = getattr(_vt_clients, 'client', None)
+    if client is None:
+        client = vt.Client(api_key)
+        _vt_clients.client = client
+    return client
+
+
+def _drop_vt_client():
+    client = getattr(_vt_clients, 'client', None)
+    _vt_clients.client = None
+    if client is not None:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+def _hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_with_virustotal(file_path, sha256=None):
     """
-    Scan file with VirusTotal API
+    Scan file with VirusTotal API (lookup by hash, upload if unknown)
+    Returns: ((is_safe, message), cacheable) - only known reports are cacheable
     """
     if not SECURITY_CONFIG['malware_scanning']['virustotal']['enabled']:
-        return True, None
-    
+        return (True, None), False
+
     api_key = getattr(settings, 'VIRUSTOTAL_API_KEY', None)
     if not api_key:
-        return True, None
-    
+        return (True, None), False
+
     try:
         # Check file size limit for VirusTotal
         file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
         max_size_mb = SECURITY_CONFIG['malware_scanning']['virustotal']['max_file_size_mb']
-        
+
         if file_size_mb > max_size_mb:
-            print(f"File too large for VirusTotal ({file_size_mb:.2f} MB > {max_size_mb} MB)")
-            return True, None
-        
-        client = vt.Client(api_key)
-        
-        # Calculate file hash
-        with open(file_path, 'rb') as f:
-            file_hash = hashlib.sha256(f.read()).hexdigest()
-        
+            logger.info(f"File too large for VirusTotal ({file_size_mb:.2f} MB > {max_size_mb} MB)")
+            return (True, None), False
+
+        client = _get_vt_client(api_key)
+        file_hash = sha256 or _hash_file(file_path)
+
         # Check if file was already scanned
+        started = time.monotonic()
         try:
             file_report = client.get_object(f"/files/{file_hash}")
-            stats = file_report.last_analysis_stats
-            
-            # If any engine detected malware, reject
-            if stats.get('malicious', 0) > 0:
-                client.close()
-                return False, f"Malware detected by {stats.get('malicious', 0)} engines"
-                
         except vt.APIError:
             # File not in VirusTotal database, upload for scanning
             with open(file_path, 'rb') as f:
-                analysis = client.scan_file(f)
-        
-        client.close()
-        return True, None
-        
+                client.scan_file(f)
+            return (True, None), False
+        finally:
+            SCANNER_METRICS.observe('virustotal', time.monotonic() - started)
+
+        stats = file_report.last_analysis_stats
+        # If any engine detected malware, reject
+        if stats.get('malicious', 0) > 0:
+            return (False, f"Malware detected by {stats.get('malicious', 0)} engines"), True
+        return (True, None), True
+
     except Exception as e:
-        print(f"VirusTotal scan error: {e}")
-        return True, None
+        _drop_vt_client()
+        SCANNER_METRICS.incr('virustotal_errors')
+        logger.error(f"VirusTotal scan error: {e}")
+        return (True, None), False
+
 
 def scan_with_clamav(file_path):
     """
-    Scan file with ClamAV
+    Scan file with ClamAV (pooled clamd sessions, content sent with INSTREAM)
+    Returns: ((is_safe, message), cacheable)
+
+    Raises:
+        FileNotScanned: the file could not be scanned; the processing job is
+            retried and the file stays pending_scan meanwhile
     """
     if not SECURITY_CONFIG['malware_scanning']['clamav']['enabled']:
-        return True, None
-    
+        return (True, None), False
+
+    started = time.monotonic()
     try:
-        import pyclamd
-        
-        # Try to connect to ClamAV daemon
-        socket_path = SECURITY_CONFIG['malware_scanning']['clamav']['socket_path']
-        
-        # Try Unix socket first
+        verdict = get_clamd_pool().scan(file_path)
+    except (OSError, ClamdError) as e:
+        SCANNER_METRICS.incr('clamav_errors')
+        logger.error(f"ClamAV scan error: {e}")
+        return (True, None), False
+    SCANNER_METRICS.observe('clamav', time.monotonic() - started)
+    return verdict, True
+
+
+def _verdict_cache_key(scanner, sha256):
+    if scanner == 'clamav':
+        # Signature updates change the key, so older verdicts are not reused
         try:
-            cd = pyclamd.ClamdUnixSocket(socket_path)
-        except:
-            # Fallback to network socket
-            cd = pyclamd.ClamdNetworkSocket()
-        
-        # Ping to check if ClamAV is running
-        if not cd.ping():
-            print("ClamAV daemon not running")
-            return True, None
-        
-        # Scan file
-        scan_result = cd.scan_file(file_path)
-        
-        if scan_result:
-            # scan_result is a dict: {filename: ('FOUND', 'virus_name')}
-            for filename, (status, virus_name) in scan_result.items():
-                if status == 'FOUND':
-                    return False, f"Malware detected: {virus_name}"
-        
-        return True, None
-        
-    except ImportError:
-        print("pyclamd not installed, skipping ClamAV scan")
-        return True, None
-    except Exception as e:
-        print(f"ClamAV scan error: {e}")
-        return True, None
+            version = get_clamd_pool().version()
+        except (OSError, ClamdError):
+            return None
+        return f'{VERDICT_CACHE_PREFIX}:clamav:{version}:{sha256}'
+    return f'{VERDICT_CACHE_PREFIX}:{scanner}:{sha256}'
 
-def scan_file_for_malware(file_path):
+
+def scan_file_for_malware(file_path, sha256=None):
     """
-    Scan file for malware using configured scanner
+    Scan file for malware using configured scanner, reusing cached verdicts
+    of the same content
     Returns: (is_safe: bool, message: str or None)
     """
     if not SECURITY_CONFIG['malware_scanning']['enabled']:
         return True, None
-    
+
     scanner = SECURITY_CONFIG['malware_scanning']['scanner']
-    
+    if scanner not in ('virustotal', 'clamav'):
+        logger.warning(f"Unknown scanner: {scanner}")
+        return True, None
+
+    sha256 = sha256 or _hash_file(file_path)
+    key = _verdict_cache_key(scanner, sha256)
+    if key is not None:
+        started = time.monotonic()
+        cached = cache.get(key)
+        SCANNER_METRICS.observe('verdict_cache', time.monotonic() - started)
+        if cached is not None:
+            SCANNER_METRICS.incr('verdict_cache_hits')
+            return tuple(cached)
+        SCANNER_METRICS.incr('verdict_cache_misses')
+
     if scanner == 'virustotal':
-        return scan_with_virustotal(file_path)
-    elif scanner == 'clamav':
-        return scan_with_clamav(file_path)
+        verdict, cacheable = scan_with_virustotal(file_path, sha256)
     else:
-        print(f"Unknown scanner: {scanner}")
-        return True, None
+        verdict, cacheable = scan_with_clamav(file_path)
+
+    if cacheable and key is not None:
+        cache.set(key, list(verdict), VERDICT_CACHE_TTL)
+    return verdict
@@ -1,6 +1,7 @@
 from rest_framework import serializers
-from .models import FileTransfer, Folder, FileAccess, FolderAccess, ShareLink
+from .models import FileTransfer, Folder, FileAccess, FolderAccess, ShareLink, UploadSession
 from django.contrib.auth.models import User
+from .access_utils import accessible_file_ids, permission_resolver
 import os
 import re
 import logging
@@ -60,15 +61,16 @@ def validate_filename(filename):
     
     return filename
 
-def validate_file(value):
+def validate_upload_metadata(filename, size):
     """
-    Validate file type and size
+    Validate file type and size from its name and declared size.
+    Shared by regular uploads and chunked upload sessions.
     """
     # Get file extension
-    ext = os.path.splitext(value.name)[1].lower()
+    ext = os.path.splitext(filename)[1].lower()
     
     # DEBUG: Log validation info
-    logger.debug(f"[FILE_UPLOAD] Validating file: {value.name}")
+    logger.debug(f"[FILE_UPLOAD] Validating file: {filename}")
     logger.debug(f"[FILE_UPLOAD] Extracted extension: '{ext}'")
     logger.debug(f"[FILE_UPLOAD] Allowed extensions count: {len(ALLOWED_EXTENSIONS)}")
     logger.debug(f"[FILE_UPLOAD] Extension in allowed list: {ext in ALLOWED_EXTENSIONS}")
@@ -92,18 +94,25 @@ def validate_file(value):
     
     # Validate file size
     max_size_gb = SECURITY_CONFIG['file_validation']['max_file_size_gb']
-    if value.size > MAX_FILE_SIZE:
-        size_gb = value.size / (1024 * 1024 * 1024)
+    if size > MAX_FILE_SIZE:
+        size_gb = size / (1024 * 1024 * 1024)
         raise serializers.ValidationError(
             f'El archivo es demasiado grande ({size_gb:.2f} GB). '
             f'Tamaño máximo: {max_size_gb} GB'
         )
     
     # Validate filename
-    validate_filename(value.name)
+    validate_filename(filename)
     
     # Log success
-    logger.info(f"File validation successful: {value.name} ({value.size} bytes)")
+    logger.info(f"File validation successful: {filename} ({size} bytes)")
+
+
+def validate_file(value):
+    """
+    Validate file type and size
+    """
+    validate_upload_metadata(value.name, value.size)
     return value
 
 class FolderAccessSerializer(serializers.ModelSerializer):
@@ -135,6 +144,12 @@ class FolderSerializer(serializers.ModelSerializer):
         validated_data['owner'] = self.context['request'].user
         return super().create(validated_data)
 
+    def validate_parent(self, parent):
+        # Una carpeta no puede moverse dentro de sí misma ni de una de sus subcarpetas
+        if parent and self.instance and self.instance.path and parent.path.startswith(self.instance.path):
+            raise serializers.ValidationError('No se puede mover una carpeta dentro de sí misma')
+        return parent
+
     def get_has_new_content(self, obj):
         # Use prefetched data if available (set by FolderViewSet.get_queryset)
         if hasattr(obj, 'unviewed_files_for_user'):
@@ -145,17 +160,10 @@ class FolderSerializer(serializers.ModelSerializer):
         if not request or not request.user.is_authenticated:
             return False
             
-        user = request.user
-        from django.db.models import Q
-        
         return FileTransfer.objects.filter(
-            folder=obj, 
-            is_viewed=False
-        ).filter(
-            Q(owner=user) | 
-            Q(uploader=user) | 
-            Q(access_list__granted_to=user) |
-            Q(folder__access_list__granted_to=user)
+            folder=obj,
+            is_viewed=False,
+            id__in=accessible_file_ids(request.user, permission_resolver(request).folder_grants())
         ).exists()
 
 
@@ -172,6 +180,17 @@ class FileAccessSerializer(serializers.ModelSerializer):
         read_only_fields = ['file', 'granted_by', 'created_at']
 
 
+class FileTransferListSerializer(serializers.ListSerializer):
+    """Resolves the permissions of the whole page at once before serializing each file"""
+
+    def to_representation(self, data):
+        request = self.context.get('request')
+        files = list(data.all() if hasattr(data, 'all') else data)
+        if request and hasattr(request, 'user'):
+            permission_resolver(request).file_permissions(files)
+        return super().to_representation(files)
+
+
 class FileTransferSerializer(serializers.ModelSerializer):
     uploader_username = serializers.ReadOnlyField(source='uploader.username')
     owner_username = serializers.ReadOnlyField(source='owner.username')
@@ -191,28 +210,22 @@ class FileTransferSerializer(serializers.ModelSerializer):
             'id', 'uploader', 'uploader_username', 'owner', 'owner_username', 'recipient_username',
             'file', 'filename', 'size', 'description', 'folder',
             'created_at', 'expires_at', 'is_downloaded', 'is_viewed',
-            'has_executables', 'executable_files', 'access_list', 'has_access', 'has_thumbnail'
+            'has_executables', 'executable_files', 'access_list', 'has_access', 'has_thumbnail',
+            'processing_status'
         ]
         read_only_fields = [
             'uploader', 'uploader_username', 'owner_username', 'size',
             'created_at', 'is_downloaded', 'is_viewed',
-            'has_executables', 'executable_files', 'access_list', 'has_access', 'has_thumbnail'
+            'has_executables', 'executable_files', 'access_list', 'has_access', 'has_thumbnail',
+            'processing_status'
         ]
+        list_serializer_class = FileTransferListSerializer
 
     def get_has_access(self, obj):
         request = self.context.get('request')
         if not request or not hasattr(request, 'user'):
             return False
-        user = request.user
-        if user.is_anonymous:
-            return False
-        if obj.owner_id == user.id or obj.uploader_id == user.id:
-            return True
-        if obj.access_list.filter(granted_to=user).exists():
-            return True
-        if obj.folder and obj.folder.access_list.filter(granted_to=user).exists():
-            return True
-        return False
+        return permission_resolver(request).has_file_access(obj)
 
     def get_has_thumbnail(self, obj):
         return bool(obj.thumbnail)
@@ -251,6 +264,70 @@ class FileTransferSerializer(serializers.ModelSerializer):
         return instance
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Serializer para sesiones de subida por fragmentos.
+    Valida nombre y tamaño declarados antes de recibir ningún byte.
+    """
+    folder = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.all(), required=False, allow_null=True)
+    owner = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), required=False, allow_null=True)
+    size = serializers.IntegerField(min_value=0)
+    total_chunks = serializers.ReadOnlyField()
+    received_bytes = serializers.ReadOnlyField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id', 'filename', 'size', 'description', 'folder', 'owner',
+            'chunk_size', 'total_chunks', 'received_chunks', 'received_bytes',
+            'status', 'file_transfer', 'created_at', 'expires_at'
+        ]
+        read_only_fields = [
+            'id', 'chunk_size', 'total_chunks', 'received_chunks', 'received_bytes',
+            'status', 'file_transfer', 'created_at', 'expires_at'
+        ]
+
+    def validate(self, attrs):
+        try:
+            validate_upload_metadata(attrs['filename'], attrs['size'])
+        except serializers.ValidationError as e:
+            detail = e.detail if isinstance(e.detail, dict) else {'file': e.detail}
+            raise serializers.ValidationError(detail)
+        return attrs
+
+
+class UploadPreflightSerializer(serializers.Serializer):
+    """
+    Serializer para la pre-admisión de una subida.
+    Valida nombre y tamaño declarados igual que una subida normal.
+    """
+    size = serializers.IntegerField(min_value=0)
+    filename = serializers.CharField(max_length=255)
+    folder = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.all(), required=False, allow_null=True)
+    owner = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), required=False, allow_null=True)
+
+    def validate(self, attrs):
+        try:
+            validate_upload_metadata(attrs['filename'], attrs['size'])
+        except serializers.ValidationError as e:
+            detail = e.detail if isinstance(e.detail, dict) else {'file': e.detail}
+            raise serializers.ValidationError(detail)
+        return attrs
+
+
+class BlobClaimSerializer(UploadPreflightSerializer):
+    """
+    Serializer para la subida instantánea por hash.
+    Valida nombre y tamaño igual que una subida normal; el contenido se
+    identifica por su SHA-256.
+    """
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+
+    def validate_sha256(self, value):
+        return value.lower()
+
+
 class ShareLinkSerializer(serializers.ModelSerializer):
     """
     Serializer para enlaces compartidos.
@@ -0,0 +1,119 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .archive_cache_utils import invalidate_folder_archives, remove_folder_cache
+from .blob_utils import release_blob
+from .etag_utils import bump_change_counters, file_audience, folder_audience
+from .models import FileAccess, FileTransfer, Folder, FolderAccess
+
+# Fields that change what a folder archive contains
+ARCHIVE_FIELDS = {'file', 'filename', 'folder', 'name', 'parent'}
+
+
+def _changes_archive(update_fields) -> bool:
+    return update_fields is None or bool(ARCHIVE_FIELDS.intersection(update_fields))
+
+
+@receiver(pre_save, sender=FileTransfer)
+def invalidate_archives_on_file_move(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or not _changes_archive(update_fields):
+        return
+    old_folder_id = FileTransfer.objects.filter(pk=instance.pk).values_list('folder_id', flat=True).first()
+    if old_folder_id and old_folder_id != instance.folder_id:
+        invalidate_folder_archives(old_folder_id)
+
+
+@receiver(post_save, sender=FileTransfer)
+@receiver(post_delete, sender=FileTransfer)
+def invalidate_archives_on_file_change(sender, instance, update_fields=None, **kwargs):
+    if instance.folder_id and _changes_archive(update_fields):
+        invalidate_folder_archives(instance.folder_id)
+
+
+@receiver(post_delete, sender=FileTransfer)
+def release_file_storage(sender, instance, **kwargs):
+    if instance.blob_id:
+        # Shared content: drop the reference, purge_orphan_blobs deletes the bytes
+        release_blob(instance.blob_id)
+    elif instance.file:
+        # Files stored before the blob store own their path
+        instance.file.delete(save=False)
+
+
+@receiver(pre_save, sender=Folder)
+def invalidate_archives_on_folder_move(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or not _changes_archive(update_fields):
+        return
+    old_parent_id = Folder.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first()
+    if old_parent_id and old_parent_id != instance.parent_id:
+        invalidate_folder_archives(old_parent_id)
+
+
+@receiver(post_save, sender=Folder)
+def invalidate_archives_on_folder_change(sender, instance, created, update_fields=None, **kwargs):
+    if not created and _changes_archive(update_fields):
+        invalidate_folder_archives(instance.pk)
+    elif created and instance.parent_id:
+        invalidate_folder_archives(instance.parent_id)
+
+
+@receiver(post_delete, sender=Folder)
+def remove_archives_on_folder_delete(sender, instance, **kwargs):
+    remove_folder_cache(instance.pk)
+    if instance.parent_id:
+        invalidate_folder_archives(instance.parent_id)
+
+
+# Listing ETags: bump the change counter of everyone who may list the changed row
+
+@receiver(pre_save, sender=FileTransfer)
+def touch_listings_on_file_move(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and 'folder' not in update_fields and 'owner' not in update_fields):
+        return
+    old = FileTransfer.objects.filter(pk=instance.pk).values_list('folder_id', 'owner_id').first()
+    if old and old != (instance.folder_id, instance.owner_id):
+        # Those who saw it in its previous place
+        bump_change_counters(file_audience([instance.pk]))
+
+
+@receiver(post_save, sender=FileTransfer)
+def touch_listings_on_file_change(sender, instance, **kwargs):
+    bump_change_counters(file_audience([instance.pk]))
+
+
+@receiver(post_delete, sender=FileTransfer)
+def touch_listings_on_file_delete(sender, instance, **kwargs):
+    # The row and its accesses are gone (each access bumped its grantee)
+    bump_change_counters({instance.owner_id, instance.uploader_id} | folder_audience([instance.folder_id]))
+
+
+@receiver(pre_save, sender=Folder)
+def touch_listings_on_folder_move(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and 'parent' not in update_fields):
+        return
+    old_parent_id = Folder.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first()
+    if old_parent_id != instance.parent_id:
+        bump_change_counters(folder_audience([instance.pk]))
+
+
+@receiver(post_save, sender=Folder)
+def touch_listings_on_folder_change(sender, instance, **kwargs):
+    # The path of a new or moved folder is written after this signal: reach its ancestors through the parent
+    bump_change_counters(folder_audience([instance.pk, instance.parent_id]))
+
+
+@receiver(post_delete, sender=Folder)
+def touch_listings_on_folder_delete(sender, instance, **kwargs):
+    bump_change_counters({instance.owner_id, instance.uploader_id} | folder_audience([instance.parent_id]))
+
+
+@receiver(post_save, sender=FileAccess)
+@receiver(post_delete, sender=FileAccess)
+def touch_listings_on_file_access(sender, instance, **kwargs):
+    bump_change_counters({instance.granted_to_id} | file_audience([instance.file_id]))
+
+
+@receiver(post_save, sender=FolderAccess)
+@receiver(post_delete, sender=FolderAccess)
+def touch_listings_on_folder_access(sender, instance, **kwargs):
+    bump_change_counters({instance.granted_to_id} | folder_audience([instance.folder_id]))
@@ -1,3 +1,1058 @@
-from django.test import TestCase
+import os
+import time
+import io
+import importlib
+import fcntl
+import shutil
+import socket
+import struct
+import tarfile
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from unittest import mock
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from . import archive_cache_utils, archive_utils, blob_utils, download_utils, preview_utils, processing_utils, security_utils, upload_utils
+from . import access_utils
+from .access_utils import (
+    PERMISSION_EDIT,
+    PERMISSION_NONE,
+    PERMISSION_READ,
+    PermissionResolver,
+    accessible_file_ids,
+    accessible_files,
+    accessible_folder_ids,
+    accessible_folders,
+)
+from .management.commands.benchmark_access_queries import _scans_table
+from .security_utils import SNIFF_BYTES, ClamdError, ClamdPool, FileNotScanned, sniff_content_mismatch
+from .models import Blob, FileAccess, FileTransfer, Folder, FolderAccess, ProcessingJob, UploadSession
+from .thumbnail_utils import rendition_dir
 
-# Create your tests here.
+
+class TemporaryMediaMixin:
+    """Run each test with an empty MEDIA_ROOT."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class ArchiveCacheLockTests(TemporaryMediaMixin, TestCase):
+    """Lock and partial files of the on-disk archive cache."""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = archive_cache_utils._folder_cache_dir(1)
+        os.makedirs(self.directory)
+
+    def _write(self, name, size=10, age=0):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if age:
+            past = time.time() - age
+            os.utime(path, (past, past))
+        return path
+
+    def test_invalidation_keeps_lock_and_partial_files(self):
+        archive = self._write('key.zip')
+        part = self._write('other.part')
+        lock = self._write('other.lock', size=0)
+        archive_cache_utils.invalidate_folder_archives(1)
+        self.assertFalse(os.path.exists(archive))
+        self.assertTrue(os.path.exists(part))
+        self.assertTrue(os.path.exists(lock))
+
+    def test_lock_replaced_after_open_is_not_taken(self):
+        lock = self._write('key.lock', size=0)
+        stale_fd = os.open(lock, os.O_RDWR)
+        self.addCleanup(os.close, stale_fd)
+        os.remove(lock)
+        fd = archive_cache_utils._try_lock(lock, fcntl.LOCK_EX)
+        self.addCleanup(os.close, fd)
+        self.assertEqual(os.fstat(fd).st_ino, os.stat(lock).st_ino)
+        self.assertNotEqual(os.fstat(fd).st_ino, os.fstat(stale_fd).st_ino)
+
+    def test_eviction_reaps_stale_unlocked_partial_files(self):
+        part = self._write('dead.part', age=2 * archive_cache_utils.ARCHIVE_CACHE_STALE_SECONDS)
+        lock = self._write('dead.lock', size=0, age=2 * archive_cache_utils.ARCHIVE_CACHE_STALE_SECONDS)
+        unused_lock = self._write('old.lock', size=0, age=2 * archive_cache_utils.ARCHIVE_CACHE_STALE_SECONDS)
+        archive_cache_utils.evict_archives()
+        self.assertFalse(os.path.exists(part))
+        self.assertFalse(os.path.exists(lock))
+        self.assertFalse(os.path.exists(unused_lock))
+
+    def test_eviction_keeps_partial_files_of_running_builds(self):
+        part = self._write('busy.part', age=2 * archive_cache_utils.ARCHIVE_CACHE_STALE_SECONDS)
+        lock_fd = archive_cache_utils._try_lock(os.path.join(self.directory, 'busy.lock'), fcntl.LOCK_EX)
+        self.addCleanup(os.close, lock_fd)
+        archive_cache_utils.evict_archives()
+        self.assertTrue(os.path.exists(part))
+
+    def test_partial_files_count_against_the_budget(self):
+        archive = self._write('key.zip', size=60)
+        self._write('busy.part', size=60)
+        with mock.patch.object(archive_cache_utils, 'ARCHIVE_CACHE_MAX_BYTES', 100):
+            archive_cache_utils.evict_archives()
+        self.assertFalse(os.path.exists(archive))
+
+
+class ProcessingLeaseTests(TestCase):
+    """Leases of running post-upload jobs."""
+
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        instance = FileTransfer.objects.create(owner=owner, uploader=owner, file='x/a.bin', filename='a.bin', size=1)
+        self.job = ProcessingJob.objects.create(file_transfer=instance, run_after=timezone.now())
+        self.assertTrue(processing_utils.claim_job(self.job))
+
+    def _age_lease(self, seconds):
+        ProcessingJob.objects.filter(id=self.job.id).update(locked_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_renewed_job_is_not_requeued(self):
+        self._age_lease(processing_utils.PROCESSING_LEASE_SECONDS * 2)
+        self.assertTrue(processing_utils.renew_lease(self.job))
+        self.assertEqual(processing_utils.requeue_stale_jobs(), 0)
+
+    def test_expired_lease_is_requeued_and_cannot_be_renewed(self):
+        self._age_lease(processing_utils.PROCESSING_LEASE_SECONDS * 2)
+        self.assertEqual(processing_utils.requeue_stale_jobs(), 1)
+        self.assertFalse(processing_utils.renew_lease(self.job))
+
+    def test_lease_of_a_previous_claim_is_not_renewed(self):
+        self._age_lease(processing_utils.PROCESSING_LEASE_SECONDS * 2)
+        processing_utils.requeue_stale_jobs()
+        reclaimed = ProcessingJob.objects.get(id=self.job.id)
+        self.assertTrue(processing_utils.claim_job(reclaimed))
+        self.assertFalse(processing_utils.renew_lease(self.job))
+        self.assertTrue(processing_utils.renew_lease(reclaimed))
+
+
+class OnDemandPreviewTests(TestCase):
+    """Missing previews queued for the worker by the thumbnail endpoints."""
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.blob = Blob.objects.create(sha256='a' * 64, file='blobs/a', size=1, ref_count=2)
+
+    def _file(self, blob=None, filename='a.jpg'):
+        return FileTransfer.objects.create(
+            owner=self.owner, uploader=self.owner, file='x/' + filename, filename=filename, size=1,
+            blob=blob, processing_status=FileTransfer.ProcessingStatus.CLEAN
+        )
+
+    def _thumbnail_jobs(self):
+        return ProcessingJob.objects.filter(stage=ProcessingJob.Stage.THUMBNAIL)
+
+    def test_preview_is_queued_once(self):
+        instance = self._file()
+        self.assertEqual(preview_utils.request_preview(instance), preview_utils.PREVIEW_PENDING)
+        self.assertEqual(preview_utils.request_preview(instance), preview_utils.PREVIEW_PENDING)
+        self.assertEqual(self._thumbnail_jobs().count(), 1)
+
+    def test_duplicates_share_one_job(self):
+        first, second = self._file(self.blob), self._file(self.blob, 'b.jpg')
+        preview_utils.request_preview(first)
+        self.assertEqual(preview_utils.request_preview(second), preview_utils.PREVIEW_PENDING)
+        self.assertEqual(self._thumbnail_jobs().get().file_transfer_id, first.id)
+
+    def test_failed_preview_is_not_queued_again_until_it_expires(self):
+        instance = self._file()
+        preview_utils.request_preview(instance)
+        self._thumbnail_jobs().update(status=ProcessingJob.Status.FAILED)
+        self.assertEqual(preview_utils.request_preview(instance), preview_utils.PREVIEW_FAILED)
+        self._thumbnail_jobs().update(
+            updated_at=timezone.now() - timedelta(seconds=2 * preview_utils.THUMBNAIL_FAILURE_TTL)
+        )
+        self.assertEqual(preview_utils.request_preview(instance), preview_utils.PREVIEW_PENDING)
+        self.assertEqual(self._thumbnail_jobs().count(), 2)
+
+    def test_content_without_preview_fails_the_job(self):
+        instance = self._file()
+        preview_utils.request_preview(instance)
+        job = self._thumbnail_jobs().get()
+        self.assertTrue(processing_utils.claim_job(job))
+        with mock.patch.object(processing_utils, 'generate_thumbnail', return_value=None):
+            self.assertFalse(processing_utils.run_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.Status.FAILED)
+        self.assertEqual(job.attempts, 1)
+
+
+class ContentSniffingTests(TestCase):
+    """Leading bytes of uploads checked against their extension."""
+
+    def _tar(self, format):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w', format=format) as archive:
+            info = tarfile.TarInfo('a.txt')
+            info.size = 3
+            archive.addfile(info, io.BytesIO(b'abc'))
+        return buffer.getvalue()[:SNIFF_BYTES]
+
+    def assertAccepted(self, filename, head):
+        self.assertIsNone(sniff_content_mismatch(filename, head))
+
+    def assertRejected(self, filename, head):
+        self.assertIsNotNone(sniff_content_mismatch(filename, head))
+
+    def test_tar_with_and_without_ustar_magic(self):
+        self.assertAccepted('a.tar', self._tar(tarfile.GNU_FORMAT))
+        v7 = bytearray(self._tar(tarfile.GNU_FORMAT))
+        # Same header as a pre-POSIX tar: no magic/version, checksum recomputed
+        v7[257:265] = b'\x00' * 8
+        v7[148:156] = b' ' * 8
+        v7[148:156] = b'%06o\x00 ' % sum(v7[:512])
+        self.assertAccepted('a.tar', bytes(v7))
+        v7[0] ^= 0xFF
+        self.assertRejected('a.tar', bytes(v7))
+
+    def test_mpeg_audio_frame_sync(self):
+        for head in (b'ID3\x04', b'\xff\xfb\x90', b'\xff\xe3\x18', b'\xff\xe2\x18', b'\xff\xf3\x40'):
+            self.assertAccepted('a.mp3', head + b'\x00' * 16)
+        self.assertRejected('a.mp3', b'\xff\xd8\xff\xe0' + b'\x00' * 16)
+
+    def test_spanned_zip(self):
+        self.assertAccepted('a.zip', b'PK\x07\x08PK\x03\x04' + b'\x00' * 16)
+
+    def test_office_documents_saved_as_markup(self):
+        self.assertAccepted('a.doc', b'{\\rtf1\\ansi')
+        self.assertAccepted('a.xls', b'\xef\xbb\xbf<?xml version="1.0"?><Workbook>')
+        self.assertAccepted('a.xls', b'\r\n<HTML xmlns:o="urn:schemas-microsoft-com:office:office">')
+        self.assertRejected('a.doc', b'%PDF-1.7')
+
+    def test_windows_executables(self):
+        pe = bytearray(b'MZ' + b'\x00' * 510)
+        pe[60:64] = (128).to_bytes(4, 'little')
+        pe[128:132] = b'PE\x00\x00'
+        self.assertRejected('a.jpg', bytes(pe))
+        # 'MZ' text whose pointer leads past the sniffed bytes is not a PE
+        text = b'MZ' + b'a' * 58 + (3000).to_bytes(4, 'little') + b'b' * 100
+        self.assertIsNone(sniff_content_mismatch('a.txt', text))
+
+
+class BlobStoreTests(TemporaryMediaMixin, TestCase):
+    """Content-addressed storage of uploads."""
+
+    def _source(self, content=b'same bytes', name='upload.part'):
+        path = os.path.join(self.media_root, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _blob_files(self):
+        blobs = os.path.join(self.media_root, 'blobs')
+        return sorted(name for _root, _dirs, names in os.walk(blobs) for name in names)
+
+    def test_losing_a_concurrent_first_insert_leaves_no_file(self):
+        sha256 = blob_utils.store_blob(self._source(name='first.part'), 'video.mp4').sha256
+        source = self._source(name='second.part')
+        # The loser did not see the winner's row yet: its insert fails
+        with mock.patch.object(Blob.objects, 'select_for_update') as unseen:
+            unseen.return_value.filter.return_value.first.return_value = None
+            with self.assertRaises(IntegrityError):
+                blob_utils._claim_blob(source, 'video.mov', sha256, 10)
+        self.assertTrue(os.path.exists(source))
+
+        blob = blob_utils.store_blob(source, 'video.mov', sha256)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(self._blob_files(), [f'{sha256}.mp4'])
+
+    def _file(self, blob):
+        user, _created = User.objects.get_or_create(username='owner')
+        transfer = FileTransfer(owner=user, uploader=user, blob=blob, filename='a.txt', size=blob.size)
+        transfer.file.name = blob.file.name
+        transfer.save()
+        return transfer
+
+    def _orphan(self, blob, minutes_ago):
+        Blob.objects.filter(id=blob.id).update(ref_count=0, orphaned_at=timezone.now() - timedelta(minutes=minutes_ago))
+
+    def _renditions(self, blob):
+        path = default_storage.path(rendition_dir(blob.sha256))
+        os.makedirs(path)
+        with open(os.path.join(path, '400.webp'), 'wb') as f:
+            f.write(b'webp')
+        return path
+
+    def test_same_content_takes_a_reference(self):
+        first = blob_utils.store_blob(self._source(name='first.part'), 'a.txt')
+        source = self._source(name='second.part')
+        second = blob_utils.store_blob(source, 'b.txt')
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(second.ref_count, 2)
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(self._blob_files(), [f'{first.sha256}.txt'])
+
+    def test_deleting_files_releases_the_blob(self):
+        blob = blob_utils.store_blob(self._source(), 'a.txt')
+        blob_utils.add_blob_reference(blob.id)
+        first, second = self._file(blob), self._file(blob)
+
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual((blob.ref_count, blob.orphaned_at), (1, None))
+
+        second.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertIsNotNone(blob.orphaned_at)
+        # The bytes stay until the orphan collector runs
+        self.assertTrue(os.path.exists(blob.file.path))
+
+    def test_purge_removes_orphans_and_their_renditions(self):
+        orphan = blob_utils.store_blob(self._source(b'orphan', 'orphan.part'), 'a.txt')
+        recent = blob_utils.store_blob(self._source(b'recent', 'recent.part'), 'b.txt')
+        referenced = blob_utils.store_blob(self._source(b'referenced', 'referenced.part'), 'c.txt')
+        self._orphan(orphan, 120)
+        self._orphan(recent, 5)
+        renditions = self._renditions(orphan)
+        orphan_path = orphan.file.path
+
+        self.assertEqual(blob_utils.purge_orphan_blobs(grace_minutes=60, dry_run=True), (1, orphan.size))
+        self.assertTrue(os.path.exists(orphan_path))
+
+        self.assertEqual(blob_utils.purge_orphan_blobs(grace_minutes=60), (1, orphan.size))
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertFalse(os.path.exists(renditions))
+        self.assertFalse(Blob.objects.filter(id=orphan.id).exists())
+        self.assertEqual(
+            sorted(Blob.objects.values_list('id', flat=True)), sorted([recent.id, referenced.id])
+        )
+        self.assertEqual(self._blob_files(), sorted([f'{recent.sha256}.txt', f'{referenced.sha256}.txt']))
+
+    def test_purge_skips_blobs_claimed_again(self):
+        blob = blob_utils.store_blob(self._source(), 'a.txt')
+        self._orphan(blob, 120)
+        self.assertEqual(blob_utils.add_blob_reference(blob.id).ref_count, 1)
+        self.assertEqual(blob_utils.purge_orphan_blobs(grace_minutes=60), (0, 0))
+        self.assertTrue(os.path.exists(blob.file.path))
+
+
+class BlobClaimTests(TemporaryMediaMixin, TestCase):
+    """Instant uploads of content the server already stores."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = User.objects.create(username='owner')
+        self.user = User.objects.create(username='claimer', is_staff=True)
+        path = os.path.join(self.media_root, 'upload.part')
+        with open(path, 'wb') as f:
+            f.write(b'private bytes')
+        self.blob = blob_utils.store_blob(path, 'secret.txt')
+        self.source = FileTransfer(owner=self.owner, uploader=self.owner, blob=self.blob,
+                                   filename='secret.txt', size=self.blob.size)
+        self.source.file.name = self.blob.file.name
+        self.source.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _claim(self, size=None):
+        cache.delete(f'upload_limit_{self.user.id}')
+        return self.client.post('/api/transfers/claim/', {
+            'sha256': self.blob.sha256, 'size': self.blob.size if size is None else size, 'filename': 'copy.txt',
+        }, format='json')
+
+    def _ref_count(self):
+        self.blob.refresh_from_db()
+        return self.blob.ref_count
+
+    def test_content_of_inaccessible_files_is_not_claimed(self):
+        response = self._claim()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['error'], 'content_not_found')
+        self.assertEqual(self._ref_count(), 1)
+        self.assertFalse(FileTransfer.objects.filter(owner=self.user).exists())
+
+    def test_content_of_shared_files_is_claimed(self):
+        FileAccess.objects.create(file=self.source, granted_to=self.user, granted_by=self.owner)
+        self.assertEqual(self._claim(size=self.blob.size + 1).status_code, 404)
+
+        response = self._claim()
+        self.assertEqual(response.status_code, 201)
+        claimed = FileTransfer.objects.get(id=response.data['id'])
+        self.assertEqual((claimed.owner, claimed.blob_id, claimed.filename), (self.user, self.blob.id, 'copy.txt'))
+        self.assertEqual(self._ref_count(), 2)
+
+    def test_content_of_files_in_shared_folders_is_claimed(self):
+        folder = Folder.objects.create(name='shared', owner=self.owner, uploader=self.owner)
+        self.source.folder = folder
+        self.source.save()
+        FolderAccess.objects.create(folder=folder, granted_to=self.user, granted_by=self.owner)
+        self.assertEqual(self._claim().status_code, 201)
+        self.assertEqual(self._ref_count(), 2)
+
+
+class UploadSessionFinalizeTests(TemporaryMediaMixin, TestCase):
+    """Completion of chunked upload sessions."""
+
+    def setUp(self):
+        super().setUp()
+        uploader = User.objects.create(username='uploader')
+        self.session = UploadSession.objects.create(
+            uploader=uploader, filename='a.bin', size=10, chunk_size=5, received_chunks=2,
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        self.part_path = upload_utils.create_part_file(self.session)
+
+    def _write(self, content):
+        with open(self.part_path, 'wb') as f:
+            f.write(content)
+
+    def test_complete_file(self):
+        self._write(b'0123456789')
+        self.assertEqual(upload_utils.finalize_part_file(self.session), self.part_path)
+
+    def test_short_file_is_not_padded(self):
+        self._write(b'01234')
+        with self.assertRaises(upload_utils.ChunkLengthMismatch):
+            upload_utils.finalize_part_file(self.session)
+        self.assertEqual(os.path.getsize(self.part_path), 5)
+
+    def test_missing_chunks_are_rejected(self):
+        self._write(b'0123456789')
+        self.session.received_chunks = 1
+        with self.assertRaises(upload_utils.ChunkLengthMismatch):
+            upload_utils.finalize_part_file(self.session)
+
+    def test_trailing_bytes_are_cut(self):
+        self._write(b'0123456789extra')
+        upload_utils.finalize_part_file(self.session)
+        self.assertEqual(os.path.getsize(self.part_path), 10)
+
+
+class UploadTicketTests(TemporaryMediaMixin, TestCase):
+    """Pre-flight admission tickets of regular uploads."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create(username='uploader', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _preflight(self, filename='a.txt', size=5):
+        cache.delete(f'upload_limit_{self.user.id}')
+        return self.client.post('/api/transfers/preflight/', {'filename': filename, 'size': size}, format='json')
+
+    def _upload(self, ticket=None, filename='a.txt', data=b'12345'):
+        cache.delete(f'upload_limit_{self.user.id}')
+        headers = {'HTTP_X_UPLOAD_TICKET': ticket} if ticket else {}
+        return self.client.post('/api/transfers/', {'file': SimpleUploadedFile(filename, data), 'filename': filename},
+                                format='multipart', **headers)
+
+    def test_ticket_is_optional_by_default(self):
+        self.assertEqual(self._upload().status_code, 201)
+
+    def test_ticket_required(self):
+        with mock.patch.object(upload_utils, 'UPLOAD_TICKET_REQUIRED', True):
+            self.assertEqual(self._upload().status_code, 400)
+            self.assertEqual(self._upload(self._preflight().data['ticket']).status_code, 201)
+
+    def test_ticket_is_used_once_and_only_for_its_file(self):
+        ticket = self._preflight().data['ticket']
+        self.assertEqual(self._upload(ticket, filename='b.txt').status_code, 400)
+        ticket = self._preflight().data['ticket']
+        self.assertEqual(self._upload(ticket).status_code, 201)
+        self.assertEqual(self._upload(ticket).status_code, 400)
+
+    def test_tampered_or_oversized_ticket_is_rejected(self):
+        ticket = self._preflight(size=2).data['ticket']
+        self.assertEqual(self._upload(ticket).status_code, 400)
+        self.assertEqual(self._upload(ticket[:-2] + 'xx').status_code, 400)
+
+    def test_parallel_tickets_cannot_exceed_the_quota_together(self):
+        with mock.patch.object(upload_utils, 'USER_QUOTA_BYTES', 8):
+            first = self._preflight().data['ticket']
+            second = self._preflight().data['ticket']
+            self.assertEqual(self._upload(first).status_code, 201)
+            response = self._upload(second)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(FileTransfer.objects.filter(owner=self.user).count(), 1)
+
+
+class FakeClamd:
+    """
+    Minimal clamd on a Unix socket speaking IDSESSION, INSTREAM, SCAN and
+    VERSION. Content with EICAR is FOUND, with BROKEN an ERROR; streams over
+    `stream_max` bytes get clamd's size-limit error and paths listed in
+    `unreadable` cannot be scanned.
+    """
+
+    def __init__(self, path, stream_max=1024):
+        self.path = path
+        self.stream_max = stream_max
+        self.unreadable = set()
+        self.connections = 0
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._session, args=(client,), daemon=True).start()
+
+    def _verdict(self, name, content):
+        if b'EICAR' in content:
+            return f'{name}: Eicar-Signature FOUND'
+        if b'BROKEN' in content:
+            return f"{name}: Can't allocate memory ERROR"
+        return f'{name}: OK'
+
+    def _session(self, client):
+        reader = client.makefile('rb')
+        request_id = 0
+        with client:
+            while True:
+                command = b''
+                while not command.endswith(b'\0'):
+                    byte = reader.read(1)
+                    if not byte:
+                        return
+                    command += byte
+                command = command[1:-1].decode()
+                self.commands.append(command.split(' ')[0])
+                if command == 'IDSESSION':
+                    continue
+                if command == 'END':
+                    return
+                request_id += 1
+                if command == 'VERSION':
+                    reply = 'ClamAV 1.0.3/27106/Mon Nov 20 09:33:39 2023'
+                elif command == 'INSTREAM':
+                    content = b''
+                    while True:
+                        length = struct.unpack('!L', reader.read(4))[0]
+                        if not length:
+                            break
+                        content += reader.read(length)
+                    if len(content) > self.stream_max:
+                        reply = 'INSTREAM size limit exceeded. ERROR'
+                    else:
+                        reply = self._verdict('stream', content)
+                elif command.startswith('SCAN '):
+                    path = command[len('SCAN '):]
+                    if path in self.unreadable:
+                        reply = f'{path}: lstat() failed: Permission denied. ERROR'
+                    else:
+                        with open(path, 'rb') as f:
+                            reply = self._verdict(path, f.read())
+                else:
+                    reply = 'UNKNOWN COMMAND'
+                client.sendall(f'{request_id}: {reply}\0'.encode())
+
+
+class ClamdPoolTests(TestCase):
+    """Pooled clamd sessions against a local fake clamd."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.clamd = FakeClamd(os.path.join(self.directory, 'clamd.sock'))
+        self.addCleanup(self.clamd.close)
+        self.pool = ClamdPool(self.clamd.path, size=2, timeout=5, stream_max_bytes=self.clamd.stream_max)
+        self.addCleanup(self.pool.close)
+
+    def _file(self, content, name='upload.bin'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_clean_and_infected_files(self):
+        self.assertEqual(self.pool.scan(self._file(b'hello')), (True, None))
+        is_safe, message = self.pool.scan(self._file(b'xx EICAR xx'))
+        self.assertFalse(is_safe)
+        self.assertIn('Eicar-Signature', message)
+
+    def test_error_reply_raises(self):
+        with self.assertRaises(ClamdError):
+            self.pool.scan(self._file(b'BROKEN'))
+
+    def test_sessions_are_reused(self):
+        for _ in range(3):
+            self.pool.scan(self._file(b'hello'))
+        self.assertEqual(self.pool.version(), '27106')
+        self.assertEqual(self.clamd.connections, 1)
+        self.assertEqual(self.clamd.commands.count('IDSESSION'), 1)
+
+    def test_large_files_are_scanned_by_path(self):
+        path = self._file(b'EICAR' + b'x' * 2048)
+        self.assertFalse(self.pool.scan(path)[0])
+        self.assertNotIn('INSTREAM', self.clamd.commands)
+        self.assertIn('SCAN', self.clamd.commands)
+
+    def test_stream_limit_reply_falls_back_to_path_scan(self):
+        self.pool.stream_max_bytes = 10 * self.clamd.stream_max
+        self.assertEqual(self.pool.scan(self._file(b'x' * 2048)), (True, None))
+        self.assertEqual(self.clamd.commands[-2:], ['INSTREAM', 'SCAN'])
+
+    def test_large_unreadable_file_is_not_reported_safe(self):
+        path = self._file(b'x' * 2048)
+        self.clamd.unreadable.add(path)
+        with mock.patch.object(security_utils, 'get_clamd_pool', return_value=self.pool), \
+                mock.patch.dict(security_utils.SECURITY_CONFIG['malware_scanning']['clamav'], enabled=True):
+            with self.assertRaises(FileNotScanned):
+                security_utils.scan_with_clamav(path)
+
+    def test_restarted_clamd_session_is_retried(self):
+        self.pool.scan(self._file(b'hello'))
+        stale = self.pool.idle.get_nowait()
+        stale.sock.close()
+        stale.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.pool.idle.put_nowait(stale)
+        self.assertEqual(self.pool.scan(self._file(b'hello')), (True, None))
+        self.assertEqual(self.clamd.connections, 2)
+
+
+class AccessQueryPlanTests(TestCase):
+    """Plans of the accessible-items queries behind the listings."""
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.grantee = User.objects.create(username='grantee')
+        folder = Folder.objects.create(name='shared', owner=self.owner, uploader=self.owner)
+        child = Folder.objects.create(name='child', owner=self.owner, uploader=self.owner, parent=folder)
+        FolderAccess.objects.create(folder=folder, granted_to=self.grantee, propagate=True)
+        for index in range(20):
+            instance = FileTransfer.objects.create(owner=self.owner, uploader=self.owner, file=f'x/{index}.bin',
+                                                   filename=f'{index}.bin', size=1, folder=child)
+            if index % 2:
+                FileAccess.objects.create(file=instance, granted_to=self.grantee)
+
+    def assertUsesIndexes(self, queryset):
+        plan = queryset.order_by('-created_at').explain()
+        scans = [line.strip() for line in plan.splitlines() if _scans_table(line)]
+        self.assertEqual(scans, [], plan)
+
+    def test_accessible_files_plan(self):
+        self.assertUsesIndexes(accessible_files(self.grantee))
+
+    def test_accessible_folders_plan(self):
+        self.assertUsesIndexes(accessible_folders(self.grantee))
+
+    def test_benchmark_check(self):
+        call_command('benchmark_access_queries', users=20, folders=50, files=2000, grants=300, folder_grants=40,
+                     samples=5, check=True, stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class ListingETagTests(TestCase):
+    """Weak ETags of the listings."""
+
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        self.grantee = User.objects.create(username='grantee')
+        self.instance = FileTransfer.objects.create(owner=owner, uploader=owner, file='x/a.bin', filename='a.bin',
+                                                    size=1)
+        self.grant = FileAccess.objects.create(file=self.instance, granted_to=self.grantee,
+                                               expires_at=timezone.now() + timedelta(hours=1))
+        self.client = APIClient()
+        self.client.force_authenticate(self.grantee)
+
+    def _list(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/api/transfers/', **headers)
+
+    def test_unchanged_listing_is_not_modified(self):
+        etag = self._list()['ETag']
+        self.assertEqual(self._list(etag).status_code, 304)
+
+    def test_lapsed_grant_invalidates_the_listing(self):
+        response = self._list()
+        self.assertIn(self.instance.id, [item['id'] for item in response.data])
+        # Nothing is written when a grant lapses: only time passes
+        FileAccess.objects.filter(id=self.grant.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        response = self._list(response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.instance.id, [item['id'] for item in response.data])
+
+
+class AccessResolutionTests(TestCase):
+    """Effective permissions through folder grants resolved at read time."""
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.grantee = User.objects.create(username='grantee')
+        self.root = Folder.objects.create(name='root', owner=self.owner, uploader=self.owner)
+        self.child = Folder.objects.create(name='child', owner=self.owner, uploader=self.owner, parent=self.root)
+        self.grandchild = Folder.objects.create(name='grandchild', owner=self.owner, uploader=self.owner,
+                                                parent=self.child)
+        self.root_file = self._file(self.root)
+        self.deep_file = self._file(self.grandchild)
+
+    def _file(self, folder, name='a.bin'):
+        return FileTransfer.objects.create(owner=self.owner, uploader=self.owner, file=f'x/{name}', filename=name,
+                                           size=1, folder=folder)
+
+    def _grant(self, folder, **fields):
+        return FolderAccess.objects.create(folder=folder, granted_to=self.grantee, granted_by=self.owner, **fields)
+
+    def _visible(self):
+        return (set(accessible_folder_ids(self.grantee).values_list('id', flat=True)),
+                set(accessible_file_ids(self.grantee).values_list('id', flat=True)))
+
+    def test_propagating_grant_covers_the_subtree(self):
+        self._grant(self.root, propagate=True)
+        resolver = PermissionResolver(self.grantee)
+        self.assertEqual(resolver.folder_permission(self.grandchild), PERMISSION_READ)
+        self.assertEqual(resolver.file_permission(self.deep_file), PERMISSION_READ)
+        self.assertEqual(self._visible(), ({self.root.id, self.child.id, self.grandchild.id},
+                                           {self.root_file.id, self.deep_file.id}))
+
+    def test_grant_without_propagate_covers_the_folder_and_its_files(self):
+        self._grant(self.root, propagate=False)
+        resolver = PermissionResolver(self.grantee)
+        self.assertEqual(resolver.file_permission(self.root_file), PERMISSION_READ)
+        self.assertEqual(resolver.folder_permission(self.child), PERMISSION_NONE)
+        self.assertEqual(self._visible(), ({self.root.id}, {self.root_file.id}))
+
+    def test_highest_grant_wins_and_expired_grants_give_nothing(self):
+        self._grant(self.root, propagate=True)
+        self._grant(self.child, permission=PERMISSION_EDIT, expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(PermissionResolver(self.grantee).folder_permission(self.grandchild), PERMISSION_READ)
+        FolderAccess.objects.filter(folder=self.child).update(expires_at=None)
+        self.assertEqual(PermissionResolver(self.grantee).folder_permission(self.grandchild), PERMISSION_EDIT)
+
+    def test_subfolder_created_later_inherits_a_grant_without_propagate(self):
+        self._grant(self.root, propagate=False)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        response = client.post('/api/folders/', {'name': 'new', 'parent': self.root.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        new_folder = Folder.objects.get(id=response.data['id'])
+        response = client.post('/api/folders/', {'name': 'deeper', 'parent': new_folder.id}, format='json')
+        deeper = Folder.objects.get(id=response.data['id'])
+        new_file = self._file(new_folder)
+        resolver = PermissionResolver(self.grantee)
+        self.assertEqual(resolver.folder_permission(new_folder), PERMISSION_READ)
+        self.assertEqual(resolver.folder_permission(deeper), PERMISSION_READ)
+        self.assertEqual(resolver.file_permission(new_file), PERMISSION_READ)
+        # The copies keep the grantor's propagate
+        self.assertFalse(FolderAccess.objects.filter(folder__in=[new_folder, deeper], propagate=True).exists())
+        # Subfolders that existed when it was granted stay out
+        self.assertEqual(resolver.folder_permission(self.child), PERMISSION_NONE)
+
+    def test_query_does_not_grow_with_the_grants(self):
+        self._grant(self.root, propagate=False)
+        _sql, params = accessible_folder_ids(self.grantee).query.sql_with_params()
+        for index in range(50):
+            self._grant(Folder.objects.create(name=f'f{index}', owner=self.owner, uploader=self.owner),
+                        propagate=False)
+        self.assertEqual(len(accessible_folder_ids(self.grantee).query.sql_with_params()[1]), len(params))
+        self.assertEqual(accessible_folders(self.grantee).count(), 51)
+
+    def test_listing_loads_the_folder_grants_once(self):
+        self._grant(self.root, propagate=True)
+        client = APIClient()
+        client.force_authenticate(self.grantee)
+        with mock.patch.object(access_utils, 'folder_grants', wraps=access_utils.folder_grants) as loads:
+            self.assertEqual(client.get('/api/folders/', {'parent': self.root.id}).status_code, 200)
+        self.assertEqual(loads.call_count, 1)
+
+
+class CollapseInheritedAccessMigrationTests(TestCase):
+    """Migration 0019: inherited ACL copies deleted without changing effective permissions."""
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.grantee = User.objects.create(username='grantee')
+
+    def _folder(self, name, parent=None):
+        return Folder.objects.create(name=name, owner=self.owner, uploader=self.owner, parent=parent)
+
+    def _file(self, folder):
+        return FileTransfer.objects.create(owner=self.owner, uploader=self.owner, file='x/a.bin', filename='a.bin',
+                                           size=1, folder=folder)
+
+    def _permissions(self, folders, files):
+        resolver = PermissionResolver(self.grantee)
+        return resolver.folder_permissions(folders), resolver.file_permissions(files)
+
+    def test_copies_are_collapsed_and_permissions_kept(self):
+        expires_at = timezone.now() + timedelta(days=1)
+        shared = self._folder('shared')
+        copied = self._folder('copied', shared)
+        wider = self._folder('wider', shared)
+        longer = self._folder('longer', shared)
+        private = self._folder('private')
+        private_child = self._folder('private child', private)
+        files = [self._file(folder) for folder in (shared, copied, private, private_child)]
+        folders = [shared, copied, wider, longer, private, private_child]
+
+        # As the previous copy-on-write inheritance left them
+        FolderAccess.objects.create(folder=shared, granted_to=self.grantee, propagate=True, expires_at=expires_at)
+        FolderAccess.objects.create(folder=copied, granted_to=self.grantee, expires_at=expires_at)
+        FolderAccess.objects.create(folder=wider, granted_to=self.grantee, permission=PERMISSION_EDIT,
+                                    expires_at=expires_at)
+        FolderAccess.objects.create(folder=longer, granted_to=self.grantee)
+        FolderAccess.objects.create(folder=private, granted_to=self.grantee, propagate=False)
+        FolderAccess.objects.create(folder=private_child, granted_to=self.grantee)
+        for instance in files:
+            FileAccess.objects.create(file=instance, granted_to=self.grantee,
+                                      expires_at=expires_at if instance.folder_id in (shared.id, copied.id) else None)
+        before = self._permissions(folders, files)
+
+        migration = importlib.import_module('transfers.migrations.0019_collapse_inherited_access')
+        migration.collapse_inherited_access(apps, None)
+
+        self.assertEqual(self._permissions(folders, files), before)
+        self.assertEqual(set(FolderAccess.objects.values_list('folder_id', flat=True)),
+                         {shared.id, wider.id, longer.id, private.id, private_child.id})
+        self.assertFalse(FileAccess.objects.exists())
+
+
+class OffloadDeliveryTests(TemporaryMediaMixin, TestCase):
+    """Validators of downloads delegated to the front server."""
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.media_root, 'a.bin')
+        with open(self.path, 'wb') as f:
+            f.write(b'hello')
+        backend = mock.patch.object(download_utils, 'FILE_DELIVERY_BACKEND', download_utils.DELIVERY_X_ACCEL)
+        backend.start()
+        self.addCleanup(backend.stop)
+
+    def _serve(self, **headers):
+        request = RequestFactory().get('/download', **headers)
+        return download_utils.serve_file(request, self.path, etag='"abc"')
+
+    def test_offloaded_response_carries_the_validators(self):
+        response = self._serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/a.bin')
+        self.assertEqual(response['ETag'], '"abc"')
+        self.assertIn('Last-Modified', response)
+
+    def test_revalidation_is_answered_before_offloading(self):
+        response = self._serve(HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(response['ETag'], '"abc"')
+
+
+class RangeRequestTests(TestCase):
+    """Range / If-Range handling of downloads (RFC 7233)."""
+
+    data = bytes(range(10))
+    etag = '"v1"'
+    mtime = 1700000000.0
+
+    def _response(self, data=None, **headers):
+        data = self.data if data is None else data
+        request = RequestFactory().get('/download', **headers)
+        return download_utils.ranged_response(
+            request, size=len(data), etag=self.etag, mtime=self.mtime,
+            read_range=lambda start, end: [data[start:end + 1]],
+            content_type='application/octet-stream', filename='a.bin',
+        )
+
+    def _body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_parse_range_header(self):
+        cases = [
+            ('bytes=0-3', [(0, 3)]),
+            ('bytes=-3', [(7, 9)]),
+            ('bytes=-20', [(0, 9)]),
+            ('bytes=-0', []),
+            ('bytes=5-', [(5, 9)]),
+            ('bytes=5-100', [(5, 9)]),
+            ('bytes=20-', []),
+            ('bytes=3-1', None),
+            ('items=0-1', None),
+            ('bytes=a-b', None),
+        ]
+        for header, expected in cases:
+            with self.subTest(header=header):
+                self.assertEqual(download_utils.parse_range_header(header, 10), expected)
+
+    def test_too_many_ranges_send_the_whole_file(self):
+        header = 'bytes=' + ','.join(f'{i}-{i}' for i in range(download_utils.MAX_RANGES + 1))
+        self.assertIsNone(download_utils.parse_range_header(header, 100))
+
+    def test_single_range(self):
+        response = self._response(HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(self._body(response), self.data[7:])
+
+    def test_unsatisfiable_ranges(self):
+        for data, header in ((self.data, 'bytes=20-'), (self.data, 'bytes=-0'), (b'', 'bytes=0-')):
+            with self.subTest(size=len(data), header=header):
+                response = self._response(data, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], f'bytes */{len(data)}')
+
+    def test_multipart_content_length(self):
+        response = self._response(HTTP_RANGE='bytes=0-1,5-6,-2')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        body = self._body(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        for part in (self.data[0:2], self.data[5:7], self.data[8:10]):
+            self.assertIn(part, body)
+
+    def test_if_range(self):
+        matching_date = download_utils.http_date(self.mtime)
+        cases = [
+            (self.etag, 206),
+            ('W/"v1"', 200),
+            ('"v0"', 200),
+            (matching_date, 206),
+            (download_utils.http_date(self.mtime - 60), 200),
+        ]
+        for if_range, status_code in cases:
+            with self.subTest(if_range=if_range):
+                response = self._response(HTTP_RANGE='bytes=0-3', HTTP_IF_RANGE=if_range)
+                self.assertEqual(response.status_code, status_code)
+
+
+class StreamZipTests(TemporaryMediaMixin, TestCase):
+    """ZIP archives written by stream_zip() read back with zipfile."""
+
+    def setUp(self):
+        super().setUp()
+        self.contents = {
+            'notes.txt': b'compressible line\n' * 5000,
+            'photo.jpg': os.urandom(40000),
+            'carpeta/año.txt': 'ñandú'.encode('utf-8') * 300,
+            'empty.txt': b'',
+        }
+        self.entries = []
+        for arcname, content in self.contents.items():
+            path = os.path.join(self.media_root, arcname.replace('/', '_'))
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.entries.append(archive_utils.ArchiveEntry(path, arcname))
+
+    def _read(self, data):
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(archive.testzip())
+        return archive
+
+    def test_round_trip(self):
+        # Small blocks: every entry spans several deflate blocks
+        with mock.patch.object(archive_utils, 'ZIP_READ_CHUNK_SIZE', 4096):
+            for parallel in (False, True):
+                with self.subTest(parallel=parallel):
+                    archive = self._read(b''.join(archive_utils.stream_zip(self.entries, parallel=parallel)))
+                    self.assertEqual({name: archive.read(name) for name in archive.namelist()}, self.contents)
+                    methods = {info.filename: info.compress_type for info in archive.infolist()}
+                    self.assertEqual(methods['notes.txt'], zipfile.ZIP_DEFLATED)
+                    self.assertEqual(methods['photo.jpg'], zipfile.ZIP_STORED)
+
+    def test_missing_files_are_skipped(self):
+        entries = self.entries + [archive_utils.ArchiveEntry(os.path.join(self.media_root, 'gone.txt'), 'gone.txt')]
+        archive = self._read(b''.join(archive_utils.stream_zip(entries, parallel=False)))
+        self.assertEqual(sorted(archive.namelist()), sorted(self.contents))
+
+    def test_duplicate_names_are_renamed(self):
+        archive = self._read(b''.join(archive_utils.stream_zip(self.entries[:1] * 2, parallel=False)))
+        names = archive.namelist()
+        self.assertEqual(len(set(names)), 2)
+        self.assertEqual([archive.read(name) for name in names], [self.contents['notes.txt']] * 2)
+
+    def test_zip64_switch(self):
+        limit = archive_utils.ZIP64_LIMIT
+        below = int(limit / 1.05) - 1
+        for size, zip64 in ((below, False), (below + 2, True), (limit, True)):
+            with self.subTest(size=size):
+                state = archive_utils._EntryState(b'big.bin', archive_utils.ZIP_DEFLATED, size, 0)
+                self.assertEqual(state.zip64, zip64)
+
+    def test_zip64_entries_round_trip(self):
+        class Zip64State(archive_utils._EntryState):
+            __slots__ = ()
+
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.zip64 = True
+
+        with mock.patch.object(archive_utils, '_EntryState', Zip64State):
+            data = b''.join(archive_utils.stream_zip(self.entries, parallel=False))
+        archive = self._read(data)
+        self.assertEqual({name: archive.read(name) for name in archive.namelist()}, self.contents)
+        # Zip64 local headers defer both sizes to the 64-bit data descriptor
+        self.assertEqual(struct.unpack_from('<II', data, 18), (0xFFFFFFFF, 0xFFFFFFFF))
+        self.assertEqual(data.count(b'PK\x07\x08'), len(self.contents))
+
+
+class SizedArchiveTests(TemporaryMediaMixin, TestCase):
+    """Archives whose exact size is announced before streaming (zip-store, tar)."""
+
+    def setUp(self):
+        super().setUp()
+        self.contents = {
+            'notes.txt': b'line\n' * 3000,
+            'block.bin': os.urandom(archive_utils.TAR_BLOCK_SIZE * 4),
+            'carpeta/' + 'nombre largo ñ ' * 10 + '.txt': os.urandom(777),
+            'empty.txt': b'',
+        }
+        entries = []
+        for index, (arcname, content) in enumerate(self.contents.items()):
+            path = os.path.join(self.media_root, f'{index}.src')
+            with open(path, 'wb') as f:
+                f.write(content)
+            entries.append(archive_utils.ArchiveEntry(path, arcname))
+        self.entries = archive_utils.stat_entries(entries)
+
+    def _body(self, archive_format):
+        stream, size = archive_utils.archive_body(self.entries, archive_format)
+        data = b''.join(stream)
+        self.assertEqual(size, len(data))
+        self.assertEqual(archive_utils.archive_size(self.entries, archive_format), len(data))
+        return data
+
+    def test_zip_store_size_matches_stream(self):
+        archive = zipfile.ZipFile(io.BytesIO(self._body(archive_utils.ARCHIVE_ZIP_STORE)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual({info.compress_type for info in archive.infolist()}, {zipfile.ZIP_STORED})
+        self.assertEqual({name: archive.read(name) for name in archive.namelist()}, self.contents)
+
+    def test_tar_size_matches_stream(self):
+        data = self._body(archive_utils.ARCHIVE_TAR)
+        self.assertEqual(len(data) % archive_utils.TAR_RECORD_SIZE, 0)
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            self.assertEqual(
+                {member.name: archive.extractfile(member).read() for member in archive.getmembers()},
+                self.contents,
+            )
+
+    def test_tar_slices_match_full_archive(self):
+        layout = archive_utils.TarLayout(self.entries)
+        full = b''.join(layout.iter_range(0, layout.size - 1))
+        # Slices starting and ending inside headers, file data and padding
+        bounds = [0, 1, 511, 512, 513, 700, 2048, 4000, 9000, layout.size - 1025, layout.size - 1]
+        for start in bounds:
+            for end in bounds:
+                if start <= end:
+                    with self.subTest(start=start, end=end):
+                        self.assertEqual(b''.join(layout.iter_range(start, end)), full[start:end + 1])
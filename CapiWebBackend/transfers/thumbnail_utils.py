@@ -1,14 +1,27 @@
 """
 Thumbnail generation utilities for file transfers.
 Generates compressed preview images for optimal gallery performance.
+
+Images are decoded at reduced resolution where the codec allows it (JPEG
+DCT scaling via draft(), then reduce() by an integer factor) and only after
+estimating the memory the decode takes from the header dimensions: files over
+TRANSFER_THUMBNAIL_MAX_DECODE_MB get no preview, which also stops
+decompression bombs. `python manage.py benchmark_thumbnails` measures it.
+
+Each stored content gets a rendition set: the preview at several sizes
+(grid, default thumbnail, lightbox), each encoded as AVIF/WebP when Pillow
+supports them plus a JPEG fallback. Renditions live next to the blob store,
+keyed by the content SHA-256, so deduplicated files share them.
 """
 import os
 import subprocess
 import tempfile
 import logging
 from io import BytesIO
-from PIL import Image, ImageOps
+from PIL import Image, features
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 
 # Configure logger
 logger = logging.getLogger('transfers')
@@ -27,6 +40,44 @@ THUMBNAIL_MAX_SIZE = (400, 400)  # Max dimensions
 THUMBNAIL_QUALITY = 85  # JPEG quality (1-100)
 THUMBNAIL_FORMAT = 'JPEG'  # Output format for thumbnails
 
+# Rendition settings: longest side in px, formats in order of preference
+RENDITION_SIZES = tuple(sorted(int(size) for size in getattr(settings, 'TRANSFER_THUMBNAIL_SIZES', (160, 400, 1600))))
+DEFAULT_RENDITION_SIZE = 400
+RENDITION_FORMATS = [
+    fmt for fmt in getattr(settings, 'TRANSFER_THUMBNAIL_FORMATS', ['avif', 'webp', 'jpeg'])
+    if fmt == 'jpeg' or features.check(fmt)
+]
+if 'jpeg' not in RENDITION_FORMATS:
+    RENDITION_FORMATS.append('jpeg')  # Always available fallback
+RENDITION_TYPES = {
+    'avif': ('AVIF', 'image/avif', 'avif', {'quality': 55, 'speed': 8}),
+    'webp': ('WEBP', 'image/webp', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg', {'quality': THUMBNAIL_QUALITY, 'optimize': True, 'progressive': True}),
+}
+RENDITIONS_DIR = 'renditions'
+
+# Decoding settings
+THUMBNAIL_MAX_DECODE_BYTES = getattr(settings, 'TRANSFER_THUMBNAIL_MAX_DECODE_MB', 1024) * 1024 * 1024
+# Peak bytes per decoded pixel (benchmark_thumbnails); WebP has no reduced decode
+DECODE_BYTES_PER_PIXEL = {'WEBP': 16, 'GIF': 5}
+DEFAULT_DECODE_BYTES_PER_PIXEL = 4
+REDUCING_GAP = 2  # Decode at least this many times the target size before the final LANCZOS pass
+REDUCIBLE_MODES = {'RGB', 'RGBA', 'L', 'LA', 'CMYK', 'YCbCr'}
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class ImageTooLarge(Exception):
+    """Decoding the image would take more than THUMBNAIL_MAX_DECODE_BYTES."""
+
 
 def is_image_file(filename: str) -> bool:
     """Check if filename has an image extension."""
@@ -40,6 +91,50 @@ def is_video_file(filename: str) -> bool:
     return ext in VIDEO_EXTENSIONS
 
 
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """Flatten transparency onto white and convert to RGB."""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def decode_image(file_path: str, max_side: int) -> Image.Image:
+    """
+    Decode the first frame of an image as RGB, EXIF-oriented, at the smallest
+    resolution that still leaves REDUCING_GAP times `max_side` for the final
+    resize. Raises ImageTooLarge if it does not fit the memory budget.
+    """
+    with Image.open(file_path) as img:
+        width, height = img.size
+        target = max_side * REDUCING_GAP
+        # JPEG: let libjpeg decode at 1/2, 1/4 or 1/8 scale (no-op for other formats)
+        scale = max(width, height) / target
+        if scale > 1:
+            img.draft('RGB', (int(width / scale), int(height / scale)))
+        cost = img.size[0] * img.size[1] * DECODE_BYTES_PER_PIXEL.get(img.format, DEFAULT_DECODE_BYTES_PER_PIXEL)
+        if cost > THUMBNAIL_MAX_DECODE_BYTES:
+            raise ImageTooLarge(f"{img.format} {width}x{height} needs ~{cost // (1024 * 1024)} MB to decode")
+
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        if img.mode not in REDUCIBLE_MODES:
+            # Palette, 1-bit and 16-bit images: expand first, keeping transparency
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'PA' else 'RGB')
+        factor = max(img.size) // target
+        if factor > 1:
+            img = img.reduce(factor)
+        else:
+            img.load()
+
+    if orientation in ORIENTATION_TRANSPOSE:
+        # Apply EXIF orientation to fix rotated images from mobile phones
+        img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return _to_rgb(img)
+
+
 def generate_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZE) -> ContentFile | None:
     """
     Generate a thumbnail from an image file.
@@ -50,42 +145,74 @@ def generate_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZE) ->
         
     Returns:
         ContentFile containing the thumbnail, or None if generation fails
+
+    Raises:
+        ImageTooLarge: if decoding would not fit the memory budget
     """
     try:
-        with Image.open(file_path) as img:
-            # Apply EXIF orientation to fix rotated images from mobile phones
-            img = ImageOps.exif_transpose(img)
-            
-            # Convert to RGB if necessary (for JPEG output)
-            if img.mode in ('RGBA', 'LA', 'P'):
-                # Create white background for transparency
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Handle animated GIFs - use first frame
-            if hasattr(img, 'n_frames') and img.n_frames > 1:
-                img.seek(0)
-            
-            # Calculate thumbnail size maintaining aspect ratio
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Save to BytesIO
-            thumb_io = BytesIO()
-            img.save(thumb_io, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, optimize=True)
-            thumb_io.seek(0)
-            
-            return ContentFile(thumb_io.read())
+        # Reduced-resolution RGB decode (first frame of animated GIFs)
+        img = decode_image(file_path, max(max_size))
+        
+        # Calculate thumbnail size maintaining aspect ratio
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        
+        # Save to BytesIO
+        thumb_io = BytesIO()
+        img.save(thumb_io, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, optimize=True)
+        thumb_io.seek(0)
+        
+        return ContentFile(thumb_io.read())
             
+    except ImageTooLarge:
+        raise
     except Exception as e:
         print(f"Error generating thumbnail for {file_path}: {e}")
         return None
 
 
+def _extract_video_frame(file_path: str, temp_image_path: str) -> bool:
+    """
+    Extract one frame of a video to `temp_image_path` with ffmpeg.
+    Tries 1 second into the video, then the first frame.
+    """
+    # Use ffmpeg to extract a frame at 1 second
+    cmd = [
+        'ffmpeg',
+        '-ss', '1',  # Seek to 1 second
+        '-i', file_path,
+        '-vframes', '1',
+        '-q:v', '2',
+        '-y',  # Overwrite output file
+        temp_image_path
+    ]
+    
+    logger.warning(f"[THUMBNAIL] Running command: {' '.join(cmd)}")
+    
+    # Run ffmpeg with timeout
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        timeout=30,  # 30 second timeout
+        check=False
+    )
+    
+    if result.returncode != 0:
+        logger.warning(f"[THUMBNAIL] ffmpeg failed with code {result.returncode}")
+        logger.warning(f"[THUMBNAIL] stderr: {result.stderr.decode('utf-8')}")
+    
+    # Check if the frame was extracted successfully
+    if not os.path.exists(temp_image_path) or os.path.getsize(temp_image_path) == 0:
+        logger.warning("[THUMBNAIL] First attempt failed, trying at 0 seconds")
+        # Try extracting from the beginning if 1 second failed
+        cmd[2] = '0'  # Change seek to 0 seconds
+        subprocess.run(cmd, capture_output=True, timeout=30, check=False)
+    
+    if os.path.exists(temp_image_path) and os.path.getsize(temp_image_path) > 0:
+        return True
+    logger.warning("[THUMBNAIL] Failed to extract frame (file empty or not created)")
+    return False
+
+
 def generate_video_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZE) -> ContentFile | None:
     """
     Generate a thumbnail from a video file using ffmpeg.
@@ -98,40 +225,8 @@ def generate_video_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZ
         with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
             temp_image_path = tmp.name
         
-        # Use ffmpeg to extract a frame at 1 second
-        cmd = [
-            'ffmpeg',
-            '-ss', '1',  # Seek to 1 second
-            '-i', file_path,
-            '-vframes', '1',
-            '-q:v', '2',
-            '-y',  # Overwrite output file
-            temp_image_path
-        ]
-        
-        logger.warning(f"[THUMBNAIL] Running command: {' '.join(cmd)}")
-        
-        # Run ffmpeg with timeout
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            timeout=30,  # 30 second timeout
-            check=False
-        )
-        
-        if result.returncode != 0:
-            logger.warning(f"[THUMBNAIL] ffmpeg failed with code {result.returncode}")
-            logger.warning(f"[THUMBNAIL] stderr: {result.stderr.decode('utf-8')}")
-        
-        # Check if the frame was extracted successfully
-        if not os.path.exists(temp_image_path) or os.path.getsize(temp_image_path) == 0:
-            logger.warning("[THUMBNAIL] First attempt failed, trying at 0 seconds")
-            # Try extracting from the beginning if 1 second failed
-            cmd[2] = '0'  # Change seek to 0 seconds
-            subprocess.run(cmd, capture_output=True, timeout=30, check=False)
-        
         # Now use PIL to resize the extracted frame
-        if os.path.exists(temp_image_path) and os.path.getsize(temp_image_path) > 0:
+        if _extract_video_frame(file_path, temp_image_path):
             logger.warning(f"[THUMBNAIL] Frame extracted successfully, resizing...")
             with Image.open(temp_image_path) as img:
                 # Convert to RGB if necessary
@@ -148,8 +243,6 @@ def generate_video_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZ
                 
                 logger.warning("[THUMBNAIL] Thumbnail generated successfully")
                 return ContentFile(thumb_io.read())
-        else:
-            logger.warning("[THUMBNAIL] Failed to extract frame (file empty or not created)")
         
         return None
         
@@ -171,6 +264,119 @@ def generate_video_thumbnail(file_path: str, max_size: tuple = THUMBNAIL_MAX_SIZ
                 pass
 
 
+def load_preview_image(file_path: str, filename: str, max_side: int = max(RENDITION_SIZES)) -> Image.Image | None:
+    """
+    Decode the image to build previews from: the (first frame of the) image
+    itself, or a frame of a video. Returns an RGB image, or None on failure.
+    ImageTooLarge is raised, not swallowed, so callers can report it.
+    """
+    temp_image_path = None
+    try:
+        if is_image_file(filename):
+            return decode_image(file_path, max_side)
+
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
+            temp_image_path = tmp.name
+        if not _extract_video_frame(file_path, temp_image_path):
+            return None
+        return decode_image(temp_image_path, max_side)
+    except ImageTooLarge:
+        raise
+    except Exception as e:
+        logger.warning(f"[THUMBNAIL] Could not decode a preview of {file_path}: {e}")
+        return None
+    finally:
+        if temp_image_path and os.path.exists(temp_image_path):
+            os.unlink(temp_image_path)
+
+
+def rendition_dir(sha256: str) -> str:
+    """Storage directory of the renditions of a content."""
+    return os.path.join(RENDITIONS_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def rendition_name(sha256: str, size: str | int, fmt: str) -> str:
+    """Storage name of one rendition, e.g. renditions/ab/cd/<sha256>/400.webp."""
+    return os.path.join(rendition_dir(sha256), f'{size}.{RENDITION_TYPES[fmt][2]}')
+
+
+def render_rendition_files(file_path: str, filename: str, sha256: str) -> dict:
+    """
+    Encode every rendition of a file into its rendition directory.
+
+    The image is decoded once and downscaled progressively from the largest
+    size to the smallest. Sizes the source is too small to reach are skipped
+    (the next larger rendition already holds the full resolution). Files are
+    written atomically, so concurrent renders of the same content are safe.
+
+    Returns:
+        {size: [formats]} of the stored renditions (sizes as strings, JSON
+        keys), empty if the preview could not be decoded.
+    """
+    img = load_preview_image(file_path, filename)
+    if img is None:
+        return {}
+
+    directory = default_storage.path(rendition_dir(sha256))
+    os.makedirs(directory, exist_ok=True)
+    renditions = {}
+    previous_size = None
+    for size in sorted(RENDITION_SIZES, reverse=True):
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        if img.size == previous_size:
+            continue
+        previous_size = img.size
+        for fmt in RENDITION_FORMATS:
+            pil_format, _mime, _ext, options = RENDITION_TYPES[fmt]
+            path = default_storage.path(rendition_name(sha256, size, fmt))
+            img.save(path + '.tmp', format=pil_format, **options)
+            os.replace(path + '.tmp', path)
+        renditions[str(size)] = list(RENDITION_FORMATS)
+    return renditions
+
+
+def pick_rendition(renditions: dict, size: int = DEFAULT_RENDITION_SIZE, accept: str = '') -> tuple[str, str] | None:
+    """
+    Choose the rendition to serve: the smallest stored size covering `size`
+    (else the largest one) in the best format listed in the Accept header.
+    JPEG is always acceptable. Returns (size, format) or None.
+    """
+    if not renditions:
+        return None
+    sizes = sorted(renditions, key=int)
+    chosen = next((key for key in sizes if int(key) >= size), sizes[-1])
+    formats = renditions[chosen]
+    for fmt in RENDITION_TYPES:
+        if fmt in formats and (fmt == 'jpeg' or RENDITION_TYPES[fmt][1] in accept):
+            return chosen, fmt
+    return None
+
+
+def store_renditions(instance) -> bool:
+    """
+    Make sure the content of a FileTransfer has its renditions and point
+    `instance.thumbnail` at the default JPEG one. Contents already rendered
+    for another file (deduplicated blobs) are reused. The caller saves
+    `instance` (field 'thumbnail'). Returns False if no preview could be made.
+    """
+    blob = instance.blob
+    renditions = blob.renditions
+    default = pick_rendition(renditions)
+    if default is None or not default_storage.exists(rendition_name(blob.sha256, *default)):
+        try:
+            renditions = render_rendition_files(instance.file.path, instance.filename, blob.sha256)
+        except ImageTooLarge as e:
+            logger.warning(f"[THUMBNAIL] Skipping previews of file {instance.id}: {e}")
+            return False
+        if not renditions:
+            return False
+        blob.renditions = renditions
+        type(blob).objects.filter(id=blob.id).update(renditions=renditions)
+        default = pick_rendition(renditions)
+    instance.thumbnail.name = rendition_name(blob.sha256, *default)
+    return True
+
+
 def get_thumbnail_filename(original_filename: str) -> str:
     """Generate thumbnail filename from original filename."""
     name, _ = os.path.splitext(original_filename)
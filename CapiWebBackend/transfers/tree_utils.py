@@ -0,0 +1,80 @@
+"""
+Subtree queries over the materialized Folder.path.
+
+Every folder stores the ids from the root down to itself (/1/5/12/), so
+"all folders under X" is a single indexed prefix query instead of one query
+per folder, and the ancestors of a folder are read from its own path.
+"""
+import os
+from django.db.models import Q
+from .archive_utils import ArchiveEntry
+from .models import FileTransfer, Folder
+
+
+def path_ids(path: str) -> list[int]:
+    """Folder ids of a materialized path, from the root down to the folder."""
+    return [int(part) for part in path.strip('/').split('/') if part]
+
+
+def subtree(folder):
+    """The folder and all its descendants."""
+    return Folder.objects.filter(path__startswith=folder.path)
+
+
+def descendants(folder):
+    """All folders below `folder` (not the folder itself)."""
+    return subtree(folder).exclude(pk=folder.pk)
+
+
+def subtree_files(folder):
+    """All files in the folder or any of its descendants."""
+    return FileTransfer.objects.filter(folder__path__startswith=folder.path)
+
+
+def with_ancestors(folder_ids) -> set:
+    """The given folder ids plus the ids of all their ancestors, with one query."""
+    folder_ids = {folder_id for folder_id in folder_ids if folder_id}
+    result = set(folder_ids)
+    for path in Folder.objects.filter(id__in=folder_ids).values_list('path', flat=True):
+        result.update(path_ids(path))
+    return result
+
+
+def collect_archive_entries(root, base_path: str = '', folder_filter: Q = None, file_filter: Q = None) -> list:
+    """
+    Archive entries of the files under `root`, depth first (files of a
+    folder, then its subfolders), with one query for folders and one for
+    files whatever the size of the tree.
+
+    Args:
+        root: Folder to archive; its name is the top directory
+        base_path: Directory inside the archive that contains `root`
+        folder_filter: Subfolders that may be entered; a folder left out
+            hides its whole subtree
+        file_filter: Files that may be included
+    """
+    folders = descendants(root)
+    if folder_filter is not None:
+        folders = folders.filter(folder_filter).distinct()
+    children = {}
+    for folder_id, parent_id, name in folders.order_by('id').values_list('id', 'parent_id', 'name'):
+        children.setdefault(parent_id, []).append((folder_id, name))
+
+    files = subtree_files(root)
+    if file_filter is not None:
+        files = files.filter(file_filter).distinct()
+    files_by_folder = {}
+    for file_transfer in files.order_by('id'):
+        if file_transfer.file:
+            files_by_folder.setdefault(file_transfer.folder_id, []).append(file_transfer)
+
+    entries = []
+    stack = [(root.id, os.path.join(base_path, root.name) if base_path else root.name)]
+    while stack:
+        folder_id, folder_path = stack.pop()
+        for file_transfer in files_by_folder.get(folder_id, []):
+            entries.append(ArchiveEntry(file_transfer.file.path, os.path.join(folder_path, file_transfer.filename)))
+        # Reversed so the stack pops them in id order
+        for child_id, name in reversed(children.get(folder_id, [])):
+            stack.append((child_id, os.path.join(folder_path, name)))
+    return entries
@@ -0,0 +1,309 @@
+"""
+Utilities for resumable chunked uploads and for the streaming upload handler.
+Chunks are streamed straight into a partial file inside MEDIA_ROOT, so the
+worker only ever holds a small buffer in memory regardless of the file size.
+"""
+import os
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db.models import Sum
+from django.utils import timezone
+from rest_framework import serializers
+from .models import FileTransfer
+from .security_utils import SNIFF_BYTES, sniff_content_mismatch
+from .serializers import MAX_FILE_SIZE, validate_upload_metadata
+
+logger = logging.getLogger('transfers')
+
+# Chunk settings
+UPLOAD_CHUNK_SIZE = getattr(settings, 'TRANSFER_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+UPLOAD_SESSION_TTL_HOURS = getattr(settings, 'TRANSFER_UPLOAD_SESSION_TTL_HOURS', 24)
+UPLOAD_SESSIONS_DIR = 'upload_sessions'
+UPLOAD_STAGING_DIR = 'upload_tmp'
+MULTIPART_OVERHEAD = 1024 * 1024  # Form fields and boundaries around the file
+
+# Pre-flight admission
+UPLOAD_TICKET_REQUIRED = getattr(settings, 'TRANSFER_UPLOAD_TICKET_REQUIRED', False)
+UPLOAD_TICKET_TTL_SECONDS = getattr(settings, 'TRANSFER_UPLOAD_TICKET_TTL_SECONDS', 600)
+UPLOAD_TICKET_SALT = 'transfers.upload_ticket'
+UPLOAD_TICKET_HEADER = 'HTTP_X_UPLOAD_TICKET'
+USER_QUOTA_BYTES = getattr(settings, 'TRANSFER_USER_QUOTA_MB', 0) * 1024 * 1024
+STREAM_BUFFER_SIZE = 64 * 1024  # 64KB reads from the request stream
+
+
+class ChunkLengthMismatch(Exception):
+    """Raised when the received chunk does not have the expected length."""
+
+
+class UploadTicketError(Exception):
+    """Raised when an upload ticket is missing, expired or not valid for the upload."""
+
+
+def get_part_path(session) -> str:
+    """Absolute path of the partial file backing an upload session."""
+    return default_storage.path(os.path.join(UPLOAD_SESSIONS_DIR, f'{session.id}.part'))
+
+
+def create_part_file(session) -> str:
+    """Create the (empty) partial file for a new upload session."""
+    part_path = get_part_path(session)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    open(part_path, 'wb').close()
+    return part_path
+
+
+def write_chunk(stream, session, index: int) -> int:
+    """
+    Stream a chunk from `stream` into the session partial file at its offset.
+
+    Reads the body in STREAM_BUFFER_SIZE blocks, so memory usage is constant.
+
+    Returns:
+        Number of bytes written
+
+    Raises:
+        ChunkLengthMismatch: if the body length differs from the expected one
+    """
+    expected = session.expected_chunk_length(index)
+    part_path = get_part_path(session)
+    written = 0
+
+    with open(part_path, 'r+b') as part:
+        part.seek(index * session.chunk_size)
+        while written <= expected:
+            data = stream.read(STREAM_BUFFER_SIZE) if stream is not None else b''
+            if not data:
+                break
+            written += len(data)
+            if written > expected:
+                break
+            part.write(data)
+
+    if written != expected:
+        raise ChunkLengthMismatch(f'Expected {expected} bytes, received {written}')
+    return written
+
+
+def finalize_part_file(session) -> str:
+    """
+    Verify that every chunk of the session was received and written, then
+    cut anything past the declared size. Returns the partial file path.
+
+    Raises:
+        ChunkLengthMismatch: if the session or the partial file is short
+    """
+    part_path = get_part_path(session)
+    # Checked before truncating: truncate() would pad a short file with zeros
+    written = os.path.getsize(part_path)
+    if session.received_chunks < session.total_chunks or written < session.size:
+        raise ChunkLengthMismatch(
+            f'Uploaded {written} bytes ({session.received_bytes} acknowledged), declared {session.size}'
+        )
+    if written > session.size:
+        with open(part_path, 'r+b') as part:
+            part.truncate(session.size)
+    return part_path
+
+
+def discard_part_file(session) -> None:
+    """Remove the partial file of an aborted or expired session."""
+    part_path = get_part_path(session)
+    try:
+        os.remove(part_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove partial upload {part_path}: {e}")
+
+
+def check_storage_quota(owner, size: int) -> None:
+    """Raise ValidationError if `size` more bytes do not fit in the owner's quota (0 = unlimited)."""
+    if USER_QUOTA_BYTES <= 0:
+        return
+    used = FileTransfer.objects.filter(owner=owner).aggregate(total=Sum('size'))['total'] or 0
+    if used + size > USER_QUOTA_BYTES:
+        free_mb = max(USER_QUOTA_BYTES - used, 0) / (1024 * 1024)
+        raise serializers.ValidationError({
+            'file': f'No hay espacio suficiente en la cuenta de {owner.username} ({free_mb:.0f} MB libres)'
+        })
+
+
+def lock_storage_quota(owner, size: int) -> None:
+    """
+    Check the quota again when an upload is saved, inside transaction.atomic().
+    Tickets and upload sessions are admitted one by one; locking the owner row
+    serializes the commits of the same owner so together they cannot exceed it.
+    """
+    if USER_QUOTA_BYTES <= 0:
+        return
+    list(User.objects.select_for_update().filter(id=owner.id).values_list('id', flat=True))
+    check_storage_quota(owner, size)
+
+
+def issue_upload_ticket(user, filename: str, size: int, folder=None, owner=None) -> tuple[str, object]:
+    """
+    Sign an admission ticket for one upload of `filename` (`size` bytes).
+    Returns (ticket, expires_at).
+    """
+    payload = {
+        'id': uuid.uuid4().hex,
+        'user': user.id,
+        'filename': filename,
+        'size': size,
+        'folder': folder.id if folder else None,
+        'owner': owner.id if owner else None,
+    }
+    ticket = signing.dumps(payload, salt=UPLOAD_TICKET_SALT, compress=True)
+    return ticket, timezone.now() + timedelta(seconds=UPLOAD_TICKET_TTL_SECONDS)
+
+
+def read_upload_ticket(ticket: str, user) -> dict:
+    """
+    Verify a ticket signature, age and user. Returns its payload.
+
+    Raises:
+        UploadTicketError: if the ticket is not valid for `user`
+    """
+    try:
+        payload = signing.loads(ticket, salt=UPLOAD_TICKET_SALT, max_age=UPLOAD_TICKET_TTL_SECONDS)
+    except signing.SignatureExpired:
+        raise UploadTicketError('El ticket de subida ha caducado, solicita uno nuevo')
+    except signing.BadSignature:
+        raise UploadTicketError('Ticket de subida no válido')
+    if not user.is_authenticated or payload.get('user') != user.id:
+        raise UploadTicketError('Ticket de subida no válido')
+    return payload
+
+
+def consume_upload_ticket(payload: dict) -> bool:
+    """Mark a ticket as used; False if it was already used."""
+    return cache.add(f'upload_ticket_{payload["id"]}', True, UPLOAD_TICKET_TTL_SECONDS)
+
+
+class StagedUploadedFile(TemporaryUploadedFile):
+    """
+    Uploaded file written inside MEDIA_ROOT instead of FILE_UPLOAD_TEMP_DIR,
+    so saving it into the storage is a rename. Carries its SHA-256.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        directory = default_storage.path(UPLOAD_STAGING_DIR)
+        os.makedirs(directory, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(suffix='.upload' + os.path.splitext(name)[1], dir=directory)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = None
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """
+    Upload handler for regular transfer uploads that validates while the
+    bytes arrive: the file is written once next to the blob store, hashed on
+    the fly and sniffed from its first block. Blocked extensions, content
+    that does not match its extension and oversize bodies abort the request
+    with a 400 before the rest of the body is read.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.file = None
+        self.digest = None
+        self.head = b''
+        self.ticket = None
+        self.max_size = MAX_FILE_SIZE
+
+    def _reject(self, message):
+        if self.file is not None:
+            # Closing the NamedTemporaryFile also deletes it
+            self.file.close()
+            self.file = None
+        logger.warning(f"Upload aborted ({self.file_name}): {message}")
+        raise serializers.ValidationError({'file': message})
+
+    def _sniff(self):
+        message = sniff_content_mismatch(self.file_name, self.head)
+        if message:
+            self._reject(message)
+        self.head = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Admission is decided by the pre-flight ticket, before reading the body
+        token = META.get(UPLOAD_TICKET_HEADER)
+        if token or UPLOAD_TICKET_REQUIRED:
+            if not token:
+                self._reject('Falta el ticket de subida: solicítalo antes en /api/transfers/preflight/')
+            try:
+                self.ticket = read_upload_ticket(token, self.request.user)
+            except UploadTicketError as e:
+                self._reject(str(e))
+            self.max_size = min(self.max_size, self.ticket['size'])
+            # The view checks the ticket matches the created file
+            self.request.upload_ticket = self.ticket
+
+        if content_length > self.max_size + MULTIPART_OVERHEAD:
+            self._reject('El archivo supera el tamaño máximo permitido')
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        try:
+            # Size is checked while receiving; here only the name and extension
+            validate_upload_metadata(self.file_name, 0)
+        except serializers.ValidationError as e:
+            self._reject(e.detail['file'] if isinstance(e.detail, dict) else e.detail[0])
+        if self.ticket and os.path.splitext(self.file_name)[1].lower() != os.path.splitext(self.ticket['filename'])[1].lower():
+            self._reject('El archivo no corresponde al ticket de subida')
+        self.file = StagedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.digest = hashlib.sha256()
+        self.head = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            self._reject('El archivo supera el tamaño máximo permitido')
+        if self.head is not None:
+            self.head += raw_data[:SNIFF_BYTES]
+            if len(self.head) >= SNIFF_BYTES:
+                self._sniff()
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.head is not None:
+            self._sniff()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.digest.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def purge_staged_uploads(max_age_hours: int = UPLOAD_SESSION_TTL_HOURS) -> int:
+    """Remove staged uploads left behind by killed workers."""
+    directory = default_storage.path(UPLOAD_STAGING_DIR)
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
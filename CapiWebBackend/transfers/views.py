@@ -36,36 +36,184 @@ from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework import serializers
-from django.http import FileResponse, StreamingHttpResponse
-import threading
 from django.utils import timezone
 from datetime import timedelta
-from .models import FileTransfer, Folder, FileAccess, FolderAccess, ShareLink
+from .models import FileTransfer, Folder, FileAccess, FolderAccess, ShareLink, UploadSession
 from .serializers import (
     FileTransferSerializer,
     FolderSerializer,
     FileAccessSerializer,
     FolderAccessSerializer,
     ShareLinkSerializer,
+    UploadSessionSerializer,
+    UploadPreflightSerializer,
+    BlobClaimSerializer,
 )
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.utils.cache import patch_vary_headers
 from .security_utils import (
     load_security_config,
-    scan_archive_contents,
-    scan_file_for_malware
+    scan_archive_contents
+)
+from .thumbnail_utils import (
+    DEFAULT_RENDITION_SIZE,
+    RENDITION_TYPES,
+    is_image_file,
+    is_video_file,
+    pick_rendition,
+    rendition_name,
+)
+from .archive_utils import ArchiveEntry, archive_response, get_archive_format
+from .archive_cache_utils import cached_archive_response
+from .download_utils import file_validators, pack_response, serve_file
+from .etag_utils import conditional_listing, content_etag, rendition_etag, touch_files
+from .blob_utils import add_blob_reference, attach_blob
+from .grant_utils import inherit_grants
+from .access_utils import (
+    PERMISSION_EDIT,
+    accessible_file_ids,
+    accessible_files,
+    accessible_folder_ids,
+    accessible_folders,
+    permission_resolver,
+    shared_file_ids,
+    shared_folder_ids,
+)
+from .tree_utils import collect_archive_entries, descendants, subtree_files
+from .processing_utils import (
+    READY_STATUSES,
+    can_download,
+    downloadable_filter,
+    enqueue_processing,
+)
+from .preview_utils import (
+    PREVIEW_PENDING,
+    PREVIEW_READY,
+    THUMBNAIL_BATCH_MAX,
+    THUMBNAIL_RETRY_AFTER_SECONDS,
+    request_preview,
+)
+from .upload_utils import (
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_SESSION_TTL_HOURS,
+    ChunkLengthMismatch,
+    StreamingUploadHandler,
+    check_storage_quota,
+    lock_storage_quota,
+    consume_upload_ticket,
+    create_part_file,
+    discard_part_file,
+    finalize_part_file,
+    issue_upload_ticket,
+    write_chunk,
 )
-from .thumbnail_utils import is_image_file, is_video_file, generate_thumbnail, generate_video_thumbnail, get_thumbnail_filename
 import os
-import zipfile
-import tempfile
-from io import BytesIO
 import logging
 
 logger = logging.getLogger(__name__)
 # Load security configuration
 SECURITY_CONFIG = load_security_config()
 
+# Public share-link thumbnails: shared caches keep them at most this long
+SHARE_THUMBNAIL_MAX_AGE = 3600
+
+
+def _processing_block_response(instance):
+    """Error response for a file whose content may not be served yet (or ever)."""
+    if instance.processing_status == FileTransfer.ProcessingStatus.QUARANTINED:
+        return Response({
+            'error': 'file_quarantined',
+            'message': 'El archivo ha sido bloqueado por el análisis de seguridad'
+        }, status=status.HTTP_403_FORBIDDEN)
+    response = Response({
+        'error': 'file_pending_scan',
+        'message': 'El archivo se está analizando, inténtalo de nuevo en unos segundos'
+    }, status=status.HTTP_409_CONFLICT)
+    response['Retry-After'] = '10'
+    return response
+
+
+def _requested_size(request) -> int:
+    try:
+        return int(request.query_params.get('size', DEFAULT_RENDITION_SIZE))
+    except ValueError:
+        return DEFAULT_RENDITION_SIZE
+
+
+def _rendition_file(request, instance, size: int):
+    """(path, content type, ETag) of the best stored rendition of a blob-backed file, or None."""
+    blob = instance.blob
+    chosen = pick_rendition(blob.renditions, size, request.META.get('HTTP_ACCEPT', ''))
+    if chosen is None:
+        return None
+    name = rendition_name(blob.sha256, *chosen)
+    path = default_storage.path(name)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return path, RENDITION_TYPES[chosen[1]][1], rendition_etag(blob.sha256, os.path.basename(name), mtime_ns)
+
+
+def _rendition_response(request, instance):
+    """Serve the best stored rendition of a blob-backed file (?size=, Accept)."""
+    rendition = _rendition_file(request, instance, _requested_size(request))
+    if rendition is None:
+        return None
+    path, content_type, etag = rendition
+    response = serve_file(request, path, content_type=content_type, as_attachment=False, etag=etag)
+    response['Cache-Control'] = 'public, max-age=86400'  # Cache for 24 hours
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def _legacy_thumbnail_response(request, instance):
+    """Serve the single JPEG thumbnail of files without renditions."""
+    if instance.thumbnail and os.path.exists(instance.thumbnail.path):
+        response = serve_file(request, instance.thumbnail.path, content_type='image/jpeg', as_attachment=False)
+        response['Cache-Control'] = 'public, max-age=86400'  # Cache for 24 hours
+        return response
+    return None
+
+
+def _thumbnail_response(request, instance):
+    """
+    Serve the stored preview of a file the caller may see, queueing it for
+    the worker (see preview_utils) when missing: 200/304 with the image, 202
+    while it is generated, 404 if it cannot have one.
+    """
+    response = _rendition_response(request, instance) if instance.blob_id else None
+    if response is None:
+        response = _legacy_thumbnail_response(request, instance)
+    if response is not None:
+        return response
+
+    # If no thumbnail but it's an image or video, queue its generation
+    # (only for scanned files: unscanned content is never decoded)
+    if (instance.file and instance.processing_status in READY_STATUSES
+            and (is_image_file(instance.filename) or is_video_file(instance.filename))):
+        outcome = request_preview(instance)
+        if outcome == PREVIEW_READY:
+            instance = FileTransfer.objects.select_related('blob').get(id=instance.id)
+            response = _rendition_response(request, instance) if instance.blob_id else None
+            if response is None:
+                response = _legacy_thumbnail_response(request, instance)
+            if response is not None:
+                return response
+        elif outcome == PREVIEW_PENDING:
+            return Response(
+                {'status': 'generating', 'message': 'La miniatura se está generando'},
+                status=status.HTTP_202_ACCEPTED,
+                headers={'Retry-After': str(THUMBNAIL_RETRY_AFTER_SECONDS)}
+            )
+
+    # No thumbnail available
+    return Response({'error': 'no_thumbnail'}, status=status.HTTP_404_NOT_FOUND)
+
 
 class FolderViewSet(viewsets.ModelViewSet):
     """
@@ -123,43 +271,37 @@ class FolderViewSet(viewsets.ModelViewSet):
         - 'sent': No aplica a carpetas (retorna vacío)
         
         Optimizaciones:
+        - Acceso resuelto con una UNION de ids por índice (access_utils)
         - Prefetch de archivos no vistos para has_new_content
         - Select_related para owner y uploader
-        - Prefetch de access_list
+        - Prefetch de access_list con sus usuarios
         
         Retorna:
             QuerySet: Carpetas filtradas y optimizadas
         """
         user = self.request.user
-        from django.db.models import Prefetch
+        grants = permission_resolver(self.request).folder_grants()
         
         # Prefetch unviewed files that the user can access for has_new_content optimization
         unviewed_files_prefetch = Prefetch(
             'files',
             queryset=FileTransfer.objects.filter(
-                is_viewed=False
-            ).filter(
-                Q(owner=user) | 
-                Q(uploader=user) | 
-                Q(access_list__granted_to=user) |
-                Q(folder__access_list__granted_to=user)
-            ).distinct().only('id'),
+                is_viewed=False, id__in=accessible_file_ids(user, grants)
+            ).only('id', 'folder_id'),
             to_attr='unviewed_files_for_user'
         )
         
-        queryset = Folder.objects.filter(
-            Q(owner=user) | Q(access_list__granted_to=user)
-        ).select_related('owner', 'uploader').prefetch_related(
-            'access_list',
+        queryset = accessible_folders(user, grants).select_related('owner', 'uploader').prefetch_related(
+            Prefetch('access_list', queryset=FolderAccess.objects.select_related('granted_to', 'granted_by')),
             unviewed_files_prefetch
-        ).distinct()
+        )
 
         # Apply scope filtering for list views
         if self.action in ['list', None]:  # None for default list action
             scope = self.request.query_params.get('scope', 'mine')
             
             if scope == 'shared':
-                queryset = queryset.filter(access_list__granted_to=user).exclude(owner=user)
+                queryset = queryset.filter(id__in=shared_folder_ids(user, grants)).exclude(owner=user)
             elif scope == 'sent':
                 # Para carpetas, el scope 'sent' no aplica porque las carpetas no tienen uploader
                 # Solo los archivos pueden ser 'enviados'. Retornar vacío para carpetas.
@@ -181,10 +323,19 @@ class FolderViewSet(viewsets.ModelViewSet):
                 queryset = queryset.filter(parent__isnull=True)
 
         return queryset
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lista las carpetas (filtros scope y parent).
+        Lleva un ETag débil del contador de cambios del usuario: con
+        If-None-Match vigente responde 304 sin consultar ni serializar.
+        """
+        parent_list = super().list
+        return conditional_listing(request, lambda: parent_list(request, *args, **kwargs))
         
     def perform_create(self, serializer):
         """
-        Handle folder creation with inheritance of ownership and access
+        Handle folder creation with inheritance of ownership
         """
         folder_data = serializer.validated_data
         logger.info(f"Creating folder '{folder_data.get('name')}' by user {self.request.user.username}")
@@ -200,36 +351,23 @@ class FolderViewSet(viewsets.ModelViewSet):
             owner = self.request.user
             uploader = self.request.user
         
-        # Save with proper ownership
-        instance = serializer.save(owner=owner, uploader=uploader)
-        
-        # If created inside a shared folder, inherit access
-        if parent_folder:
-            self._inherit_folder_access(instance, parent_folder)
+        # Save with proper ownership: the accesses of the parent that propagate cover it at
+        # read time, the ones that don't are copied to it (grant_utils), in one transaction
+        with transaction.atomic():
+            instance = serializer.save(owner=owner, uploader=uploader)
+            if parent_folder:
+                inherit_grants(parent_folder, instance)
 
-    def _get_folder_permission(self, user, folder: Folder) -> str:
-        """Get the permission level for a user on a folder"""
-        logger.debug(f"Checking folder permission for user {user.username} on folder {folder.id}")
-        if user.is_anonymous:
-            return 'none'
-        
-        # Owner has full permissions
-        if folder.owner_id == user.id:
-            return 'edit'
-        
-        # Check folder access
-        folder_access = folder.access_list.filter(granted_to=user).first()
-        if folder_access:
-            return folder_access.permission
-        
-        return 'none'
+    def _get_folder_permission(self, folder: Folder) -> str:
+        """Get the permission level for the current user on a folder"""
+        return permission_resolver(self.request).folder_permission(folder)
 
     def update(self, request, *args, **kwargs):
         """Override update to check permissions for renaming folders"""
         instance = self.get_object()
         
         # Check if user has edit permission
-        permission = self._get_folder_permission(request.user, instance)
+        permission = self._get_folder_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -243,7 +381,7 @@ class FolderViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         # Check if user has edit permission
-        permission = self._get_folder_permission(request.user, instance)
+        permission = self._get_folder_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -260,31 +398,14 @@ class FolderViewSet(viewsets.ModelViewSet):
         folder = self.get_object()
         user = request.user
         
-        # Helper to get all descendant folders
-        def get_all_descendants(parent_folder):
-            descendants = []
-            children = parent_folder.subfolders.all()
-            for child in children:
-                descendants.append(child)
-                descendants.extend(get_all_descendants(child))
-            return descendants
-
-        # Collect all relevant folders (current + descendants)
-        all_folders = [folder] + get_all_descendants(folder)
-        
-        # Determine which files the user can access/view across all these folders
-        from django.db.models import Q
-        files = FileTransfer.objects.filter(
-            folder__in=all_folders,
-            is_viewed=False
-        ).filter(
-            Q(owner=user) | 
-            Q(uploader=user) | 
-            Q(access_list__granted_to=user) |
-            Q(folder__access_list__granted_to=user)
-        ).distinct()
-        
-        updated_count = files.update(is_viewed=True)
+        # Determine which files the user can access/view across the whole subtree
+        files = subtree_files(folder).filter(
+            is_viewed=False, id__in=accessible_file_ids(user, permission_resolver(request).folder_grants())
+        )
+        
+        file_ids = list(files.values_list('id', flat=True))
+        updated_count = FileTransfer.objects.filter(id__in=file_ids).update(is_viewed=True)
+        touch_files(file_ids)
         return Response({'status': 'marked as viewed recursively', 'count': updated_count})
 
     @action(detail=True, methods=['get'])
@@ -292,97 +413,40 @@ class FolderViewSet(viewsets.ModelViewSet):
         """
         Download folder as ZIP file with all contents recursively using StreamingHttpResponse
         to avoid timeouts and high memory usage.
+
+        ?archive=zip-store|tar sends the exact Content-Length; tar also accepts
+        Range so an interrupted download can be resumed.
         """
-        import zipfile
-        import io
-        
         folder = self.get_object()
 
-        if not self._has_folder_access(request.user, folder):
+        if not self._has_folder_access(folder):
             return Response({'error': 'unauthorized'}, status=status.HTTP_403_FORBIDDEN)
-        
-        # 1. Collect all files to be zipped first (Main Thread - DB Access)
-        files_to_zip = [] # List of tuples (file_path, archive_name)
-        
-        def collect_files(current_folder, path_prefix=""):
-            # Collect files
-            files = FileTransfer.objects.filter(
-                folder=current_folder
-            ).filter(
-                Q(owner=request.user)
-                | Q(access_list__granted_to=request.user)
-                | Q(folder__access_list__granted_to=request.user)
-            ).distinct()
-            
-            for file_transfer in files:
-                if file_transfer.file and hasattr(file_transfer.file, 'path'):
-                    try:
-                        # Check existence simply by access
-                        if os.path.exists(file_transfer.file.path):
-                            archive_path = os.path.join(path_prefix, file_transfer.filename)
-                            files_to_zip.append((file_transfer.file.path, archive_path))
-                    except Exception:
-                        pass
-
-            # Collect subfolders
-            subfolders = Folder.objects.filter(parent=current_folder).filter(
-                Q(owner=request.user)
-                | Q(access_list__granted_to=request.user)
-            ).distinct()
-            
-            for subfolder in subfolders:
-                subfolder_path = os.path.join(path_prefix, subfolder.name)
-                collect_files(subfolder, subfolder_path)
 
-        # Build the file list
-        collect_files(folder, folder.name)
+        try:
+            archive_format = get_archive_format(request)
+        except ValueError as e:
+            return Response({'error': 'invalid_archive_format', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Collect all files to be zipped first (DB access happens before streaming),
+        # with one query for the subfolders and one for the files of the whole tree
+        grants = permission_resolver(request).folder_grants()
+        entries = collect_archive_entries(
+            folder,
+            folder_filter=Q(id__in=accessible_folder_ids(request.user, grants)),
+            file_filter=Q(id__in=accessible_file_ids(request.user, grants)) & downloadable_filter(request.user),
+        )
         
         # Calculate approximate total size (uncompressed) for progress bar
-        total_size = sum(os.path.getsize(f[0]) for f in files_to_zip if os.path.exists(f[0]))
+        total_size = sum(os.path.getsize(entry.path) for entry in entries if os.path.exists(entry.path))
 
-        # 2. Setup Pipe and Thread for Streaming
-        r, w = os.pipe()
-        
-        def zip_writer(write_fd, file_list):
-            """Thread function to write zip to pipe"""
-            try:
-                with os.fdopen(write_fd, 'wb') as w_file:
-                    with zipfile.ZipFile(w_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-                        for file_path, archive_name in file_list:
-                            try:
-                                zf.write(file_path, archive_name)
-                            except Exception as e:
-                                print(f"Error zipping {file_path}: {e}")
-            except Exception as e:
-                print(f"Zip writer thread error: {e}")
-            # File descriptor is closed by with context or explicitly
-        
-        # Start background thread
-        t = threading.Thread(target=zip_writer, args=(w, files_to_zip))
-        t.daemon = True
-        t.start()
-        
-        # 3. Stream Generator
-        def file_iterator(read_fd):
-            with os.fdopen(read_fd, 'rb') as r_file:
-                while True:
-                    data = r_file.read(65536) # 64KB chunks
-                    if not data:
-                        break
-                    yield data
-            # Ensure thread finishes
-            t.join(timeout=1.0)
-
-        response = StreamingHttpResponse(file_iterator(r), content_type='application/zip')
-        response['Content-Disposition'] = f'attachment; filename="{folder.name}.zip"'
+        # Generator-based archive stream: no thread, bounded memory
+        response = archive_response(request, entries, folder.name, archive_format)
         # Custom header for progress estimation (Approximation: Uncompressed size)
         response['X-Total-Size'] = str(total_size)
         return response
 
-    def _has_folder_access(self, user, folder: Folder) -> bool:
-        if folder.owner_id == user.id:
-            return True
-        return folder.access_list.filter(granted_to=user).exists()
+    def _has_folder_access(self, folder: Folder) -> bool:
+        return permission_resolver(self.request).has_folder_access(folder)
 
     @action(detail=True, methods=['delete'])
     def delete_folder(self, request, pk=None):
@@ -391,7 +455,7 @@ class FolderViewSet(viewsets.ModelViewSet):
         logger.info(f"Request to delete folder {folder.id} ({folder.name}) by {request.user.username}")
         
         # Check if user has edit permission
-        permission = self._get_folder_permission(request.user, folder)
+        permission = self._get_folder_permission(folder)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -412,31 +476,32 @@ class FolderViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Error al eliminar la carpeta'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def _delete_folder_contents(self, folder, user):
-        """Recursively delete all files and subfolders in a folder"""
-        # Delete all files in this folder
-        files = FileTransfer.objects.filter(
-            folder=folder
-        ).filter(
-            Q(owner=user) | Q(uploader=user)
-        )
-        
-        for file in files:
-            if file.file and os.path.exists(file.file.path):
-                file.file.delete()  # Delete physical file
-            file.delete()  # Delete database record
-        
-        # Recursively delete subfolders
-        subfolders = Folder.objects.filter(parent=folder, owner=user)
-        for subfolder in subfolders:
-            self._delete_folder_contents(subfolder, user)  # Recursive call
-            subfolder.delete()  # Delete the subfolder
+        """
+        Delete the user's files in a folder and in the subfolders they own,
+        and those subfolders. Subfolders of other owners (and what is below
+        them) are left to the cascade of the folder delete.
+        """
+        # Subfolders reachable through folders owned by the user
+        children = {}
+        for folder_id, parent_id in descendants(folder).filter(owner=user).values_list('id', 'parent_id'):
+            children.setdefault(parent_id, []).append(folder_id)
+        reachable = []
+        pending = [folder.id]
+        while pending:
+            folder_id = pending.pop()
+            reachable.append(folder_id)
+            pending.extend(children.get(folder_id, []))
+
+        # Delete database records (the blob references are released by a signal)
+        FileTransfer.objects.filter(folder_id__in=reachable).filter(Q(owner=user) | Q(uploader=user)).delete()
+        Folder.objects.filter(id__in=reachable[1:]).delete()
 
     @action(detail=True, methods=['get', 'post'], url_path='access')
     def manage_access(self, request, pk=None):
         folder = self.get_object()
         
         # Check if user has edit permission to manage access
-        permission = self._get_folder_permission(request.user, folder)
+        permission = self._get_folder_permission(folder)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -483,10 +548,8 @@ class FolderViewSet(viewsets.ModelViewSet):
             }
         )
 
-        # Si se debe propagar el acceso, aplicarlo a todos los elementos internos
-        if propagate:
-            self._propagate_access_to_contents(folder, user, request.user, permission, request.data.get('expires_at'))
-
+        # Con propagate el acceso cubre todo el subárbol al comprobarse (access_utils),
+        # sin copiarlo a cada subcarpeta y archivo
         serializer = FolderAccessSerializer(access)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -495,7 +558,7 @@ class FolderViewSet(viewsets.ModelViewSet):
         folder = self.get_object()
         
         # Check if user has edit permission to manage access
-        permission = self._get_folder_permission(request.user, folder)
+        permission = self._get_folder_permission(folder)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -518,74 +581,6 @@ class FolderViewSet(viewsets.ModelViewSet):
         access.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-    def _propagate_access_to_contents(self, folder, user, granted_by, permission, expires_at):
-        """
-        Propaga el acceso de una carpeta a todos sus contenidos (archivos y subcarpetas)
-        """
-        from django.db.models import Q
-        
-        # Propagar a subcarpetas
-        subfolders = Folder.objects.filter(parent=folder)
-        for subfolder in subfolders:
-            FolderAccess.objects.update_or_create(
-                folder=subfolder,
-                granted_to=user,
-                defaults={
-                    'granted_by': granted_by,
-                    'permission': permission,
-                    'expires_at': expires_at
-                }
-            )
-            # Recursividad para subcarpetas anidadas
-            self._propagate_access_to_contents(subfolder, user, granted_by, permission, expires_at)
-        
-        # Propagar a archivos
-        files = FileTransfer.objects.filter(folder=folder)
-        for file in files:
-            FileAccess.objects.update_or_create(
-                file=file,
-                granted_to=user,
-                defaults={
-                    'granted_by': granted_by,
-                    'permission': permission,
-                    'expires_at': expires_at
-                }
-            )
-
-    def _inherit_folder_access(self, new_folder, parent_folder):
-        """
-        Hereda los accesos de la carpeta padre a la nueva carpeta
-        """
-        parent_accesses = FolderAccess.objects.filter(folder=parent_folder)
-        
-        for access in parent_accesses:
-            FolderAccess.objects.update_or_create(
-                folder=new_folder,
-                granted_to=access.granted_to,
-                defaults={
-                    'granted_by': access.granted_by,
-                    'permission': access.permission,
-                    'expires_at': access.expires_at
-                }
-            )
-
-    def _inherit_file_access(self, new_file, parent_folder):
-        """
-        Hereda los accesos de la carpeta padre al nuevo archivo
-        """
-        folder_accesses = FolderAccess.objects.filter(folder=parent_folder)
-        
-        for access in folder_accesses:
-            FileAccess.objects.update_or_create(
-                file=new_file,
-                granted_to=access.granted_to,
-                defaults={
-                    'granted_by': access.granted_by,
-                    'permission': access.permission,
-                    'expires_at': access.expires_at
-                }
-            )
-
 class FileTransferViewSet(viewsets.ModelViewSet):
     """
     ViewSet para la gestión de archivos en el sistema de transferencias.
@@ -602,8 +597,14 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         DELETE /api/files/{id}/               - Elimina un archivo
     
     Acciones personalizadas:
+        POST   /api/files/uploads/            - Crea sesión de subida por fragmentos
+        GET    /api/files/uploads/{upload_id}/ - Estado/offset de la sesión
+        PUT    /api/files/uploads/{upload_id}/chunks/{n}/ - Envía el fragmento n
+        POST   /api/files/uploads/{upload_id}/complete/ - Finaliza y crea el archivo
+        DELETE /api/files/uploads/{upload_id}/ - Cancela la sesión
         GET    /api/files/{id}/download/      - Descarga el archivo
         GET    /api/files/{id}/thumbnail/     - Obtiene miniatura (imágenes/videos)
+        GET    /api/files/thumbnails/?ids=    - Miniaturas de varios archivos en una respuesta
         GET    /api/files/{id}/check_archive/ - Verifica ejecutables en archivos comprimidos
         POST   /api/files/{id}/mark_viewed/   - Marca como visto
         DELETE /api/files/{id}/delete_file/   - Elimina archivo y fichero físico
@@ -648,6 +649,16 @@ class FileTransferViewSet(viewsets.ModelViewSet):
     parser_classes = (MultiPartParser, FormParser, JSONParser)
     pagination_class = None  # Deshabilitar paginación para mostrar todos los archivos
 
+    def initialize_request(self, request, *args, **kwargs):
+        """
+        Las subidas multipart se validan y hashean mientras llegan los bytes
+        (StreamingUploadHandler) y se escriben una sola vez junto al almacén.
+        """
+        drf_request = super().initialize_request(request, *args, **kwargs)
+        if self.action == 'create':
+            request.upload_handlers = [StreamingUploadHandler(request)]
+        return drf_request
+
     def get_queryset(self):
         """
         Obtiene el queryset de archivos accesibles para el usuario actual.
@@ -659,9 +670,11 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         4. Tiene acceso a la carpeta contenedora
         
         Optimizaciones:
-            - Prefetch de access_list
+            - Select_related de owner y uploader
+            - Prefetch de access_list con sus usuarios
             - Ordenamiento por fecha de creación descendente
-            - Distinct para evitar duplicados por múltiples accesos
+            - Acceso resuelto con una UNION de ids por índice (access_utils),
+              sin joins que dupliquen filas ni DISTINCT
         
         Retorna:
             QuerySet: Archivos filtrados y ordenados
@@ -670,12 +683,10 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         if not user.is_authenticated:
             return FileTransfer.objects.none()
 
-        return FileTransfer.objects.filter(
-            Q(owner=user)
-            | Q(uploader=user)
-            | Q(access_list__granted_to=user)
-            | Q(folder__access_list__granted_to=user)
-        ).prefetch_related('access_list').order_by('-created_at').distinct()
+        grants = permission_resolver(self.request).folder_grants()
+        return accessible_files(user, grants).select_related('owner', 'uploader').prefetch_related(
+            Prefetch('access_list', queryset=FileAccess.objects.select_related('granted_to', 'granted_by'))
+        ).order_by('-created_at')
 
     def update(self, request, *args, **kwargs):
         """
@@ -695,7 +706,7 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         # Check if user has edit permission
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -709,7 +720,7 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         # Check if user has edit permission
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -719,15 +730,20 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         return super().partial_update(request, *args, **kwargs)
 
     def list(self, request, *args, **kwargs):
+        """
+        Lista los archivos visibles (filtros scope y folder).
+        Lleva un ETag débil del contador de cambios del usuario: con
+        If-None-Match vigente responde 304 sin consultar ni serializar.
+        """
+        return conditional_listing(request, lambda: self._list_files(request))
+
+    def _list_files(self, request):
         queryset = self.get_queryset()
         user = request.user
         scope = request.query_params.get('scope', 'all')
 
         if scope == 'shared':
-            queryset = queryset.filter(
-                Q(access_list__granted_to=user)
-                | Q(folder__access_list__granted_to=user)
-            )
+            queryset = queryset.filter(id__in=shared_file_ids(user, permission_resolver(request).folder_grants()))
         elif scope == 'sent':
             # Archivos que otros usuarios han enviado al usuario actual
             queryset = queryset.filter(uploader__in=User.objects.exclude(id=user.id), owner=user)
@@ -783,29 +799,19 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         # Update cache with current time
         cache.set(cache_key, timezone.now(), large_cooldown)
 
-    def perform_create(self, serializer):
-        """
-        Set the sender to the current user and expires_at to 3 days from now
-        Handle inheritance of ownership and access for files in shared folders
-        """
+    def _check_upload_permission(self):
+        """Raise PermissionDenied if the current user cannot upload files"""
         from .permissions import has_fileshare_permission
         
         # Check permissions (Staff, Superuser, or fileshareGROUP)
         if not has_fileshare_permission(self.request.user):
             from rest_framework.exceptions import PermissionDenied
             raise PermissionDenied('No tienes permisos para subir archivos. Contacta al administrador.')
-        
-        # Get file size from request
-        file_obj = self.request.FILES.get('file')
-        if file_obj:
-            logger.info(f"Starting file upload: {file_obj.name} ({file_obj.size} bytes) by {self.request.user.username}")
-            # Check rate limit before saving
-            self.check_rate_limit(self.request.user, file_obj.size)
-        
-        # Determine ownership based on parent folder
-        folder = serializer.validated_data.get('folder')
-        received_owner = serializer.validated_data.get('owner')
-        
+
+    def _resolve_upload_ownership(self, folder, received_owner):
+        """
+        Determine (owner, uploader) for a new file based on parent folder
+        """
         if received_owner:
             # Use owner sent from frontend
             owner = User.objects.get(id=received_owner.id)
@@ -818,51 +824,347 @@ class FileTransferViewSet(viewsets.ModelViewSet):
             # If uploading to root, uploader is both owner and uploader
             owner = self.request.user
             uploader = self.request.user
+        return owner, uploader
+
+    def _check_folder_upload_permission(self, folder):
+        """Raise PermissionDenied if the current user cannot add files to `folder`"""
+        if folder is None:
+            return
+        if permission_resolver(self.request).folder_permission(folder) != PERMISSION_EDIT:
+            from rest_framework.exceptions import PermissionDenied
+            raise PermissionDenied('No tienes permisos para subir archivos a esta carpeta.')
+
+    def _admit_upload(self, size, folder, owner):
+        """
+        Checks every upload runs before receiving bytes: folder edit permission,
+        owner quota and rate limiting. Extension and size are validated by the serializers.
+        """
+        self._check_folder_upload_permission(folder)
+        check_storage_quota(owner, size)
+        self.check_rate_limit(self.request.user, size)
+
+    def perform_create(self, serializer):
+        """
+        Set the sender to the current user and expires_at to 3 days from now
+        Handle inheritance of ownership and access for files in shared folders
+        """
+        self._check_upload_permission()
+        
+        # Determine ownership based on parent folder
+        folder = serializer.validated_data.get('folder')
+        owner, uploader = self._resolve_upload_ownership(folder, serializer.validated_data.get('owner'))
+        
+        # Get file size from request
+        file_obj = self.request.FILES.get('file')
+        ticket = getattr(self.request, 'upload_ticket', None)
+        if ticket is not None:
+            # Admitted by the pre-flight: the ticket must describe this upload, once
+            if (ticket['filename'] != serializer.validated_data.get('filename')
+                    or ticket['folder'] != (folder.id if folder else None)
+                    or ticket['owner'] != owner.id
+                    or not consume_upload_ticket(ticket)):
+                raise serializers.ValidationError({'file': 'El ticket de subida no corresponde a este archivo'})
+        elif file_obj:
+            logger.info(f"Starting file upload: {file_obj.name} ({file_obj.size} bytes) by {self.request.user.username}")
+            self._admit_upload(file_obj.size, folder, owner)
         
         # Save the file with proper ownership
-        instance = serializer.save(
-            owner=owner,
-            uploader=uploader,
-            expires_at=timezone.now() + timedelta(days=3)
+        with transaction.atomic():
+            if file_obj:
+                # Uploads admitted in parallel must also fit in the quota together
+                lock_storage_quota(owner, file_obj.size)
+            instance = serializer.save(
+                owner=owner,
+                uploader=uploader,
+                expires_at=timezone.now() + timedelta(days=3),
+                processing_status=FileTransfer.ProcessingStatus.PENDING_SCAN if file_obj else FileTransfer.ProcessingStatus.CLEAN
+            )
+        
+        # Move the bytes into the content-addressed store (a duplicate only adds a reference)
+        if file_obj:
+            attach_blob(instance, instance.file.path, getattr(file_obj, 'sha256', None))
+            instance.save(update_fields=['blob', 'file'])
+        
+        # Malware scan and thumbnails run in the background worker
+        if file_obj:
+            enqueue_processing(instance)
+
+    def _get_upload_session(self, upload_id):
+        """Return the active upload session of the current user or None"""
+        try:
+            return UploadSession.objects.get(id=upload_id, uploader=self.request.user)
+        except (UploadSession.DoesNotExist, ValueError, DjangoValidationError):
+            return None
+
+    @action(detail=False, methods=['post'], url_path='preflight')
+    def preflight(self, request):
+        """
+        Pre-admisión de una subida: ejecuta todas las comprobaciones antes de enviar ningún byte.
+        
+        Body (JSON): filename, size, folder (opcional), owner (opcional)
+        
+        Comprueba extensión, tamaño, permiso de subida, permiso de edición en la
+        carpeta destino, cuota del propietario y rate limiting. La subida debe
+        enviar el ticket en la cabecera X-Upload-Ticket antes de que caduque;
+        si no, se rechaza sin leer el cuerpo.
+        
+        Retorna:
+            200 con ticket y expires_at
+            400/403 con el motivo por el que la subida sería rechazada
+        """
+        self._check_upload_permission()
+        
+        serializer = UploadPreflightSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        folder = data.get('folder')
+        owner, _uploader = self._resolve_upload_ownership(folder, data.get('owner'))
+        self._admit_upload(data['size'], folder, owner)
+        
+        ticket, expires_at = issue_upload_ticket(request.user, data['filename'], data['size'], folder, owner)
+        return Response({'ticket': ticket, 'expires_at': expires_at})
+
+    @action(detail=False, methods=['post'], url_path='uploads')
+    def create_upload(self, request):
+        """
+        Crea una sesión de subida por fragmentos (reanudable).
+        
+        Body (JSON): filename, size, folder (opcional), owner (opcional), description (opcional)
+        
+        Aplica las mismas validaciones que una subida normal (extensión, tamaño,
+        permisos y rate limiting) antes de recibir ningún byte.
+        
+        Retorna:
+            201 con la sesión: id, chunk_size, total_chunks, received_bytes...
+        """
+        self._check_upload_permission()
+        
+        serializer = UploadSessionSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        folder = serializer.validated_data.get('folder')
+        owner, _uploader = self._resolve_upload_ownership(folder, serializer.validated_data.get('owner'))
+        self._admit_upload(serializer.validated_data['size'], folder, owner)
+        
+        session = serializer.save(
+            uploader=request.user,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            expires_at=timezone.now() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
         )
+        create_part_file(session)
+        logger.info(f"Upload session {session.id} created: {session.filename} ({session.size} bytes) by {request.user.username}")
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='claim')
+    def claim(self, request):
+        """
+        Subida instantánea: crea el archivo a partir de contenido que el servidor ya tiene.
         
-        # If uploaded to a shared folder, inherit access
-        if folder:
-            self._inherit_file_access(instance, folder)
-        
-        # Scan file for malware
-        if file_obj and hasattr(instance.file, 'path'):
-            is_safe, message = scan_file_for_malware(instance.file.path)
-            if not is_safe:
-                # Delete the file and instance
-                instance.file.delete()
-                instance.delete()
-                raise serializers.ValidationError({
-                    'file': f'El archivo fue detectado como malware: {message}'
-                })
-            
-            # Scan archive contents for executables
-            ext = os.path.splitext(instance.filename)[1].lower()
-            if ext in ['.zip', '.rar', '.7z', '.tar', '.gz', '.bz2']:
-                has_executables, executable_list = scan_archive_contents(instance.file.path)
-                if has_executables:
-                    # Store this information in the instance (you might want to add fields to the model)
-                    # For now, we'll just log it
-                    print(f"Archive contains executables: {executable_list}")
-            
-            # Generate thumbnail for image files
-            if is_image_file(instance.filename):
-                thumbnail_content = generate_thumbnail(instance.file.path)
-                if thumbnail_content:
-                    thumb_filename = get_thumbnail_filename(instance.filename)
-                    instance.thumbnail.save(thumb_filename, thumbnail_content, save=True)
+        Body (JSON): sha256, size, filename, folder (opcional), owner (opcional), description (opcional)
+        
+        Solo se reutiliza contenido de archivos a los que el usuario ya tiene acceso
+        (reenviar o recompartir), para no revelar si otro usuario ha subido unos bytes
+        concretos. Aplica las mismas validaciones que una subida normal (extensión,
+        tamaño, permisos, rate limiting) y la misma herencia de propietario y accesos.
+        
+        Retorna:
+            201 con el archivo creado, sin transferir ningún byte
+            404 si no hay contenido reutilizable: el cliente debe subir el archivo
+        """
+        self._check_upload_permission()
+        
+        serializer = BlobClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        folder = data.get('folder')
+        owner, uploader = self._resolve_upload_ownership(folder, data.get('owner'))
+        self._admit_upload(data['size'], folder, owner)
+        
+        user = request.user
+        source = FileTransfer.objects.filter(
+            blob__sha256=data['sha256'],
+            blob__size=data['size'],
+            id__in=accessible_file_ids(user, permission_resolver(request).folder_grants())
+        ).first()
+        
+        with transaction.atomic():
+            blob = add_blob_reference(source.blob_id) if source else None
+            if blob is None:
+                return Response({
+                    'error': 'content_not_found',
+                    'message': 'El contenido no está disponible, sube el archivo'
+                }, status=status.HTTP_404_NOT_FOUND)
             
-            # Generate thumbnail for video files
-            elif is_video_file(instance.filename):
-                thumbnail_content = generate_video_thumbnail(instance.file.path)
-                if thumbnail_content:
-                    thumb_filename = get_thumbnail_filename(instance.filename)
-                    instance.thumbnail.save(thumb_filename, thumbnail_content, save=True)
+            instance = FileTransfer(
+                owner=owner,
+                uploader=uploader,
+                folder=folder,
+                blob=blob,
+                filename=data['filename'],
+                size=blob.size,
+                description=data.get('description'),
+                expires_at=timezone.now() + timedelta(days=3),
+            )
+            instance.file.name = blob.file.name
+            # Same bytes, same verdict and preview as the file they come from
+            instance.processing_status = source.processing_status
+            if source.thumbnail:
+                instance.thumbnail.name = source.thumbnail.name
+            lock_storage_quota(owner, instance.size)
+            instance.save()
+        logger.info(f"FileTransfer created by hash claim: {instance.filename} (ID: {instance.id}) blob {blob.sha256[:12]} Owner: {instance.owner.username}")
+        
+        # The source is still waiting for its scan: scan this copy too
+        if instance.processing_status == FileTransfer.ProcessingStatus.PENDING_SCAN:
+            enqueue_processing(instance)
+        
+        return Response(self.get_serializer(instance).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get', 'delete'], url_path=r'uploads/(?P<upload_id>[^/.]+)')
+    def upload_status(self, request, upload_id=None):
+        """
+        GET: Estado de la sesión (received_bytes es el offset desde el que reanudar).
+        DELETE: Cancela la sesión y elimina el fichero parcial.
+        """
+        session = self._get_upload_session(upload_id)
+        if not session:
+            return Response({'error': 'Upload session not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        if request.method.lower() == 'delete':
+            if session.status == UploadSession.Status.ACTIVE:
+                session.status = UploadSession.Status.ABORTED
+                session.save(update_fields=['status', 'updated_at'])
+                discard_part_file(session)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        
+        response = Response(UploadSessionSerializer(session).data)
+        response['Upload-Offset'] = str(session.received_bytes)
+        return response
+
+    @action(detail=False, methods=['put'], url_path=r'uploads/(?P<upload_id>[^/.]+)/chunks/(?P<index>[0-9]+)')
+    def upload_chunk(self, request, upload_id=None, index=None):
+        """
+        Recibe el fragmento número `index` como cuerpo binario (application/octet-stream).
+        
+        Los fragmentos se envían en orden. Reenviar uno ya recibido es idempotente,
+        y un fragmento fuera de orden devuelve 409 con el offset esperado.
+        El cuerpo se escribe en disco en bloques de 64KB (memoria constante).
+        """
+        session = self._get_upload_session(upload_id)
+        if not session:
+            return Response({'error': 'Upload session not found'}, status=status.HTTP_404_NOT_FOUND)
+        if session.status != UploadSession.Status.ACTIVE:
+            return Response({'error': 'upload_not_active', 'status': session.status}, status=status.HTTP_409_CONFLICT)
+        if session.expires_at < timezone.now():
+            return Response({'error': 'upload_expired'}, status=status.HTTP_410_GONE)
+        
+        index = int(index)
+        if index >= session.total_chunks:
+            return Response({'error': 'Chunk index out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if index < session.received_chunks:
+            # Already received (client retry after a lost response)
+            return Response(UploadSessionSerializer(session).data)
+        
+        if index > session.received_chunks:
+            return Response({
+                'error': 'unexpected_chunk',
+                'expected_chunk': session.received_chunks,
+                'received_bytes': session.received_bytes,
+            }, status=status.HTTP_409_CONFLICT)
+        
+        try:
+            write_chunk(request.stream, session, index)
+        except ChunkLengthMismatch as e:
+            return Response({'error': 'invalid_chunk_length', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Advance only if nobody else advanced the session concurrently
+        advanced = UploadSession.objects.filter(
+            id=session.id, received_chunks=index, status=UploadSession.Status.ACTIVE
+        ).update(received_chunks=index + 1, updated_at=timezone.now())
+        if not advanced:
+            session.refresh_from_db()
+            return Response({
+                'error': 'unexpected_chunk',
+                'expected_chunk': session.received_chunks,
+                'received_bytes': session.received_bytes,
+            }, status=status.HTTP_409_CONFLICT)
+        
+        session.received_chunks = index + 1
+        response = Response(UploadSessionSerializer(session).data)
+        response['Upload-Offset'] = str(session.received_bytes)
+        return response
+
+    @action(detail=False, methods=['post'], url_path=r'uploads/(?P<upload_id>[^/.]+)/complete')
+    def complete_upload(self, request, upload_id=None):
+        """
+        Finaliza la sesión y crea el FileTransfer.
+        
+        Aplica la misma herencia de propiedad y accesos que perform_create,
+        seguida del escaneo de malware y la generación de miniaturas.
+        El fichero parcial se mueve (rename) a su ubicación final, sin copias.
+        """
+        self._check_upload_permission()
+        
+        session = self._get_upload_session(upload_id)
+        if not session:
+            return Response({'error': 'Upload session not found'}, status=status.HTTP_404_NOT_FOUND)
+        if session.status == UploadSession.Status.COMPLETED and session.file_transfer_id:
+            return Response(self.get_serializer(session.file_transfer).data)
+        if session.status != UploadSession.Status.ACTIVE:
+            return Response({'error': 'upload_not_active', 'status': session.status}, status=status.HTTP_409_CONFLICT)
+        if session.received_chunks < session.total_chunks:
+            return Response({
+                'error': 'upload_incomplete',
+                'expected_chunk': session.received_chunks,
+                'received_bytes': session.received_bytes,
+            }, status=status.HTTP_409_CONFLICT)
+        
+        # Claim the session so a concurrent complete cannot finalize it twice
+        claimed = UploadSession.objects.filter(
+            id=session.id, status=UploadSession.Status.ACTIVE
+        ).update(status=UploadSession.Status.COMPLETED, updated_at=timezone.now())
+        if not claimed:
+            return Response({'error': 'upload_not_active'}, status=status.HTTP_409_CONFLICT)
+        
+        try:
+            part_path = finalize_part_file(session)
+        except (ChunkLengthMismatch, OSError) as e:
+            logger.error(f"Upload session {session.id} could not be finalized: {e}")
+            UploadSession.objects.filter(id=session.id).update(status=UploadSession.Status.ABORTED)
+            discard_part_file(session)
+            return Response({'error': 'upload_corrupted'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        folder = session.folder
+        owner, uploader = self._resolve_upload_ownership(folder, session.owner)
+        
+        instance = FileTransfer(
+            owner=owner,
+            uploader=uploader,
+            folder=folder,
+            filename=session.filename,
+            size=session.size,
+            description=session.description,
+            expires_at=timezone.now() + timedelta(days=3),
+            processing_status=FileTransfer.ProcessingStatus.PENDING_SCAN,
+        )
+        try:
+            with transaction.atomic():
+                # The session was admitted when it was created; other uploads may have filled the quota since
+                lock_storage_quota(owner, session.size)
+                # Content-addressed storage: a duplicate only adds a reference
+                attach_blob(instance, part_path)
+                instance.save()
+        except serializers.ValidationError:
+            UploadSession.objects.filter(id=session.id).update(status=UploadSession.Status.ABORTED)
+            discard_part_file(session)
+            raise
+        logger.info(f"FileTransfer created from upload session {session.id}: {instance.filename} (ID: {instance.id}) Owner: {instance.owner.username}")
+        
+        # Malware scan and thumbnails run in the background worker
+        enqueue_processing(instance)
+        
+        UploadSession.objects.filter(id=session.id).update(file_transfer=instance)
+        return Response(self.get_serializer(instance).data, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
@@ -871,63 +1173,98 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         """
         instance = self.get_object()
         
-        if not self._has_file_access(request.user, instance):
+        if not self._has_file_access(instance):
             return Response({'error': 'unauthorized'}, status=status.HTTP_403_FORBIDDEN)
 
-        if request.user == instance.owner:
+        if not can_download(instance, request.user):
+            return _processing_block_response(instance)
+
+        if request.user == instance.owner and not instance.is_downloaded:
             instance.is_downloaded = True
             instance.save(update_fields=['is_downloaded'])
-            
-        response = FileResponse(instance.file.open(), as_attachment=True, filename=instance.filename)
-        return response
+        
+        if not instance.file or not os.path.exists(instance.file.path):
+            return Response({'error': 'Archivo no encontrado en el servidor'}, status=status.HTTP_404_NOT_FOUND)
+        
+        # Supports Range/If-Range so players can seek and downloads can resume
+        return serve_file(request, instance.file.path, filename=instance.filename, etag=content_etag(instance))
 
     @action(detail=True, methods=['get'])
     def thumbnail(self, request, pk=None):
         """
         Serve the thumbnail image for gallery preview.
         Falls back to a placeholder if no thumbnail exists.
+
+        ?size=<px> picks the rendition (longest side) and the format is
+        negotiated with the Accept header (AVIF > WebP > JPEG).
+
+        Missing previews are generated on demand, once per content and with
+        bounded concurrency (see preview_utils); while that runs the answer
+        is 202 with Retry-After.
         """
         instance = self.get_object()
         
-        if not self._has_file_access(request.user, instance):
+        if not self._has_file_access(instance):
             return Response({'error': 'unauthorized'}, status=status.HTTP_403_FORBIDDEN)
         
-        # Return thumbnail if it exists
-        if instance.thumbnail:
-            response = FileResponse(
-                instance.thumbnail.open(),
-                content_type='image/jpeg'
-            )
-            response['Cache-Control'] = 'public, max-age=86400'  # Cache for 24 hours
-            return response
-        
-        # If no thumbnail but it's an image, try to generate one on-the-fly
-        # If no thumbnail but it's an image or video, try to generate one on-the-fly
-        if instance.file and hasattr(instance.file, 'path'):
-            try:
-                thumbnail_content = None
-                
-                if is_image_file(instance.filename):
-                    thumbnail_content = generate_thumbnail(instance.file.path)
-                elif is_video_file(instance.filename):
-                    thumbnail_content = generate_video_thumbnail(instance.file.path)
-                
-                if thumbnail_content:
-                    thumb_filename = get_thumbnail_filename(instance.filename)
-                    instance.thumbnail.save(thumb_filename, thumbnail_content, save=True)
-                    instance.refresh_from_db()
-                    
-                    response = FileResponse(
-                        instance.thumbnail.open(),
-                        content_type='image/jpeg'
-                    )
-                    response['Cache-Control'] = 'public, max-age=86400'
-                    return response
-            except Exception as e:
-                print(f"Error generating thumbnail on-the-fly for {instance.id}: {e}")
-        
-        # No thumbnail available
-        return Response({'error': 'no_thumbnail'}, status=status.HTTP_404_NOT_FOUND)
+        return _thumbnail_response(request, instance)
+
+    @action(detail=False, methods=['get'])
+    def thumbnails(self, request):
+        """
+        Miniaturas de varios archivos en una sola respuesta, para galerías.
+        GET /api/transfers/thumbnails/?ids=1,2,3&size=160
+
+        El acceso a todos se comprueba con una sola consulta. Devuelve un
+        paquete (ver download_utils.pack_response): una línea JSON con el
+        índice {files: [{id, offset, length, content_type, etag}], missing}
+        seguida de las imágenes concatenadas. `missing` indica por id por qué
+        no se incluyó: 'not_found' (no existe o sin acceso), 'unavailable'
+        (sin analizar o en cuarentena) o 'missing' (sin miniatura guardada:
+        el cliente la pide a /{id}/thumbnail/, que la genera).
+
+        Solo versiones pequeñas: ?size= se limita a la de galería (400).
+        """
+        raw_ids = request.query_params.get('ids', '').split(',')
+        try:
+            ids = list(dict.fromkeys(int(value) for value in raw_ids if value.strip()))
+        except ValueError:
+            return Response({'error': 'invalid_ids', 'message': 'ids debe ser una lista de enteros separados por comas'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not ids or len(ids) > THUMBNAIL_BATCH_MAX:
+            return Response({
+                'error': 'invalid_ids',
+                'message': f'Indica entre 1 y {THUMBNAIL_BATCH_MAX} archivos'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        size = min(_requested_size(request), DEFAULT_RENDITION_SIZE)
+
+        # Same visibility filter as the rest of the viewset, for all ids at once
+        files = {
+            instance.id: instance
+            for instance in self.get_queryset().filter(id__in=ids).select_related('blob').prefetch_related(None)
+        }
+        parts = []
+        missing = {}
+        for file_id in ids:
+            instance = files.get(file_id)
+            if instance is None:
+                missing[str(file_id)] = 'not_found'
+                continue
+            if instance.processing_status not in READY_STATUSES:
+                missing[str(file_id)] = 'unavailable'
+                continue
+            preview = _rendition_file(request, instance, size) if instance.blob_id else None
+            if preview is None and instance.thumbnail and os.path.exists(instance.thumbnail.path):
+                preview = (instance.thumbnail.path, 'image/jpeg', file_validators(instance.thumbnail.path)[0])
+            if preview is None:
+                missing[str(file_id)] = 'missing'
+                continue
+            parts.append((file_id, *preview))
+
+        response = pack_response(request, parts, {'missing': missing})
+        response['Cache-Control'] = 'private, max-age=86400'
+        patch_vary_headers(response, ['Accept'])
+        return response
 
     @action(detail=True, methods=['get'])
     def check_archive(self, request, pk=None):
@@ -961,7 +1298,7 @@ class FileTransferViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def mark_viewed(self, request, pk=None):
         instance = self.get_object()
-        if not self._has_file_access(request.user, instance):
+        if not self._has_file_access(instance):
             return Response({'status': 'unauthorized'}, status=status.HTTP_403_FORBIDDEN)
 
         if request.user == instance.owner:
@@ -974,15 +1311,13 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         # Check if user has edit permission
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
                 'message': 'No tienes permisos para eliminar este archivo'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        if instance.file:
-            instance.file.delete()
         instance.delete()
         return Response({'status': 'deleted'}, status=status.HTTP_200_OK)
 
@@ -992,7 +1327,7 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         folder_id = request.data.get('folder_id')
         
         # Check if user has edit permission
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -1013,143 +1348,89 @@ class FileTransferViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'], url_path='download_multiple')
     def download_multiple(self, request):
-        """Download multiple files and folders as a ZIP"""
-        print("DOWNLOAD_MULTIPLE METHOD CALLED!")
-        
-        # Debug: log received data
-        print(f"DEBUG: request.data = {request.data}")
-        print(f"DEBUG: request.FILES = {request.FILES}")
-        
+        """Download multiple files and folders as a streamed ZIP"""
         file_ids = request.data.getlist('file_ids[]', [])
         folder_ids = request.data.getlist('folder_ids[]', [])
-        
-        print(f"DEBUG: file_ids = {file_ids}")
-        print(f"DEBUG: folder_ids = {folder_ids}")
+        logger.debug(f"download_multiple: file_ids={file_ids} folder_ids={folder_ids}")
         
         if not file_ids and not folder_ids:
             return Response({'error': 'No files or folders specified'}, status=status.HTTP_400_BAD_REQUEST)
+        grants = permission_resolver(request).folder_grants()
+
+        try:
+            archive_format = get_archive_format(request)
+        except ValueError as e:
+            return Response({'error': 'invalid_archive_format', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Create a ZIP file in memory
-        zip_buffer = BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Add files to ZIP
-            for file_id in file_ids:
-                try:
-                    file_transfer = FileTransfer.objects.filter(
-                        id=file_id
-                    ).filter(
-                        Q(owner=request.user) | Q(uploader=request.user) | Q(access_list__granted_to=request.user)
-                    ).first()
-                    
-                    if file_transfer and file_transfer.file and os.path.exists(file_transfer.file.path):
-                        # Add file to ZIP with original filename
-                        zip_file.write(
-                            file_transfer.file.path,
-                            os.path.basename(file_transfer.file.name)
-                        )
-                        print(f"Added file: {file_transfer.file.name}")
-                except Exception as e:
-                    print(f"Error adding file {file_id}: {e}")
-                    continue  # Skip files user doesn't have access to
-            
-            # Add folders to ZIP
-            for folder_id in folder_ids:
-                try:
-                    folder = Folder.objects.filter(
-                        id=folder_id
-                    ).filter(
-                        Q(owner=request.user) | Q(access_list__granted_to=request.user)
-                    ).first()
-                    if folder:
-                        # Add all files in this folder and subfolders
-                        self._add_folder_to_zip(zip_file, folder, request.user, '')
-                        print(f"Added folder: {folder.name}")
-                    
-                except Exception as e:
-                    print(f"Error adding folder {folder_id}: {e}")
-                    continue  # Skip folders user doesn't have access to
-        
-        zip_buffer.seek(0)
-        
-        # Create response with ZIP file
-        response = FileResponse(
-            zip_buffer,
-            as_attachment=True,
-            filename=f'archivos_seleccionados_{timezone.now().strftime("%Y%m%d_%H%M%S")}.zip'
-        )
-        response['Content-Type'] = 'application/zip'
+        entries = []
         
-        print(f"ZIP created successfully with {len(file_ids)} files and {len(folder_ids)} folders")
-        return response
-    
-    def _add_folder_to_zip(self, zip_file, folder, user, base_path):
-        """Recursively add folder contents to ZIP"""
-        folder_path = os.path.join(base_path, folder.name) if base_path else folder.name
-        
-        # Add files in this folder
-        files = FileTransfer.objects.filter(
-            folder=folder
-        ).filter(
-            Q(owner=user) | Q(uploader=user) | Q(access_list__granted_to=user)
-        )
-        
-        for file_transfer in files:
-            if file_transfer.file and os.path.exists(file_transfer.file.path):
-                zip_file.write(
-                    file_transfer.file.path,
-                    os.path.join(folder_path, os.path.basename(file_transfer.file.name))
-                )
+        # Add files to ZIP
+        for file_id in file_ids:
+            try:
+                file_transfer = FileTransfer.objects.filter(
+                    id=file_id
+                ).filter(
+                    id__in=accessible_file_ids(request.user, grants)
+                ).filter(
+                    downloadable_filter(request.user)
+                ).first()
+                
+                if file_transfer and file_transfer.file:
+                    # Add file to ZIP with original filename
+                    entries.append(ArchiveEntry(
+                        file_transfer.file.path,
+                        file_transfer.filename
+                    ))
+            except Exception as e:
+                logger.warning(f"Error adding file {file_id} to ZIP: {e}")
+                continue  # Skip files user doesn't have access to
         
-        # Recursively add subfolders
-        subfolders = Folder.objects.filter(
-            parent=folder
-        ).filter(
-            Q(owner=user) | Q(access_list__granted_to=user)
+        # Add folders to ZIP
+        for folder_id in folder_ids:
+            try:
+                folder = Folder.objects.filter(
+                    id=folder_id
+                ).filter(
+                    id__in=accessible_folder_ids(request.user, grants)
+                ).first()
+                if folder:
+                    # Add all files in this folder and subfolders
+                    self._collect_folder_entries(entries, folder, request.user, '')
+            except Exception as e:
+                logger.warning(f"Error adding folder {folder_id} to ZIP: {e}")
+                continue  # Skip folders user doesn't have access to
+        
+        logger.info(f"Streaming {archive_format} archive with {len(entries)} entries for {request.user.username}")
+        return archive_response(
+            request,
+            entries,
+            f'archivos_seleccionados_{timezone.now().strftime("%Y%m%d_%H%M%S")}',
+            archive_format
         )
-        
-        for subfolder in subfolders:
-            self._add_folder_to_zip(zip_file, subfolder, user, folder_path)
-
-    def _has_file_access(self, user, instance: FileTransfer) -> bool:
-        if user.is_anonymous:
-            return False
-        if instance.owner_id == user.id or instance.uploader_id == user.id:
-            return True
-        if instance.access_list.filter(granted_to=user).exists():
-            return True
-        if instance.folder and instance.folder.access_list.filter(granted_to=user).exists():
-            return True
-        return False
-
-    def _get_file_permission(self, user, instance: FileTransfer) -> str:
-        """Get the permission level for a user on a file"""
-        if user.is_anonymous:
-            return 'none'
-        
-        # Owner and uploader have full permissions
-        if instance.owner_id == user.id or instance.uploader_id == user.id:
-            return 'edit'
-        
-        # Check direct file access
-        file_access = instance.access_list.filter(granted_to=user).first()
-        if file_access:
-            return file_access.permission
-        
-        # Check folder access
-        if instance.folder:
-            folder_access = instance.folder.access_list.filter(granted_to=user).first()
-            if folder_access:
-                return folder_access.permission
-        
-        return 'none'
+    
+    def _collect_folder_entries(self, entries, folder, user, base_path):
+        """Collect folder contents (whole subtree) as ZIP entries"""
+        grants = permission_resolver(self.request).folder_grants()
+        entries.extend(collect_archive_entries(
+            folder,
+            base_path,
+            folder_filter=Q(id__in=accessible_folder_ids(user, grants)),
+            file_filter=Q(id__in=accessible_file_ids(user, grants)) & downloadable_filter(user),
+        ))
+
+    def _has_file_access(self, instance: FileTransfer) -> bool:
+        return permission_resolver(self.request).has_file_access(instance)
+
+    def _get_file_permission(self, instance: FileTransfer) -> str:
+        """Get the permission level for the current user on a file"""
+        return permission_resolver(self.request).file_permission(instance)
 
     @action(detail=True, methods=['delete'], url_path='access/(?P<user_id>[^/.]+)')
     def revoke_access(self, request, pk=None, user_id=None):
         instance = self.get_object()
         
         # Check if user has edit permission to manage access
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -1177,7 +1458,7 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         # Check if user has edit permission to manage access
-        permission = self._get_file_permission(request.user, instance)
+        permission = self._get_file_permission(instance)
         if permission not in ['edit']:
             return Response({
                 'error': 'insufficient_permissions',
@@ -1221,23 +1502,6 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         serializer = FileAccessSerializer(access)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def _inherit_file_access(self, new_file, parent_folder):
-        """
-        Hereda los accesos de la carpeta padre al nuevo archivo
-        """
-        folder_accesses = FolderAccess.objects.filter(folder=parent_folder)
-        
-        for access in folder_accesses:
-            FileAccess.objects.update_or_create(
-                file=new_file,
-                granted_to=access.granted_to,
-                defaults={
-                    'granted_by': access.granted_by,
-                    'permission': access.permission,
-                    'expires_at': access.expires_at
-                }
-            )
-
     @action(detail=False, methods=['get'], url_path='buscar-por-usuario')
     def buscar_archivos_usuario(self, request):
         """
@@ -1288,7 +1552,9 @@ class FileTransferViewSet(viewsets.ModelViewSet):
         # (tanto como propietario o como uploader)
         archivos = FileTransfer.objects.filter(
             Q(owner=target_user) | Q(uploader=target_user)
-        ).prefetch_related('access_list').order_by('-created_at').distinct()
+        ).select_related('owner', 'uploader').prefetch_related(
+            Prefetch('access_list', queryset=FileAccess.objects.select_related('granted_to', 'granted_by'))
+        ).order_by('-created_at')
         
         # Filtrar por tipo si se especifica
         tipo = request.query_params.get('tipo', 'todos')
@@ -1443,7 +1709,7 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
             
             # Add folder contents - files with thumbnail info
             files = FileTransfer.objects.filter(folder=folder).values(
-                'id', 'filename', 'size', 'created_at', 'file'
+                'id', 'filename', 'size', 'created_at', 'file', 'processing_status'
             )
             # Convert to list and add thumbnail URL
             files_list = []
@@ -1466,6 +1732,36 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
 
         return Response(response_data)
 
+    def _get_valid_link(self, request, token, *related):
+        """
+        Valida un token de enlace: activo, no expirado y, si es restringido,
+        que el usuario sea el destinatario.
+        
+        Retorna:
+            (link, None) si es válido, o (None, Response de error)
+        """
+        try:
+            link = ShareLink.objects.select_related(*related).get(token=token, is_active=True)
+        except ShareLink.DoesNotExist:
+            return None, Response({'error': 'Enlace no válido'}, status=status.HTTP_404_NOT_FOUND)
+        
+        if link.expires_at and link.expires_at < timezone.now():
+            return None, Response({'error': 'Enlace expirado'}, status=status.HTTP_410_GONE)
+        
+        if link.access_type == ShareLink.AccessType.SPECIFIC_USER:
+            if not request.user.is_authenticated:
+                return None, Response(
+                    {'error': 'Debes iniciar sesión para acceder a este enlace'},
+                    status=status.HTTP_401_UNAUTHORIZED
+                )
+            if request.user.id != link.specific_user_id:
+                return None, Response(
+                    {'error': 'No tienes permiso para acceder a este enlace'},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+        
+        return link, None
+
     def _grant_permanent_access(self, link, user):
         """
         Concede acceso permanente al usuario cuando accede via enlace 'anyone'.
@@ -1503,65 +1799,44 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
         """
         Endpoint público para obtener thumbnail de archivo via share token.
         URL: /api/share-links/{token}/thumbnail/{file_id}/
+
+        Sirve las miniaturas persistidas (las mismas versiones que
+        /api/transfers/{id}/thumbnail/, con ?size= y negociación por Accept),
+        generadas una sola vez por contenido. Las respuestas llevan ETag y
+        Cache-Control, y las revalidaciones responden 304 sin leer la imagen.
         """
-        token = pk
-        
-        try:
-            link = ShareLink.objects.select_related('folder').get(
-                token=token, is_active=True
-            )
-        except ShareLink.DoesNotExist:
-            return Response({'error': 'Enlace no válido'}, status=status.HTTP_404_NOT_FOUND)
+        link, error_response = self._get_valid_link(request, pk, 'folder')
+        if error_response:
+            return error_response
         
         # Verificar que el archivo pertenece a la carpeta compartida
         if not link.folder:
             return Response({'error': 'Este enlace no es para una carpeta'}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            file_obj = FileTransfer.objects.get(id=file_id, folder=link.folder)
+            file_obj = FileTransfer.objects.select_related('blob').get(id=file_id, folder=link.folder)
         except FileTransfer.DoesNotExist:
             return Response({'error': 'Archivo no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         
-        # Generar thumbnail
-        from PIL import Image
-        from django.http import HttpResponse, FileResponse
-        import io
-        import os
+        # No decodificar contenido sin analizar
+        if file_obj.processing_status not in READY_STATUSES:
+            return _processing_block_response(file_obj)
         
-        file_path = file_obj.file.path
         ext = os.path.splitext(file_obj.filename)[1].lower()
         
-        # Imágenes soportadas
-        supported_images = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg']
-        
-        if ext not in supported_images:
-            return Response({'error': 'No es una imagen'}, status=status.HTTP_400_BAD_REQUEST)
-        
         # SVG: Servir directamente (no se puede procesar con PIL)
         if ext == '.svg':
-            try:
-                return FileResponse(open(file_path, 'rb'), content_type='image/svg+xml')
-            except Exception as e:
-                return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = serve_file(request, file_obj.file.path, content_type='image/svg+xml', as_attachment=False,
+                                  etag=content_etag(file_obj))
+        elif is_image_file(file_obj.filename) or is_video_file(file_obj.filename):
+            response = _thumbnail_response(request, file_obj)
+        else:
+            return Response({'error': 'No es una imagen'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Otros formatos: Generar thumbnail con PIL
-        try:
-            img = Image.open(file_path)
-            img.thumbnail((300, 300))
-            
-            output = io.BytesIO()
-            format_map = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF', '.webp': 'WEBP', '.bmp': 'BMP'}
-            img_format = format_map.get(ext, 'JPEG')
-            
-            if img_format == 'JPEG' and img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            
-            img.save(output, format=img_format, quality=80)
-            output.seek(0)
-            
-            return HttpResponse(output.read(), content_type=f'image/{img_format.lower()}')
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            # Enlaces revocados o caducados dejan de verse en cachés compartidas en una hora
+            response['Cache-Control'] = f'public, max-age={SHARE_THUMBNAIL_MAX_AGE}'
+        return response
 
     @action(detail=True, methods=['get'], url_path='download/(?P<file_id>[^/.]+)', permission_classes=[permissions.AllowAny])
     def download(self, request, pk=None, file_id=None):
@@ -1569,14 +1844,9 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
         Endpoint público para descargar archivo via share token.
         URL: /api/share-links/{token}/download/{file_id}/
         """
-        token = pk
-        
-        try:
-            link = ShareLink.objects.select_related('folder', 'file').get(
-                token=token, is_active=True
-            )
-        except ShareLink.DoesNotExist:
-            return Response({'error': 'Enlace no válido'}, status=status.HTTP_404_NOT_FOUND)
+        link, error_response = self._get_valid_link(request, pk, 'folder', 'file__blob')
+        if error_response:
+            return error_response
         
         # Determinar el archivo a descargar
         file_obj = None
@@ -1587,27 +1857,21 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
         elif link.folder:
             # Archivo dentro de carpeta compartida
             try:
-                file_obj = FileTransfer.objects.get(id=file_id, folder=link.folder)
+                file_obj = FileTransfer.objects.select_related('blob').get(id=file_id, folder=link.folder)
             except FileTransfer.DoesNotExist:
                 return Response({'error': 'Archivo no encontrado en la carpeta compartida'}, status=status.HTTP_404_NOT_FOUND)
         else:
             return Response({'error': 'Archivo no accesible'}, status=status.HTTP_403_FORBIDDEN)
         
-        # Servir el archivo
-        from django.http import FileResponse
-        import os
+        if not can_download(file_obj, request.user):
+            return _processing_block_response(file_obj)
         
+        # Servir el archivo (con soporte de Range para reanudar y buscar en vídeos)
         file_path = file_obj.file.path
         if not os.path.exists(file_path):
             return Response({'error': 'Archivo no encontrado en el servidor'}, status=status.HTTP_404_NOT_FOUND)
         
-        response = FileResponse(
-            open(file_path, 'rb'),
-            as_attachment=True,
-            filename=file_obj.filename
-        )
-        response['Content-Length'] = file_obj.size
-        return response
+        return serve_file(request, file_path, filename=file_obj.filename, etag=content_etag(file_obj))
 
     @action(detail=True, methods=['get'], url_path='download-folder', permission_classes=[permissions.AllowAny])
     def download_folder(self, request, pk=None):
@@ -1615,58 +1879,28 @@ class ShareLinkViewSet(viewsets.ModelViewSet):
         Endpoint público para descargar toda la carpeta como ZIP via share token.
         URL: /api/share-links/{token}/download-folder/
         """
-        token = pk
-        
-        try:
-            link = ShareLink.objects.select_related('folder').get(
-                token=token, is_active=True
-            )
-        except ShareLink.DoesNotExist:
-            return Response({'error': 'Enlace no válido'}, status=status.HTTP_404_NOT_FOUND)
+        link, error_response = self._get_valid_link(request, pk, 'folder')
+        if error_response:
+            return error_response
         
         # Verificar que es un enlace de carpeta
         if not link.folder:
             return Response({'error': 'Este enlace no es para una carpeta'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Verificar expiración
-        if link.expires_at and link.expires_at < timezone.now():
-            return Response({'error': 'Enlace expirado'}, status=status.HTTP_410_GONE)
-        
         folder = link.folder
-        
-        # Crear ZIP en memoria
-        zip_buffer = BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            self._add_shared_folder_to_zip(zip_file, folder, '')
-        
-        zip_buffer.seek(0)
-        
-        response = FileResponse(
-            zip_buffer,
-            as_attachment=True,
-            filename=f'{folder.name}.zip'
-        )
-        response['Content-Type'] = 'application/zip'
-        return response
-
-    def _add_shared_folder_to_zip(self, zip_file, folder, base_path):
-        """Recursively add folder contents to ZIP for shared links"""
-        folder_path = os.path.join(base_path, folder.name) if base_path else folder.name
-        
-        # Add files in this folder
-        files = FileTransfer.objects.filter(folder=folder)
-        
-        for file_transfer in files:
-            if file_transfer.file and os.path.exists(file_transfer.file.path):
-                zip_file.write(
-                    file_transfer.file.path,
-                    os.path.join(folder_path, file_transfer.filename)
-                )
-        
-        # Recursively add subfolders
-        subfolders = Folder.objects.filter(parent=folder)
-        
-        for subfolder in subfolders:
-            self._add_shared_folder_to_zip(zip_file, subfolder, folder_path)
 
+        try:
+            archive_format = get_archive_format(request)
+        except ValueError as e:
+            return Response({'error': 'invalid_archive_format', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # El archivo se construye una vez por estado de la carpeta y se cachea en disco;
+        # las descargas siguientes se sirven como fichero normal (Range incluido)
+        entries = []
+        self._collect_shared_folder_entries(entries, folder, '')
+        return cached_archive_response(request, folder.id, entries, folder.name, archive_format)
+
+    def _collect_shared_folder_entries(self, entries, folder, base_path):
+        """Collect folder contents (whole subtree) as ZIP entries for shared links"""
+        # Only scanned content is shared publicly
+        entries.extend(collect_archive_entries(folder, base_path, file_filter=downloadable_filter()))
@@ -34,6 +34,7 @@ export class FilePreviewModalComponent implements OnInit {
     // UI State
     showMoreMenu = false;
     zoomLevel = 1;
+    renditionFailed = false;
 
     ngOnInit() {
         setTimeout(() => {
@@ -59,6 +60,21 @@ export class FilePreviewModalComponent implements OnInit {
         return this.customDownloadUrl() || `/api/transfers/${this.file().id}/download/`;
     }
 
+    get imageUrl(): string {
+        // Lightbox uses the 1600px rendition instead of the original (GIF/SVG/ICO keep the file)
+        if (this.customDownloadUrl() || this.renditionFailed || /\.(gif|svg|ico)$/i.test(this.file().filename)) {
+            return this.downloadUrl;
+        }
+        return `/api/transfers/${this.file().id}/thumbnail/?size=1600`;
+    }
+
+    onImageError(): void {
+        // No rendition yet (e.g. pending scan): fall back to the original
+        if (!this.renditionFailed && this.imageUrl !== this.downloadUrl) {
+            this.renditionFailed = true;
+        }
+    }
+
     onClose(): void {
         this.isClosing = true;
         setTimeout(() => {
@@ -2328,13 +2328,14 @@ export class IncomingFilesComponent implements OnInit, OnDestroy {
         return `/api/transfers/${fileId}/download/`;
     }
 
-    getThumbnailUrl(fileId: number, filename?: string): string {
+    getThumbnailUrl(fileId: number, filename?: string, size = 400): string {
         // Para SVGs, usamos el propio archivo como miniatura ya que los navegadores lo renderizan bien
         if (filename && filename.toLowerCase().endsWith('.svg')) {
             return this.getFileUrl(fileId);
         }
         // Returns the thumbnail endpoint for optimized gallery preview
-        return `/api/transfers/${fileId}/thumbnail/`;
+        // (the browser's Accept header picks AVIF/WebP/JPEG)
+        return `/api/transfers/${fileId}/thumbnail/?size=${size}`;
     }
 
 
@@ -2895,7 +2896,7 @@ export class IncomingFilesComponent implements OnInit, OnDestroy {
         // Show thumbnail for images and videos
         if (this.isImage(file.filename) || this.isVideo(file.filename)) {
             const img = document.createElement('img');
-            img.src = this.getThumbnailUrl(file.id, file.filename);
+            img.src = this.getThumbnailUrl(file.id, file.filename, 160);
             img.alt = file.filename;
             img.style.width = '48px';
             img.style.height = '48px';
@@ -469,7 +469,25 @@ export class ApiClientService {
         });
     }
 
-    uploadFile(formData: FormData, onProgress?: (progress: any) => void): Promise<any> {
+    preflightUpload(data: { filename: string; size: number; folder?: number | null; owner?: number | null }): Promise<any> {
+        return new Promise((resolve, reject) => {
+            this.request('/transfers/preflight/', 'POST', { data }).subscribe({
+                next: (response) => resolve(response),
+                error: (err) => reject(err)
+            });
+        });
+    }
+
+    async uploadFile(formData: FormData, onProgress?: (progress: any) => void): Promise<any> {
+        // Pre-flight: the server validates the upload and returns a ticket before any byte is sent
+        const file = formData.get('file') as File;
+        const { ticket } = await this.preflightUpload({
+            filename: (formData.get('filename') as string) || file.name,
+            size: file.size,
+            folder: formData.get('folder') ? Number(formData.get('folder')) : null,
+            owner: formData.get('owner') ? Number(formData.get('owner')) : null
+        });
+
         // For file uploads with progress, we need to use a different approach
         return new Promise((resolve, reject) => {
             const xhr = new XMLHttpRequest();
@@ -506,6 +524,7 @@ export class ApiClientService {
 
             xhr.open('POST', `${this.baseUrl}/transfers/`);
             xhr.withCredentials = true;
+            xhr.setRequestHeader('X-Upload-Ticket', ticket);
             xhr.send(formData);
         });
     }
@@ -1,4 +1,5 @@
 import { Directive, ElementRef, Input, OnInit, OnDestroy, Output, EventEmitter } from '@angular/core';
+import { ThumbnailBatchService } from '../services/thumbnail-batch.service';
 
 /**
  * Cola global para limitar peticiones concurrentes de imágenes.
@@ -46,8 +47,11 @@ class ImageLoadQueue {
  * Directiva para carga diferida de imágenes con retry automático.
  * 
  * - Muestra estado "loading" hasta que carga
- * - Si falla, reintenta después de 60 segundos
+ * - Si falla, reintenta tras 3 s, duplicando la espera hasta 60 s
+ *   (las miniaturas en generación responden 202 y cargan en pocos segundos)
  * - Sin límite de reintentos (reintenta indefinidamente)
+ * - Con lazyBatchId, la primera carga va por lotes (ThumbnailBatchService);
+ *   si el lote no la trae se usa lazySrc
  */
 @Directive({
     selector: '[appLazyLoad]',
@@ -56,6 +60,10 @@ class ImageLoadQueue {
 export class LazyLoadImageDirective implements OnInit, OnDestroy {
     @Input('appLazyLoad') lazySrc!: string;
 
+    /** Id del archivo para pedir su miniatura por lotes (opcional) */
+    @Input() lazyBatchId?: number;
+    @Input() lazyBatchSize = 400;
+
     /** Si es true, la imagen está cargando o esperando retry */
     @Output() lazyLoading = new EventEmitter<boolean>();
 
@@ -63,9 +71,14 @@ export class LazyLoadImageDirective implements OnInit, OnDestroy {
     private hasLoaded = false;
     private isQueued = false;
     private retryTimeout?: ReturnType<typeof setTimeout>;
-    private readonly RETRY_DELAY_MS = 60000; // 60 segundos = 1 minuto
+    private readonly RETRY_DELAY_MS = 3000;
+    private readonly MAX_RETRY_DELAY_MS = 60000; // 60 segundos = 1 minuto
+    private retryDelay = this.RETRY_DELAY_MS;
+    private batchTried = false;
+    private objectUrl?: string;
+    private destroyed = false;
 
-    constructor(private el: ElementRef<HTMLImageElement>) { }
+    constructor(private el: ElementRef<HTMLImageElement>, private thumbnailBatch: ThumbnailBatchService) { }
 
     ngOnInit(): void {
         if (!this.lazySrc) return;
@@ -96,14 +109,30 @@ export class LazyLoadImageDirective implements OnInit, OnDestroy {
         this.isQueued = true;
         this.observer?.disconnect();
 
+        if (this.lazyBatchId !== undefined && !this.batchTried) {
+            // El lote no pasa por la cola: es una sola petición para muchas tiles
+            this.batchTried = true;
+            this.thumbnailBatch.request(this.lazyBatchId, this.lazyBatchSize).then(image => {
+                if (this.destroyed) return;
+                if (image) {
+                    this.objectUrl = URL.createObjectURL(image);
+                    this.loadImage(this.objectUrl, false);
+                } else {
+                    this.isQueued = false;
+                    this.queueImageLoad();
+                }
+            });
+            return;
+        }
+
         ImageLoadQueue.enqueue(() => {
-            this.loadImage();
+            this.loadImage(this.lazySrc, true);
         });
     }
 
-    private loadImage(): void {
+    private loadImage(src: string, queued: boolean): void {
         if (this.hasLoaded) {
-            ImageLoadQueue.complete();
+            if (queued) ImageLoadQueue.complete();
             return;
         }
 
@@ -112,23 +141,26 @@ export class LazyLoadImageDirective implements OnInit, OnDestroy {
         const onLoad = () => {
             this.hasLoaded = true;
             this.lazyLoading.emit(false); // Ya no está cargando
-            ImageLoadQueue.complete();
+            if (queued) ImageLoadQueue.complete();
             cleanup();
         };
 
         const onError = () => {
-            ImageLoadQueue.complete();
+            if (queued) ImageLoadQueue.complete();
             cleanup();
+            this.revokeObjectUrl();
 
-            // Siempre reintentar después de 60 segundos
-            console.log(`[LazyLoad] Error cargando imagen. Reintentando en 60s...`);
+            // Siempre reintentar, con espera creciente
+            const delay = this.retryDelay;
+            this.retryDelay = Math.min(this.retryDelay * 2, this.MAX_RETRY_DELAY_MS);
+            console.log(`[LazyLoad] Error cargando imagen. Reintentando en ${delay / 1000}s...`);
             img.removeAttribute('src');
             this.lazyLoading.emit(true); // Sigue en estado de carga
 
             this.retryTimeout = setTimeout(() => {
                 this.isQueued = false;
                 this.queueImageLoad();
-            }, this.RETRY_DELAY_MS);
+            }, delay);
         };
 
         const cleanup = () => {
@@ -138,13 +170,22 @@ export class LazyLoadImageDirective implements OnInit, OnDestroy {
 
         img.addEventListener('load', onLoad);
         img.addEventListener('error', onError);
-        img.src = this.lazySrc;
+        img.src = src;
+    }
+
+    private revokeObjectUrl(): void {
+        if (this.objectUrl) {
+            URL.revokeObjectURL(this.objectUrl);
+            this.objectUrl = undefined;
+        }
     }
 
     ngOnDestroy(): void {
+        this.destroyed = true;
         this.observer?.disconnect();
         if (this.retryTimeout) {
             clearTimeout(this.retryTimeout);
         }
+        this.revokeObjectUrl();
     }
 }
@@ -0,0 +1,93 @@
+import { Injectable } from '@angular/core';
+
+/** Entrada del índice de un paquete de miniaturas (GET /api/transfers/thumbnails/). */
+interface ThumbnailPackEntry {
+  id: number;
+  offset: number;
+  length: number;
+  content_type: string;
+  etag: string;
+}
+
+type ThumbnailResolver = (image: Blob | null) => void;
+
+/**
+ * Agrupa las miniaturas que pide la galería en peticiones por lotes a
+ * /api/transfers/thumbnails/?ids=...: una petición autenticada por cada
+ * grupo de tiles que entran en pantalla, en vez de una por tile.
+ *
+ * Cada tile recibe la imagen (Blob) o null si el servidor no la incluyó
+ * (sin miniatura guardada todavía, sin analizar...); en ese caso usa el
+ * endpoint individual, que la genera bajo demanda.
+ */
+@Injectable({
+  providedIn: 'root'
+})
+export class ThumbnailBatchService {
+  private static readonly BATCH_DELAY_MS = 50;
+  private static readonly MAX_BATCH = 100; // TRANSFER_THUMBNAIL_BATCH_MAX del backend
+  // Las imágenes de <img> negocian AVIF/WebP solas; fetch debe declararlo (WebP lo admiten todos)
+  private static readonly ACCEPT = 'image/webp,*/*';
+
+  /** tamaño -> id de archivo -> tiles esperando */
+  private pending = new Map<number, Map<number, ThumbnailResolver[]>>();
+  private flushTimeout?: ReturnType<typeof setTimeout>;
+
+  request(fileId: number, size: number): Promise<Blob | null> {
+    return new Promise(resolve => {
+      let bySize = this.pending.get(size);
+      if (!bySize) {
+        bySize = new Map();
+        this.pending.set(size, bySize);
+      }
+      const waiting = bySize.get(fileId) ?? [];
+      waiting.push(resolve);
+      bySize.set(fileId, waiting);
+
+      if (!this.flushTimeout) {
+        this.flushTimeout = setTimeout(() => this.flush(), ThumbnailBatchService.BATCH_DELAY_MS);
+      }
+    });
+  }
+
+  private flush(): void {
+    this.flushTimeout = undefined;
+    const pending = this.pending;
+    this.pending = new Map();
+
+    pending.forEach((bySize, size) => {
+      const ids = Array.from(bySize.keys());
+      for (let start = 0; start < ids.length; start += ThumbnailBatchService.MAX_BATCH) {
+        const batch = ids.slice(start, start + ThumbnailBatchService.MAX_BATCH);
+        this.fetchBatch(batch, size).then(images => {
+          batch.forEach(id => bySize.get(id)?.forEach(resolve => resolve(images.get(id) ?? null)));
+        });
+      }
+    });
+  }
+
+  /** Descarga un paquete: línea JSON con el índice y las imágenes concatenadas. */
+  private async fetchBatch(ids: number[], size: number): Promise<Map<number, Blob>> {
+    const images = new Map<number, Blob>();
+    try {
+      const response = await fetch(`/api/transfers/thumbnails/?ids=${ids.join(',')}&size=${size}`, {
+        credentials: 'include',
+        headers: { Accept: ThumbnailBatchService.ACCEPT }
+      });
+      if (!response.ok) {
+        return images;
+      }
+      const body = new Uint8Array(await response.arrayBuffer());
+      const newline = body.indexOf(10);
+      const index = JSON.parse(new TextDecoder().decode(body.subarray(0, newline)));
+      const data = body.subarray(newline + 1);
+      for (const entry of index.files as ThumbnailPackEntry[]) {
+        const bytes = data.subarray(entry.offset, entry.offset + entry.length);
+        images.set(entry.id, new Blob([bytes], { type: entry.content_type }));
+      }
+    } catch (error) {
+      console.warn('[ThumbnailBatch] Error cargando miniaturas por lotes', error);
+    }
+    return images;
+  }
+}